@@ -0,0 +1,179 @@
+"""
+Write-behind activity ingestion.
+
+Key ideas:
+- request handlers enqueue activity events in memory instead of inserting rows
+- repeated events of the same type from the same actor are coalesced while
+  they wait (e.g. autosave -> many "data_updated"; changed_keys are merged)
+- a background thread flushes entries older than the coalescing window in one
+  multi-row INSERT and publishes them to feed streams in the same transaction
+  (only the ones the actor's friends may currently see, see visibility.py)
+- rows are stamped with the flush time, not the time of the event: feed
+  cursors are (created_at, id), so a row must never be older than one that
+  was already streamed
+- shutdown flushes everything that is still pending
+
+Trade-off: a hard crash loses at most one window of feed events. Activities
+are feed decoration, not user data, so that is acceptable here.
+"""
+
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional, Tuple
+
+from sqlalchemy import insert
+
+from .db import SessionLocal
+from .feed_hub import activity_out, publish
+from .models import Activity
+from .settings import settings
+from .visibility import visibility_for, visible_now
+
+log = logging.getLogger(__name__)
+
+ACTIVITY_TTL = timedelta(days=7)
+MAX_FLUSH_ATTEMPTS = 3
+
+
+def _merge_payload(old: Dict[str, Any], new: Dict[str, Any]) -> Dict[str, Any]:
+    merged = dict(old)
+    for k, v in new.items():
+        if k == "changed_keys" and isinstance(v, list) and isinstance(merged.get(k), list):
+            merged[k] = merged[k] + [x for x in v if x not in merged[k]]
+        else:
+            merged[k] = v
+    return merged
+
+
+class _Pending:
+    __slots__ = ("payload", "first_seen", "attempts")
+
+    def __init__(self, payload: Dict[str, Any], first_seen: float):
+        self.payload = payload
+        self.first_seen = first_seen  # monotonic, drives the window
+        self.attempts = 0
+
+
+class ActivityQueue:
+    def __init__(self, window_sec: float, flush_interval_sec: float, max_pending: int):
+        self.window_sec = window_sec
+        self.flush_interval_sec = flush_interval_sec
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # (actor_user_id, type) -> pending event
+        self._pending: Dict[Tuple[str, str], _Pending] = {}
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"enqueued": 0, "coalesced": 0, "flushed": 0, "flushes": 0, "errors": 0, "dropped": 0}
+
+    def enqueue(self, actor_user_id: str, activity_type: str, payload: Dict[str, Any]) -> None:
+        key = (actor_user_id, activity_type)
+        with self._lock:
+            self.stats["enqueued"] += 1
+            p = self._pending.get(key)
+            if p is not None:
+                p.payload = _merge_payload(p.payload, payload)
+                self.stats["coalesced"] += 1
+            else:
+                self._pending[key] = _Pending(dict(payload), time.monotonic())
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.set()
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def _take(self, force: bool) -> Dict[Tuple[str, str], _Pending]:
+        cutoff = time.monotonic() - self.window_sec
+        with self._lock:
+            if force or len(self._pending) >= self.max_pending:
+                ready = self._pending
+                self._pending = {}
+                return ready
+            ready = {k: p for k, p in self._pending.items() if p.first_seen <= cutoff}
+            for k in ready:
+                del self._pending[k]
+            return ready
+
+    def _requeue(self, batch: Dict[Tuple[str, str], _Pending]) -> None:
+        with self._lock:
+            for key, p in batch.items():
+                p.attempts += 1
+                if p.attempts >= MAX_FLUSH_ATTEMPTS:
+                    self.stats["dropped"] += 1
+                    continue
+                newer = self._pending.get(key)
+                if newer is not None:
+                    p.payload = _merge_payload(p.payload, newer.payload)
+                self._pending[key] = p
+
+    def flush(self, force: bool = False) -> int:
+        with self._flush_lock:
+            batch = self._take(force)
+            if not batch:
+                return 0
+
+            now = datetime.now(timezone.utc)
+            rows = [{
+                "id": str(uuid.uuid4()),
+                "actor_user_id": actor,
+                "type": activity_type,
+                "visibility": visibility_for(activity_type),
+                "payload": p.payload,
+                "created_at": now,
+                "expires_at": now + ACTIVITY_TTL,
+            } for (actor, activity_type), p in batch.items()]
+
+            db = SessionLocal()
+            try:
+                db.execute(insert(Activity), rows)
+                # Streams get what GET /feed would show now; hidden rows stay stored
+                for row in visible_now(db, rows):
+                    publish(db, {"kind": "activity", "actor_user_id": row["actor_user_id"], "activity": activity_out(Activity(**row))})
+                db.commit()
+            except Exception:
+                db.rollback()
+                self.stats["errors"] += 1
+                log.exception("Activity flush failed; %d events re-queued", len(rows))
+                self._requeue(batch)
+                return 0
+            finally:
+                db.close()
+
+            self.stats["flushed"] += len(rows)
+            self.stats["flushes"] += 1
+            return len(rows)
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.flush_interval_sec)
+            self._wakeup.clear()
+            self.flush()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="activity-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._wakeup.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+        self.flush(force=True)
+
+
+activity_queue = ActivityQueue(
+    settings.activity_coalesce_sec,
+    settings.activity_flush_sec,
+    settings.activity_max_pending,
+)
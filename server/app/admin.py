@@ -1,25 +1,194 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, ClassVar, Optional, Sequence
+
+import anyio
 from sqladmin import Admin, ModelView
-from .models import User, Friend, Activity, ActivityReaction, RevokedToken
+from sqladmin.pagination import Pagination
+from sqlalchemy import func, select, text, tuple_
+from sqlalchemy.orm import selectinload
+from starlette.requests import Request
+
+from .models import User, Friend, Activity, ActivityReaction, RevokedToken, RefreshToken, IdempotencyKey, StorageUsage
+
+# Below this many (estimated) rows an exact count is cheap enough
+EXACT_COUNT_BELOW = 10000
+
+
+class _PageBoundaries:
+    """(view, page size, page) -> sort key of that page's last row, so the next page can seek past it."""
+
+    def __init__(self, max_entries: int = 2000, ttl_sec: float = 300):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[tuple]:
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None or time.monotonic() - hit[0] > self.ttl_sec:
+                return None
+            return hit[1]
+
+    def put(self, key: tuple, value: tuple) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_boundaries = _PageBoundaries()
+
+
+class IndexedModelView(ModelView):
+    """
+    List pages that stay cheap on big tables:
+    - sorting only by indexed columns, newest first by default (seek_columns,
+      which must be unique together and match an index)
+    - unfiltered counts are pg_class.reltuples estimates, not count(*)
+    - page N+1 seeks past the last row of page N (remembered per worker)
+      instead of OFFSET; pages reached some other way fall back to OFFSET
+    """
+
+    page_size = 50
+    page_size_options = [25, 50, 100]
+    seek_columns: ClassVar[Sequence[Any]] = ()
+
+    def _plain(self, request: Request) -> bool:
+        if request.query_params.get("search"):
+            return False
+        return not any(request.query_params.get(f.parameter_name) for f in self.get_filters())
+
+    def _estimated_count_sync(self) -> int:
+        with self.session_maker() as session:
+            n = session.execute(
+                text("SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(:t)"),
+                {"t": self.model.__table__.name},
+            ).scalar()
+            # -1 = never analyzed
+            if n is None or n < EXACT_COUNT_BELOW:
+                n = session.execute(select(func.count()).select_from(self.model)).scalar()
+            return int(n)
+
+    async def count(self, request: Request, stmt=None) -> int:
+        if self._plain(request):
+            return await anyio.to_thread.run_sync(self._estimated_count_sync)
+        return await super().count(request, stmt)
+
+    async def list(self, request: Request) -> Pagination:
+        if not self.seek_columns or not self._plain(request) or request.query_params.get("sortBy"):
+            return await super().list(request)
 
-class UserAdmin(ModelView, model=User):
+        page = max(self.validate_page_number(request.query_params.get("page"), 1), 1)
+        page_size = min(self.validate_page_number(request.query_params.get("pageSize"), self.page_size), max(self.page_size_options))
+        if page_size < 1:
+            return await super().list(request)
+
+        stmt = self.list_query(request)
+        for relation in self._list_relations:
+            stmt = stmt.options(selectinload(relation))
+        stmt = self.sort_query(stmt, request)
+        boundary = _boundaries.get((self.identity, page_size, page - 1)) if page > 1 else None
+        if boundary is not None:
+            stmt = stmt.where(tuple_(*self.seek_columns) < tuple_(*boundary))
+        else:
+            stmt = stmt.offset((page - 1) * page_size)
+        rows = await self._run_query(stmt.limit(page_size))
+
+        if rows:
+            last = rows[-1]
+            _boundaries.put((self.identity, page_size, page), tuple(getattr(last, c.key) for c in self.seek_columns))
+        # The estimate is only a hint: never hide rows that are actually there
+        count = await self.count(request)
+        if rows:
+            count = max(count, (page - 1) * page_size + len(rows) + (1 if len(rows) == page_size else 0))
+        return Pagination(rows=rows, page=page, page_size=page_size, count=count)
+
+
+def _newest_first(*columns) -> list:
+    return [(c, True) for c in columns]
+
+
+class UserAdmin(IndexedModelView, model=User):
     column_list = [User.id, User.email, User.username, User.first_name, User.last_name, User.is_admin]
+    # ix_users_username / ix_users_email
+    column_sortable_list = [User.username, User.email]
+    column_default_sort = [(User.username, False)]
 
-class FriendAdmin(ModelView, model=Friend):
+
+class FriendAdmin(IndexedModelView, model=Friend):
     column_list = [Friend.user_id, Friend.friend_id, Friend.created_at]
+    # ix_friends_created
+    seek_columns = (Friend.created_at, Friend.id)
+    column_sortable_list = [Friend.created_at]
+    column_default_sort = _newest_first(*seek_columns)
+
 
-class ActivityAdmin(ModelView, model=Activity):
-    column_list = [Activity.actor_user_id, Activity.type, Activity.created_at, Activity.expires_at]
+class ActivityAdmin(IndexedModelView, model=Activity):
+    column_list = [Activity.actor_user_id, Activity.type, Activity.visibility, Activity.created_at, Activity.expires_at]
+    # ix_activities_created / ix_activities_expires_at
+    seek_columns = (Activity.created_at, Activity.id)
+    column_sortable_list = [Activity.created_at, Activity.expires_at]
+    column_default_sort = _newest_first(*seek_columns)
 
-class ActivityReactionAdmin(ModelView, model=ActivityReaction):
-    column_list = [ActivityReaction.activity_id, ActivityReaction.user_id, ActivityReaction.reaction]
 
-class RevokedTokenAdmin(ModelView, model=RevokedToken):
+class ActivityReactionAdmin(IndexedModelView, model=ActivityReaction):
+    column_list = [ActivityReaction.activity_id, ActivityReaction.user_id, ActivityReaction.reaction, ActivityReaction.created_at]
+    # ix_activity_reactions_created
+    seek_columns = (ActivityReaction.created_at, ActivityReaction.id)
+    column_sortable_list = [ActivityReaction.created_at]
+    column_default_sort = _newest_first(*seek_columns)
+
+
+class RevokedTokenAdmin(IndexedModelView, model=RevokedToken):
     column_list = [RevokedToken.jti, RevokedToken.user_id, RevokedToken.expires_at]
+    # ix_revoked_tokens_expires_jti
+    seek_columns = (RevokedToken.expires_at, RevokedToken.jti)
+    column_sortable_list = [RevokedToken.expires_at]
+    column_default_sort = _newest_first(*seek_columns)
+
+
+class RefreshTokenAdmin(IndexedModelView, model=RefreshToken):
+    column_list = [
+        RefreshToken.user_id, RefreshToken.family_id, RefreshToken.created_at,
+        RefreshToken.expires_at, RefreshToken.used_at, RefreshToken.revoked_at,
+    ]
+    column_details_exclude_list = [RefreshToken.token_hash]
+    # ix_refresh_tokens_created
+    seek_columns = (RefreshToken.created_at, RefreshToken.id)
+    column_sortable_list = [RefreshToken.created_at]
+    column_default_sort = _newest_first(*seek_columns)
+    can_create = False
+    can_edit = False
+
+
+class IdempotencyKeyAdmin(IndexedModelView, model=IdempotencyKey):
+    column_list = [IdempotencyKey.user_id, IdempotencyKey.idem_key, IdempotencyKey.status_code, IdempotencyKey.expires_at]
+    # ix_idempotency_keys_expires_at
+    column_sortable_list = [IdempotencyKey.expires_at]
+    column_default_sort = [(IdempotencyKey.expires_at, True)]
+
+
+class StorageUsageAdmin(IndexedModelView, model=StorageUsage):
+    name_plural = "Storage usage"
+    column_list = [StorageUsage.user_id, StorageUsage.bytes, StorageUsage.files, StorageUsage.updated_at]
+    # Heaviest users first (ix_storage_usage_bytes)
+    column_sortable_list = [StorageUsage.bytes]
+    column_default_sort = [(StorageUsage.bytes, True)]
+    can_create = False
+    can_edit = False
 
-def setup_admin(app, engine):
+def setup_admin(app, engine) -> Admin:
     admin = Admin(app, engine, title="Database")
     admin.add_view(UserAdmin)
     admin.add_view(FriendAdmin)
     admin.add_view(ActivityAdmin)
     admin.add_view(ActivityReactionAdmin)
     admin.add_view(RevokedTokenAdmin)
+    admin.add_view(RefreshTokenAdmin)
+    admin.add_view(IdempotencyKeyAdmin)
+    admin.add_view(StorageUsageAdmin)
+    return admin
@@ -1,11 +1,12 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Request
+from fastapi import APIRouter, Depends, HTTPException, status
 from sqlalchemy.orm import Session
-from datetime import datetime, timezone
 
 from ...db import get_db
-from ...models import User, RevokedToken
-from ...schemas import UserRegister, UserLogin, TokenResponse, UserOut
-from ...auth import hash_password, verify_password, create_access_token, decode_token, get_current_user
+from ...models import User
+from ...schemas import UserRegister, UserLogin, TokenResponse, RefreshRequest, UserOut
+from ...auth import Principal, hash_password, verify_password, create_access_token, get_principal_write
+from ...refresh_tokens import InvalidRefreshToken, issue, revoke_family, rotate
+from ...settings import settings
 
 router = APIRouter()
 
@@ -45,6 +46,14 @@ def register(payload: UserRegister, db: Session = Depends(get_db)):
     )
 
 
+def _tokens(user: User, refresh_token: str, family_id: str) -> TokenResponse:
+    return TokenResponse(
+        access_token=create_access_token(user, family_id),
+        expires_in=settings.access_token_expires_min * 60,
+        refresh_token=refresh_token,
+    )
+
+
 @router.post("/login", response_model=TokenResponse)
 def login(payload: UserLogin, db: Session = Depends(get_db)):
     # identifier can be email or username
@@ -60,32 +69,30 @@ def login(payload: UserLogin, db: Session = Depends(get_db)):
     if not user or not verify_password(payload.password, user.password_hash):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 
-    return TokenResponse(access_token=create_access_token(user.id))
+    # Every login is a new refresh token family
+    refresh_token, family_id = issue(db, user.id)
+    db.commit()
+    return _tokens(user, refresh_token, family_id)
+
+
+@router.post("/refresh", response_model=TokenResponse)
+def refresh(payload: RefreshRequest, db: Session = Depends(get_db)):
+    """Trade a refresh token for a new access token and the next refresh token (single use)."""
+    try:
+        user, refresh_token, family_id = rotate(db, payload.refresh_token)
+    except InvalidRefreshToken as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
+    return _tokens(user, refresh_token, family_id)
 
 
 @router.post("/logout")
 def logout(
-    request: Request,
-    user: User = Depends(get_current_user),
+    principal: Principal = Depends(get_principal_write),
     db: Session = Depends(get_db),
 ):
-    # read bearer token
-    auth = request.headers.get("authorization", "")
-    if not auth.lower().startswith("bearer "):
-        raise HTTPException(status_code=400, detail="Missing bearer token")
-
-    token = auth.split(" ", 1)[1].strip()
-    payload = decode_token(token)
-    jti = payload.get("jti")
-    exp = payload.get("exp")
-
-    if not jti or not exp:
-        raise HTTPException(status_code=400, detail="Invalid token")
-
-    expires_at = datetime.fromtimestamp(int(exp), tz=timezone.utc)
-    db.add(RevokedToken(jti=jti, user_id=user.id, expires_at=expires_at))
+    # Ends this login: its refresh tokens stop working; the access token
+    # itself runs out within ACCESS_TOKEN_EXPIRES_MIN
+    revoke_family(db, principal.family_id, principal.id)
     db.commit()
 
     return {"status": "ok"}
-
-
@@ -1,57 +1,149 @@
-from fastapi import APIRouter, Depends
+import zipfile
+from typing import Optional
+
+from fastapi import APIRouter, Depends, File, HTTPException, Query, UploadFile
+from fastapi.responses import StreamingResponse
 from sqlalchemy.orm import Session
 
-from ...auth import get_current_user
+from ...auth import Principal, get_current_user, get_current_user_read, get_principal
+from ...activity_queue import activity_queue
+from ...data_export import export_stream, import_archive
+from ...data_history import list_revisions, latest_rev, lock_user, reconstruct, record
 from ...db import get_db
-from ...models import User, Activity
+from ...friend_graph import friend_graph
+from ...models import User
+from ...read_routing import get_read_db
 from ...schemas import AppDataOut, AppDataUpdate
+from ...storage_quota import QuotaExceeded
+from ...tracing import span
+from ...travel_stats import update_for as update_travel_stats
 
 router = APIRouter()
 
 
 def _merge_dict(dst: dict, src: dict) -> dict:
-    # simple recursive merge
+    # simple recursive merge; returns a new dict (dst stays untouched, so it
+    # can still be diffed against, and SQLAlchemy sees a new value)
+    out = dict(dst)
     for k, v in src.items():
-        if isinstance(v, dict) and isinstance(dst.get(k), dict):
-            dst[k] = _merge_dict(dst[k], v)
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = _merge_dict(out[k], v)
         else:
-            dst[k] = v
-    return dst
+            out[k] = v
+    return out
+
+
+def _set_app_data(db: Session, user: User, new: dict) -> None:
+    """Replace app_data and append a history revision. Caller holds lock_user and commits."""
+    old = user.app_data or {}
+    user.app_data = new
+
+    # Mirror visibility flag from app settings if present:
+    # expecting something like app_data["settings"]["travelVisibleToFriends"] = bool
+    settings = (new or {}).get("settings") or {}
+    was_visible = user.travel_visible_to_friends
+    if "travelVisibleToFriends" in settings:
+        user.travel_visible_to_friends = bool(settings["travelVisibleToFriends"])
+
+    with span("data.history"):
+        record(db, user.id, old, new)
+    update_travel_stats(db, user.id, old, new, visibility_changed=was_visible != user.travel_visible_to_friends)
 
 
 @router.get("", response_model=AppDataOut)
-def get_data(user: User = Depends(get_current_user)):
+def get_data(user: User = Depends(get_current_user_read)):
     return AppDataOut(app_data=user.app_data or {})
 
 
 @router.put("", response_model=AppDataOut)
 def update_data(payload: AppDataUpdate, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    current = user.app_data or {}
-    updated = _merge_dict(current, payload.app_data or {})
-    user.app_data = updated
+    lock_user(db, user)
+    with span("data.merge"):
+        updated = _merge_dict(user.app_data or {}, payload.app_data or {})
+    _set_app_data(db, user, updated)
 
-    # Mirror visibility flag from app settings if present:
-    # expecting something like app_data["settings"]["travelVisibleToFriends"] = bool
-    settings = (updated or {}).get("settings") or {}
-    if "travelVisibleToFriends" in settings:
-        user.travel_visible_to_friends = bool(settings["travelVisibleToFriends"])
+    with span("data.commit"):
+        db.add(user)
+        db.commit()
+        db.refresh(user)
 
-    # Add activity (for friends feed)
-    db.add(Activity(
-        actor_user_id=user.id,
-        type="data_updated",
-        payload={"changed_keys": list((payload.app_data or {}).keys())},
-    ))
+    # Add activity (for friends feed); buffered and coalesced, written in batches
+    activity_queue.enqueue(user.id, "data_updated", {"changed_keys": list((payload.app_data or {}).keys())})
+    return AppDataOut(app_data=user.app_data or {})
 
-    db.add(user)
+
+@router.get("/export")
+def export_data(user: Principal = Depends(get_principal)):
+    # Zip of NDJSON per table + stored files, generated while it is sent
+    filename = f"export-{user.username}.zip"
+    return StreamingResponse(
+        export_stream(user.id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/import")
+def import_data(
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    user: User = Depends(get_current_user),
+):
+    try:
+        counts, linked = import_archive(db, user, file.file)
+    except QuotaExceeded as e:
+        db.rollback()
+        raise HTTPException(status_code=413, detail=str(e))
+    except (zipfile.BadZipFile, ValueError, KeyError) as e:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Invalid export archive: {e}")
     db.commit()
-    db.refresh(user)
-    return AppDataOut(app_data=user.app_data or {})
+    friend_graph.invalidate([user.id, *linked])
+    return {"status": "ok", "imported": counts}
 
 
 @router.delete("")
 def delete_data(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    user.app_data = {}
+    # Recoverable: the previous state stays in /data/history
+    lock_user(db, user)
+    _set_app_data(db, user, {})
     db.add(user)
     db.commit()
     return {"status": "ok"}
+
+
+@router.get("/history")
+def data_history(
+    limit: int = Query(50, ge=1, le=200),
+    before: Optional[int] = None,
+    db: Session = Depends(get_read_db),
+    user: Principal = Depends(get_principal),
+):
+    items = list_revisions(db, user.id, limit, before)
+    next_before = items[-1]["rev"] if len(items) == limit else None
+    return {"latest": latest_rev(db, user.id), "items": items, "next_before": next_before}
+
+
+@router.get("/history/{rev}")
+def data_at_revision(rev: int, db: Session = Depends(get_read_db), user: Principal = Depends(get_principal)):
+    data = reconstruct(db, user.id, rev)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Revision not found (or pruned)")
+    return {"rev": rev, "app_data": data}
+
+
+@router.post("/restore")
+def restore_data(rev: int, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
+    lock_user(db, user)
+    data = reconstruct(db, user.id, rev)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Revision not found (or pruned)")
+
+    old = user.app_data or {}
+    changed = sorted(k for k in data.keys() | old.keys() if data.get(k) != old.get(k))
+    _set_app_data(db, user, data)
+    db.add(user)
+    db.commit()
+
+    activity_queue.enqueue(user.id, "data_updated", {"changed_keys": changed})
+    return {"status": "ok", "restored_from": rev, "rev": latest_rev(db, user.id), "app_data": user.app_data or {}}
@@ -1,82 +1,257 @@
-from fastapi import APIRouter, Depends, HTTPException
+import asyncio
+import json
+import uuid
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy import String, exists, func, literal, select, tuple_, union_all
 from sqlalchemy.orm import Session
 from datetime import datetime, timezone
 
-from ...auth import get_current_user
-from ...db import get_db
-from ...models import User, Friend, Activity, ActivityReaction
+from ...auth import Principal, get_principal, get_principal_write
+from ...db import get_db, SessionLocal
+from ...read_routing import get_read_db
+from ...feed_hub import activity_out, hub, publish
+from ...friend_graph import friend_graph
+from ...models import User, Activity, ActivityReaction
 from ...schemas import ReactRequest
+from ...settings import settings
+from ...tracing import span
+from ...upsert import upsert_from_select
+from ...visibility import visible_to_friends
 
 router = APIRouter()
 
 
-def cleanup_expired(db: Session):
-    now = datetime.now(timezone.utc)
-    db.query(ActivityReaction).filter(
-        ActivityReaction.activity_id.in_(
-            db.query(Activity.id).filter(Activity.expires_at < now)
-        )
-    ).delete(synchronize_session=False)
-    db.query(Activity).filter(Activity.expires_at < now).delete(synchronize_session=False)
-    db.commit()
+def reaction_counts(db: Session, activity_ids: list) -> dict:
+    if not activity_ids:
+        return {}
+    reactions = db.query(ActivityReaction).filter(ActivityReaction.activity_id.in_(activity_ids)).all()
 
+    react_map = {}
+    for r in reactions:
+        react_map.setdefault(r.activity_id, {})
+        react_map[r.activity_id].setdefault(r.reaction, 0)
+        react_map[r.activity_id][r.reaction] += 1
+    return react_map
 
-@router.get("")
-def get_feed(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    cleanup_expired(db)
 
-    friend_ids = [r.friend_id for r in db.query(Friend).filter(Friend.user_id == user.id).all()]
+def activity_cursor(created_at: str, activity_id: str) -> str:
+    # Stream cursor: "<created_at ISO>|<activity id>" (sent as the SSE event id)
+    return f"{created_at}|{activity_id}"
+
+
+def _feed_query(db: Session, friend_ids: list, now: datetime):
+    """
+    Friends' unexpired activities that their actor currently lets friends see.
+    One query: the index on (actor, created_at) plus a probe of each actor's row.
+    """
+    return (
+        db.query(Activity)
+        .join(User, User.id == Activity.actor_user_id)
+        .filter(Activity.actor_user_id.in_(friend_ids), Activity.expires_at >= now, visible_to_friends())
+    )
+
+
+def _parse_cursor(cursor: str):
+    try:
+        ts, activity_id = cursor.split("|", 1)
+        return datetime.fromisoformat(ts), activity_id
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+@router.get("")
+def get_feed(db: Session = Depends(get_read_db), user: Principal = Depends(get_principal)):
+    # Expired rows are purged in the background (lifecycle.py); filter them here
+    with span("feed.friend_ids"):
+        friend_ids = list(friend_graph.friend_ids(db, user.id))
     if not friend_ids:
         return []
 
     now = datetime.now(timezone.utc)
-    # Note: visibility logic: if actor hides travel, you may still show non-travel activities.
-    # For now we show all activities, but you can filter by activity type if needed.
-    q = (
-        db.query(Activity)
-        .filter(Activity.actor_user_id.in_(friend_ids), Activity.expires_at >= now)
-        .order_by(Activity.created_at.desc())
-        .limit(200)
+    q = _feed_query(db, friend_ids, now).order_by(Activity.created_at.desc()).limit(200)
+    with span("feed.activities"):
+        activities = q.all()
+
+    with span("feed.reaction_counts", activities=len(activities)):
+        react_map = reaction_counts(db, [a.id for a in activities])
+    with span("feed.serialize"):
+        return [activity_out(a, react_map.get(a.id)) for a in activities]
+
+
+def _activities_after(friend_ids: list, after) -> list:
+    """Catch-up query for a stream: friends' activities newer than the cursor, oldest first."""
+    db = SessionLocal()
+    try:
+        now = datetime.now(timezone.utc)
+        activities = (
+            _feed_query(db, friend_ids, now)
+            .filter(tuple_(Activity.created_at, Activity.id) > tuple_(*after))
+            .order_by(Activity.created_at.asc(), Activity.id.asc())
+            .limit(200)
+            .all()
+        )
+        react_map = reaction_counts(db, [a.id for a in activities])
+        return [activity_out(a, react_map.get(a.id)) for a in activities]
+    finally:
+        db.close()
+
+
+def _friend_ids(user_id: str) -> list:
+    # Primary: called right after a friend change committed
+    db = SessionLocal()
+    try:
+        return list(friend_graph.friend_ids(db, user_id))
+    finally:
+        db.close()
+
+
+def _sse(event: dict) -> str:
+    lines = [f"event: {event['kind']}"]
+    if event["kind"] == "activity":
+        a = event["activity"]
+        lines.append(f"id: {activity_cursor(a['created_at'], a['id'])}")
+    lines.append(f"data: {json.dumps(event, default=str)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@router.get("/stream")
+async def stream_feed(
+    request: Request,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_read_db),
+    user: Principal = Depends(get_principal),
+):
+    """
+    Server-Sent Events stream of new friend activities and reaction changes.
+
+    Resume: pass the last received event id as `Last-Event-ID` (EventSource does
+    this automatically) or as `?cursor=`; missed activities are replayed first.
+    """
+    if not settings.feed_push_enabled:
+        raise HTTPException(status_code=404, detail="Feed push disabled")
+
+    resume_from = request.headers.get("last-event-id") or cursor
+    after = _parse_cursor(resume_from) if resume_from else None
+
+    user_id = user.id
+    friend_ids = list(friend_graph.friend_ids(db, user_id))
+    # Release the pooled connection: the stream may stay open for hours.
+    db.close()
+
+    async def events():
+        last = after
+        # Subscribe before the catch-up query so nothing falls in between.
+        sub = hub.subscribe(user_id, friend_ids)
+        try:
+            catch_up = last is not None
+            while True:
+                refetch = False
+                if sub.friends_changed:
+                    # Follow the new friend set; a new friend's events from
+                    # before the resubscribe come from the catch-up query
+                    sub.friends_changed = False
+                    hub.resubscribe(sub, await run_in_threadpool(_friend_ids, user_id))
+                    refetch = True
+                if catch_up or sub.lagged:
+                    while not sub.queue.empty():
+                        sub.queue.get_nowait()
+                    sub.lagged = False
+                    catch_up = False
+                    refetch = True
+                if refetch and sub.friend_ids and last is not None:
+                    for a in await run_in_threadpool(_activities_after, list(sub.friend_ids), last):
+                        last = (datetime.fromisoformat(a["created_at"]), a["id"])
+                        yield _sse({"kind": "activity", "actor_user_id": a["actor_user_id"], "activity": a})
+
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=settings.feed_heartbeat_sec)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+
+                if event.get("kind") == "friends_changed":
+                    continue  # handled at the top of the loop
+                if event.get("actor_user_id") not in sub.friend_ids:
+                    continue  # queued before an unfriend
+                if event.get("kind") == "activity":
+                    a = event["activity"]
+                    key = (datetime.fromisoformat(a["created_at"]), a["id"])
+                    if last is not None and key <= last:
+                        continue  # already sent by a catch-up query
+                    last = key
+                yield _sse(event)
+        finally:
+            hub.unsubscribe(sub)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    activities = q.all()
 
-    # reactions counts
-    act_ids = [a.id for a in activities]
-    reactions = db.query(ActivityReaction).filter(ActivityReaction.activity_id.in_(act_ids)).all()
 
-    react_map = {}
-    for r in reactions:
-        react_map.setdefault(r.activity_id, {})
-        react_map[r.activity_id].setdefault(r.reaction, 0)
-        react_map[r.activity_id][r.reaction] += 1
+def _react_stmt(activity_id: str, user_id: str, reaction: str):
+    """
+    One statement that upserts the reaction and returns the activity's new
+    reaction counts (plus its actor) - one row per reaction kind.
+    No rows means the activity does not exist.
+    """
+    target = (
+        select(Activity.id, Activity.actor_user_id)
+        .where(Activity.id == activity_id)
+        .cte("target")
+    )
+    up = upsert_from_select(
+        ActivityReaction,
+        ["id", "activity_id", "user_id", "reaction", "created_at"],
+        select(
+            literal(str(uuid.uuid4()), String),
+            target.c.id,
+            literal(user_id, String),
+            literal(reaction, String),
+            func.now(),
+        ),
+        constraint="uq_react_once",
+        update=["reaction"],
+    ).returning(ActivityReaction.reaction).cte("up")
 
-    return [{
-        "id": a.id,
-        "actor_user_id": a.actor_user_id,
-        "type": a.type,
-        "payload": a.payload,
-        "created_at": a.created_at.isoformat(),
-        "expires_at": a.expires_at.isoformat(),
-        "reactions": react_map.get(a.id, {}),
-    } for a in activities]
+    # The outer query sees the pre-statement snapshot, so count everyone
+    # else's rows from the table and our own from the upsert's RETURNING.
+    others = select(ActivityReaction.reaction).where(
+        ActivityReaction.activity_id == activity_id,
+        ActivityReaction.user_id != user_id,
+    )
+    r = union_all(others, select(up.c.reaction)).subquery("r")
+    return (
+        select(
+            r.c.reaction,
+            func.count().label("n"),
+            select(target.c.actor_user_id).scalar_subquery().label("actor_user_id"),
+        )
+        .where(exists(select(up.c.reaction)))
+        .group_by(r.c.reaction)
+    )
 
 
 @router.post("/activities/{activity_id}/react")
-def react(activity_id: str, payload: ReactRequest, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    a = db.query(Activity).filter(Activity.id == activity_id).first()
-    if not a:
+def react(activity_id: str, payload: ReactRequest, db: Session = Depends(get_db), user: Principal = Depends(get_principal_write)):
+    rows = db.execute(_react_stmt(activity_id, user.id, payload.reaction)).all()
+    if not rows:
         raise HTTPException(status_code=404, detail="Activity not found")
 
-    existing = db.query(ActivityReaction).filter(
-        ActivityReaction.activity_id == activity_id,
-        ActivityReaction.user_id == user.id,
-    ).first()
-
-    if existing:
-        existing.reaction = payload.reaction
-        db.add(existing)
-    else:
-        db.add(ActivityReaction(activity_id=activity_id, user_id=user.id, reaction=payload.reaction))
+    reactions = {row.reaction: row.n for row in rows}
+    publish(db, {
+        "kind": "reaction",
+        "actor_user_id": rows[0].actor_user_id,
+        "activity_id": activity_id,
+        "reactions": reactions,
+    })
 
     db.commit()
-    return {"status": "ok"}
+    return {"status": "ok", "reactions": reactions}
@@ -1,43 +1,144 @@
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException
-from pathlib import Path
+from typing import Callable, Optional
 
-from ...auth import get_current_user
+from fastapi import APIRouter, Depends, Request, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import Session
+
+from ...auth import Principal, get_current_user, get_principal, get_principal_write
+from ...db import get_db
+from ...read_routing import get_read_db
 from ...models import User
 from ...schemas import FileMeta
-from ...storage import save_upload
+from ...storage import object_key, storage, upload_chunks
+from ...storage_quota import QuotaExceeded, check_quota, list_files, record_delete, record_put, usage
 
 router = APIRouter()
 
+PROFILE_PIC = "profile_pic"
+
+
+def _key(user_id: str, name: str) -> str:
+    try:
+        return object_key(user_id, name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def _name(key: str) -> str:
+    return key.split("/", 1)[1]
+
+
+def _upload_size(request: Request, file: UploadFile) -> int:
+    # Spooled multipart uploads know their size; else bound it by the request body
+    if file.size is not None:
+        return file.size
+    return int(request.headers.get("content-length") or 0)
+
+
+async def _store(db: Session, user_id: str, key: str, request: Request, file: UploadFile, also: Optional[Callable[[], None]] = None):
+    """Quota check before any byte is written, stream to the driver, then account it in one transaction."""
+    try:
+        await run_in_threadpool(check_quota, db, user_id, _name(key), _upload_size(request, file))
+    except QuotaExceeded as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    obj = await storage.put(key, upload_chunks(file), file.content_type)
+
+    def _account():
+        record_put(db, user_id, _name(key), obj.size, file.content_type)
+        if also is not None:
+            also()
+        db.commit()
+
+    await run_in_threadpool(_account)
+    return obj
+
+
+async def _download(key: str) -> StreamingResponse:
+    obj = await storage.stat(key)
+    if obj is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    headers = {"Content-Length": str(obj.size), "Content-Disposition": f'inline; filename="{_name(key)}"'}
+    if obj.etag:
+        headers["ETag"] = obj.etag
+    return StreamingResponse(storage.get(key), media_type="application/octet-stream", headers=headers)
+
+
+@router.get("")
+def get_files(db: Session = Depends(get_read_db), user: Principal = Depends(get_principal)):
+    # From the usage index, not a directory walk
+    return {"usage": usage(db, user.id), "files": list_files(db, user.id)}
+
+
 @router.post("/upload", response_model=FileMeta)
 async def upload_file(
+    request: Request,
     file: UploadFile = File(...),
-    user: User = Depends(get_current_user),
+    db: Session = Depends(get_db),
+    user: Principal = Depends(get_principal_write),
 ):
-    target_path: Path = await save_upload(file, subdir=user.id)
-    size = target_path.stat().st_size
-    return FileMeta(
-        filename=file.filename,
-        path=str(target_path),
-        size=size,
-        content_type=file.content_type,
-    )
+    key = _key(user.id, file.filename)
+    obj = await _store(db, user.id, key, request, file)
+    return FileMeta(filename=_name(key), path=key, size=obj.size, content_type=file.content_type)
+
+
+@router.get("/download/{name}")
+async def download_file(name: str, user: Principal = Depends(get_principal)):
+    return await _download(_key(user.id, name))
 
 
 @router.put("/profile-pic", response_model=FileMeta)
 async def update_profile_pic(
+    request: Request,
     file: UploadFile = File(...),
+    db: Session = Depends(get_db),
     user: User = Depends(get_current_user),
 ):
     # store under user folder, fixed filename
-    target_path: Path = await save_upload(file, subdir=user.id, force_name="profile_pic")
-    user.profile_pic_path = str(target_path)
-    size = target_path.stat().st_size
-    return FileMeta(filename=file.filename, path=str(target_path), size=size, content_type=file.content_type)
+    key = object_key(user.id, PROFILE_PIC)
+
+    def _set_pic():
+        user.profile_pic_path = key
+
+    obj = await _store(db, user.id, key, request, file, also=_set_pic)
+    return FileMeta(filename=file.filename, path=key, size=obj.size, content_type=file.content_type)
+
+
+@router.get("/profile-pic/{user_id}")
+async def get_profile_pic(user_id: str, user: Principal = Depends(get_principal)):
+    if user_id in (".", "..") or "/" in user_id or "\\" in user_id:
+        raise HTTPException(status_code=404, detail="File not found")
+    return await _download(object_key(user_id, PROFILE_PIC))
 
 
 @router.delete("/profile-pic")
-def delete_profile_pic(user: User = Depends(get_current_user)):
+async def delete_profile_pic(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
     if not user.profile_pic_path:
         raise HTTPException(status_code=404, detail="No profile pic")
-    user.profile_pic_path = None
+
+    def _forget():
+        user.profile_pic_path = None
+        record_delete(db, user.id, PROFILE_PIC)
+        db.commit()
+
+    await run_in_threadpool(_forget)
+    await storage.delete(object_key(user.id, PROFILE_PIC))
+    return {"status": "ok"}
+
+
+# Declared last: the fixed /profile-pic routes above take precedence
+@router.delete("/{name}")
+async def delete_file(name: str, db: Session = Depends(get_db), user: Principal = Depends(get_principal_write)):
+    key = _key(user.id, name)
+
+    def _forget() -> bool:
+        found = record_delete(db, user.id, _name(key))
+        db.commit()
+        return found
+
+    # Blobs from before quotas may not be accounted yet (lifecycle reconciles them)
+    if not await run_in_threadpool(_forget) and await storage.stat(key) is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    await storage.delete(key)
     return {"status": "ok"}
@@ -1,18 +1,63 @@
-from fastapi import APIRouter, Depends, HTTPException
+from typing import List
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import and_, func, or_
 from sqlalchemy.orm import Session
 
-from ...auth import get_current_user
+from ...auth import Principal, get_principal, get_principal_write
 from ...db import get_db
+from ...read_routing import get_read_db
+from ...friend_graph import friend_graph, friends_changed
+from ...friend_suggestions import refresh as refresh_suggestions, suggestions_for
 from ...models import User, Friend
+from ...upsert import upsert
+from ...travel_stats import leaderboard
+from ...schemas import FriendBulkRequest, FriendBulkResult, ContactMatchRequest, ContactMatch
 
 router = APIRouter()
 
 
+def _link(db: Session, user_id: str, other_ids: list) -> None:
+    """Store both directions for every pair in one statement; existing pairs are kept."""
+    if not other_ids:
+        return
+    rows = []
+    for other_id in other_ids:
+        rows.append({"user_id": user_id, "friend_id": other_id})
+        rows.append({"user_id": other_id, "friend_id": user_id})
+    db.execute(upsert(Friend, rows, constraint="uq_friend_pair"))
+    friends_changed(db, [user_id, *other_ids])
+    refresh_suggestions(db, [user_id, *other_ids])
+
+
+def _unlink(db: Session, user_id: str, other_ids: list) -> None:
+    if not other_ids:
+        return
+    db.query(Friend).filter(or_(
+        and_(Friend.user_id == user_id, Friend.friend_id.in_(other_ids)),
+        and_(Friend.friend_id == user_id, Friend.user_id.in_(other_ids)),
+    )).delete(synchronize_session=False)
+    friends_changed(db, [user_id, *other_ids])
+    refresh_suggestions(db, [user_id, *other_ids])
+
+
+def _resolve_usernames(db: Session, user: Principal, usernames: list):
+    wanted = {u for u in usernames if u and u != user.username}
+    found = (
+        db.query(User.id, User.username)
+        .filter(User.username.in_(wanted), User.is_deleted == False)  # noqa: E712
+        .all()
+    ) if wanted else []
+    found_names = {r.username for r in found}
+    return found, sorted(wanted - found_names)
+
+
 @router.get("")
-def list_friends(db: Session = Depends(get_db), user: User = Depends(get_current_user)):
-    rows = db.query(Friend).filter(Friend.user_id == user.id).all()
-    friend_ids = [r.friend_id for r in rows]
-    friends = db.query(User).filter(User.id.in_(friend_ids), User.is_deleted == False).all()  # noqa: E712
+def list_friends(db: Session = Depends(get_read_db), user: Principal = Depends(get_principal)):
+    friend_ids = friend_graph.friend_ids(db, user.id)
+    if not friend_ids:
+        return []
+    friends = db.query(User).filter(User.id.in_(list(friend_ids)), User.is_deleted == False).all()  # noqa: E712
     return [{
         "id": f.id,
         "username": f.username,
@@ -22,8 +67,85 @@ def list_friends(db: Session = Depends(get_db), user: User = Depends(get_current
     } for f in friends]
 
 
+@router.get("/leaderboard")
+def friends_leaderboard(
+    sort: str = Query("countries", pattern="^(countries|cities|continents)$"),
+    db: Session = Depends(get_read_db),
+    user: Principal = Depends(get_principal),
+):
+    # Me plus friends who share their travel stats, ranked (ties share a rank)
+    return {"sort": sort, "items": leaderboard(db, user.id, sort)}
+
+
+@router.get("/suggestions")
+def friend_suggestions(
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_read_db),
+    user: Principal = Depends(get_principal),
+):
+    # Precomputed friend-of-friend candidates, most mutual friends first
+    return suggestions_for(db, user.id, friend_graph.friend_ids(db, user.id), limit)
+
+
+# Multi-user operations sit under /actions/ (two path segments), so they never
+# shadow POST /{username} for users named "bulk" or "match"
+@router.post("/actions/bulk", response_model=FriendBulkResult)
+def add_friends_bulk(payload: FriendBulkRequest, db: Session = Depends(get_db), user: Principal = Depends(get_principal_write)):
+    found, not_found = _resolve_usernames(db, user, payload.usernames)
+    other_ids = [r.id for r in found]
+
+    _link(db, user.id, other_ids)
+    db.commit()
+    friend_graph.invalidate([user.id, *other_ids])
+    return FriendBulkResult(usernames=sorted(r.username for r in found), not_found=not_found)
+
+
+@router.post("/actions/bulk/remove", response_model=FriendBulkResult)
+def remove_friends_bulk(payload: FriendBulkRequest, db: Session = Depends(get_db), user: Principal = Depends(get_principal_write)):
+    found, not_found = _resolve_usernames(db, user, payload.usernames)
+    other_ids = [r.id for r in found]
+
+    _unlink(db, user.id, other_ids)
+    db.commit()
+    friend_graph.invalidate([user.id, *other_ids])
+    return FriendBulkResult(usernames=sorted(r.username for r in found), not_found=not_found)
+
+
+@router.post("/actions/match", response_model=List[ContactMatch])
+def match_contacts(payload: ContactMatchRequest, db: Session = Depends(get_read_db), user: Principal = Depends(get_principal)):
+    """Contact-import matching: which of these usernames/emails have accounts (one query)."""
+    usernames = {u for u in payload.usernames if u}
+    emails = {e.lower() for e in payload.emails if e}
+    if not usernames and not emails:
+        return []
+
+    conds = []
+    if usernames:
+        conds.append(User.username.in_(usernames))
+    if emails:
+        conds.append(func.lower(User.email).in_(emails))
+    matches = (
+        db.query(User)
+        .filter(or_(*conds), User.id != user.id, User.is_deleted == False)  # noqa: E712
+        .limit(len(usernames) + len(emails))
+        .all()
+    )
+    # only report the identifiers the caller actually supplied
+    matches = [m for m in matches if m.username in usernames or m.email.lower() in emails]
+
+    friend_ids = friend_graph.friend_ids(db, user.id)
+    return [ContactMatch(
+        id=m.id,
+        username=m.username,
+        first_name=m.first_name,
+        last_name=m.last_name,
+        profile_pic_path=m.profile_pic_path,
+        is_friend=m.id in friend_ids,
+    ) for m in matches]
+
+
 @router.post("/{username}")
-def add_friend(username: str, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
+def add_friend(username: str, db: Session = Depends(get_db), user: Principal = Depends(get_principal_write)):
     other = db.query(User).filter(User.username == username, User.is_deleted == False).first()  # noqa: E712
     if not other:
         raise HTTPException(status_code=404, detail="User not found")
@@ -31,22 +153,19 @@ def add_friend(username: str, db: Session = Depends(get_db), user: User = Depend
         raise HTTPException(status_code=400, detail="Cannot friend yourself")
 
     # store both directions
-    for a, b in [(user.id, other.id), (other.id, user.id)]:
-        exists = db.query(Friend).filter(Friend.user_id == a, Friend.friend_id == b).first()
-        if not exists:
-            db.add(Friend(user_id=a, friend_id=b))
-
+    _link(db, user.id, [other.id])
     db.commit()
+    friend_graph.invalidate([user.id, other.id])
     return {"status": "ok"}
 
 
 @router.delete("/{username}")
-def remove_friend(username: str, db: Session = Depends(get_db), user: User = Depends(get_current_user)):
+def remove_friend(username: str, db: Session = Depends(get_db), user: Principal = Depends(get_principal_write)):
     other = db.query(User).filter(User.username == username, User.is_deleted == False).first()  # noqa: E712
     if not other:
         raise HTTPException(status_code=404, detail="User not found")
 
-    db.query(Friend).filter(Friend.user_id == user.id, Friend.friend_id == other.id).delete()
-    db.query(Friend).filter(Friend.user_id == other.id, Friend.friend_id == user.id).delete()
+    _unlink(db, user.id, [other.id])
     db.commit()
+    friend_graph.invalidate([user.id, other.id])
     return {"status": "ok"}
@@ -1,12 +1,31 @@
+import asyncio
+import json
+import threading
+import time
+from typing import Any, Dict, Optional
+
 from fastapi import APIRouter, Depends, Form, Request, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 
 from ...auth import verify_password
 from ...models import User
 from ...db import get_db
+from ...read_routing import get_read_db, read_router
 from ...monitoring import stats, request_logs
+from ...tracing import traces, trace_stats
+from ...idempotency import idempotency_stats
+from ...activity_queue import activity_queue
+from ...lifecycle import lifecycle_worker
+from ...storage_quota import heaviest_users, totals
+from ...friend_suggestions import suggestions_worker
+from ...map_cache import map_images
+from ...refresh_tokens import refresh_stats
+from ...ratelimit import rate_limit_stats
+from ...boot import boot_report
+from ...settings import settings
 
 router = APIRouter()
 
@@ -140,33 +159,130 @@ def monitor_page(user: User = Depends(get_admin_user_from_session)):
         </div>
       </div>
       <div id="stats" style="margin-top: 16px;"></div>
+      <h3>Recent Traces</h3>
+      <pre id="traces" style="background:#f6f6f6; padding: 12px; overflow:auto; max-height: 400px;"></pre>
       <h3>Last Requests</h3>
       <pre id="logs" style="background:#f6f6f6; padding: 12px; overflow:auto;"></pre>
       <script>
-        async function refresh(){{
-          const s = await fetch('/monitor/stats').then(r=>r.json());
-          const l = await fetch('/monitor/requests').then(r=>r.json());
-          document.getElementById('stats').innerText = JSON.stringify(s, null, 2);
-          document.getElementById('logs').innerText = JSON.stringify(l, null, 2);
-        }}
-        refresh();
-        setInterval(refresh, 2000);
+        // Pushed by the server (one shared snapshot per worker), no polling
+        const es = new EventSource('/monitor/stream');
+        es.onmessage = (e) => {{
+          const m = JSON.parse(e.data);
+          document.getElementById('stats').innerText = JSON.stringify(m.stats, null, 2);
+          document.getElementById('logs').innerText = JSON.stringify(m.requests, null, 2);
+          document.getElementById('traces').innerText = JSON.stringify(m.traces, null, 2);
+        }};
       </script>
     </body>
     </html>
     """
 
 
-@router.get("/monitor/stats")
-def monitor_stats(db: Session = Depends(get_db), user: User = Depends(get_admin_user_from_session)):
+def _collect_stats() -> Dict[str, Any]:
     ok = True
+    db = read_router.session_for(None)
     try:
         db.execute(text("SELECT 1"))
     except Exception:
         ok = False
-    return {"api": stats, "db_ok": ok}
+    finally:
+        db.close()
+    return {
+        "api": stats,
+        "db_ok": ok,
+        "activity_queue": {**activity_queue.stats, "pending": activity_queue.pending_count()},
+        "rate_limit": rate_limit_stats,
+        "lifecycle": lifecycle_worker.stats,
+        "friend_suggestions": suggestions_worker.stats,
+        "map_render": map_images.stats(),
+        "auth": refresh_stats,
+        "idempotency": idempotency_stats,
+        "tracing": trace_stats,
+        "read_routing": {"replica_enabled": read_router.enabled, **read_router.stats},
+        "boot": boot_report,
+    }
+
+
+class _MonitorSnapshot:
+    """
+    The monitor payload as of at most MONITOR_SNAPSHOT_SEC ago. However many
+    tabs / streams watch, a worker builds (and DB-probes, and serialises) it
+    once per interval.
+    """
+
+    def __init__(self, max_age_sec: float):
+        self.max_age_sec = max_age_sec
+        self._lock = threading.Lock()
+        self.built_at = 0.0
+        self.stats: Optional[Dict[str, Any]] = None
+        self.payload = ""
+
+    def fresh(self) -> bool:
+        return self.stats is not None and time.monotonic() - self.built_at < self.max_age_sec
+
+    def get(self) -> "_MonitorSnapshot":
+        with self._lock:
+            if not self.fresh():
+                current = json.loads(json.dumps(_collect_stats(), default=str))
+                self.payload = json.dumps(
+                    {"stats": current, "requests": list(request_logs), "traces": list(traces)[:10]},
+                    default=str,
+                )
+                self.stats = current
+                self.built_at = time.monotonic()
+            return self
+
+
+_snapshot = _MonitorSnapshot(settings.monitor_snapshot_sec)
+
+
+@router.get("/monitor/stats")
+def monitor_stats(user: User = Depends(get_admin_user_from_session)):
+    return _snapshot.get().stats
+
+
+@router.get("/monitor/stream", include_in_schema=False)
+async def monitor_stream(request: Request, db: Session = Depends(get_db), user: User = Depends(get_admin_user_from_session)):
+    """Server-Sent Events: the monitor snapshot every MONITOR_PUSH_SEC."""
+    # Same session as the admin check; release it, the stream stays open
+    db.close()
+
+    async def events():
+        sent_at = None
+        while not await request.is_disconnected():
+            snap = _snapshot if _snapshot.fresh() else await run_in_threadpool(_snapshot.get)
+            if snap.built_at != sent_at:
+                sent_at = snap.built_at
+                yield f"data: {snap.payload}\n\n"
+            else:
+                yield ": ping\n\n"
+            await asyncio.sleep(settings.monitor_push_sec)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @router.get("/monitor/requests")
 def monitor_requests(user: User = Depends(get_admin_user_from_session)):
-    return list(request_logs)
\ No newline at end of file
+    return list(request_logs)
+
+@router.get("/monitor/traces")
+def monitor_traces(limit: int = 50, user: User = Depends(get_admin_user_from_session)):
+    return list(traces)[:max(0, limit)]
+
+
+@router.get("/monitor/storage")
+def monitor_storage(limit: int = 50, db: Session = Depends(get_read_db), user: User = Depends(get_admin_user_from_session)):
+    # Heaviest users first, straight off the usage index
+    return {"totals": totals(db), "users": heaviest_users(db, max(1, min(limit, 1000)))}
+
+
+@router.get("/monitor/traces/{request_id}")
+def monitor_trace(request_id: str, user: User = Depends(get_admin_user_from_session)):
+    for t in traces:
+        if t["request_id"] == request_id:
+            return t
+    raise HTTPException(status_code=404, detail="Trace not found (not sampled or already evicted)")
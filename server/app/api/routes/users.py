@@ -1,16 +1,27 @@
-from fastapi import APIRouter, Depends, HTTPException
+import threading
+import time
+from collections import OrderedDict
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, literal_column
 from sqlalchemy.orm import Session
 
-from ...auth import get_current_user
-from ...db import get_db
+from ...auth import Principal, get_current_user_read, get_principal
+from ...read_routing import get_read_db
+from ...friend_graph import friend_graph
+from ...map_cache import RenderBusy, map_images, map_stats, visited_ids
+from ...map_render import MapStyle
 from ...models import User
-from ...schemas import UserOut, UserPublic
+from ...schemas import UserOut, UserPublic, UserSearchResult
+from ...settings import settings
 
 router = APIRouter()
 
 
 @router.get("/me", response_model=UserOut)
-def me(user: User = Depends(get_current_user)):
+def me(user: User = Depends(get_current_user_read)):
     return UserOut(
         id=user.id,
         first_name=user.first_name,
@@ -23,12 +34,7 @@ def me(user: User = Depends(get_current_user)):
     )
 
 
-@router.get("/{username}", response_model=UserPublic)
-def get_user(username: str, db: Session = Depends(get_db), current: User = Depends(get_current_user)):
-    u = db.query(User).filter(User.username == username, User.is_deleted == False).first()  # noqa: E712
-    if not u:
-        raise HTTPException(status_code=404, detail="User not found")
-
+def _public(u: User) -> UserPublic:
     return UserPublic(
         id=u.id,
         first_name=u.first_name,
@@ -37,3 +43,148 @@ def get_user(username: str, db: Session = Depends(get_db), current: User = Depen
         profile_pic_path=u.profile_pic_path,
         travel_visible_to_friends=u.travel_visible_to_friends,
     )
+
+
+class _SearchCache:
+    """Tiny per-worker LRU for first pages of hot queries (short TTL)."""
+
+    def __init__(self, max_entries: int, ttl_sec: float):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, key: tuple) -> Optional[UserSearchResult]:
+        with self._lock:
+            hit = self._entries.get(key)
+            if hit is None or time.monotonic() - hit[0] > self.ttl_sec:
+                return None
+            self._entries.move_to_end(key)
+            return hit[1]
+
+    def put(self, key: tuple, value: UserSearchResult) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_search_cache = _SearchCache(settings.search_cache_size, settings.search_cache_ttl_sec)
+
+# Must match the expression of ix_users_search_trgm exactly, or the index is not used
+_SPACE = literal_column("' '")
+_SEARCH_EXPR = func.lower(User.username + _SPACE + User.first_name + _SPACE + User.last_name)
+
+
+def _like_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@router.get("/search", response_model=UserSearchResult)
+def search_users(
+    q: str = Query(min_length=1, max_length=64),
+    after: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=50),
+    db: Session = Depends(get_read_db),
+    current: Principal = Depends(get_principal),
+):
+    """
+    Search live users by username / first / last name.
+
+    - 1-2 chars: username prefix (ix_users_username_prefix)
+    - 3+ chars: substring via trigrams (ix_users_search_trgm)
+    Keyset pagination on username: pass `next_after` back as `after`.
+    """
+    term = q.strip().lower()
+    if not term:
+        return UserSearchResult(items=[])
+
+    key = (term, limit)
+    if after is None:
+        cached = _search_cache.get(key)
+        if cached is not None:
+            return cached
+
+    pattern = _like_escape(term)
+    query = db.query(User).filter(User.is_deleted == False)  # noqa: E712
+    if len(term) < 3:
+        query = query.filter(func.lower(User.username).like(pattern + "%", escape="\\"))
+    else:
+        query = query.filter(_SEARCH_EXPR.like("%" + pattern + "%", escape="\\"))
+    if after is not None:
+        query = query.filter(User.username > after)
+
+    rows = query.order_by(User.username).limit(limit + 1).all()
+    result = UserSearchResult(
+        items=[_public(u) for u in rows[:limit]],
+        next_after=rows[limit - 1].username if len(rows) > limit else None,
+    )
+    if after is None:
+        _search_cache.put(key, result)
+    return result
+
+
+@router.get("/{username}", response_model=UserPublic)
+def get_user(username: str, db: Session = Depends(get_read_db), current: Principal = Depends(get_principal)):
+    u = db.query(User).filter(User.username == username, User.is_deleted == False).first()  # noqa: E712
+    if not u:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    return _public(u)
+
+
+def _etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return header.strip() == "*" or etag in (t.strip() for t in header.split(","))
+
+
+@router.get("/{username}/map.png", responses={200: {"content": {"image/png": {}}}, 304: {}})
+async def get_user_map(
+    username: str,
+    request: Request,
+    width: int = Query(1200, ge=64, le=settings.map_max_px),
+    height: int = Query(600, ge=64, le=settings.map_max_px),
+    color: str = Query("FF9800", pattern=r"^#?[0-9a-fA-F]{6}$"),
+    multicolor: bool = False,
+    theme: Literal["light", "dark"] = "light",
+    db: Session = Depends(get_read_db),
+    current: Principal = Depends(get_principal),
+):
+    """
+    World map PNG with the user's visited countries highlighted (own map, or a
+    friend's while they share travel). Cached by visited set + style; send the
+    ETag back as If-None-Match to get 304 when nothing changed.
+    """
+    style = MapStyle(width, height, tuple(bytes.fromhex(color.lstrip("#"))), multicolor, theme)
+
+    def _load():
+        # Only the selectedCountries key of app_data, not the whole blob
+        row = (
+            db.query(User.id, User.travel_visible_to_friends, User.app_data["selectedCountries"].label("selected"))
+            .filter(User.username == username, User.is_deleted == False)  # noqa: E712
+            .first()
+        )
+        if row is None:
+            return None
+        if row.id != current.id and not (row.travel_visible_to_friends and friend_graph.are_friends(db, current.id, row.id)):
+            return None
+        selected = visited_ids(row.selected)
+        return selected, map_images.key(selected, style)
+
+    loaded = await run_in_threadpool(_load)
+    if loaded is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    selected, key = loaded
+
+    headers = {"ETag": map_images.etag(key), "Cache-Control": "private, no-cache"}
+    if _etag_matches(request, headers["ETag"]):
+        map_stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    try:
+        png = await map_images.get(key, selected, style)
+    except RenderBusy:
+        raise HTTPException(status_code=503, detail="Map renderer busy", headers={"Retry-After": "5"})
+    return Response(content=png, media_type="image/png", headers=headers)
@@ -1,15 +1,23 @@
 """
 Authentication helpers:
 - password hashing + verification (bcrypt)
-- JWT creation (includes jti)
-- get_current_user dependency (checks revoked tokens)
+- access tokens: short-lived JWTs (ACCESS_TOKEN_EXPIRES_MIN) carrying the
+  user id, username and refresh token family; refresh_tokens.py renews them
+- get_principal: verifies the signature and expiry only, no database; for
+  routes that just need who is calling (id / username)
+- get_principal_write: same, and tags the write session with the user
+  (read_routing stickiness) without a query
+- get_current_user / get_current_user_read: the live User row, for routes
+  that read or change the user's own columns
 """
 
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 import uuid
 
+from functools import lru_cache
+
 from jose import jwt, JWTError
-from passlib.context import CryptContext
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
@@ -17,27 +25,46 @@ from sqlalchemy.orm import Session
 
 from .settings import settings
 from .db import get_db
-from .models import User, RevokedToken
+from .read_routing import get_read_db
+from .tracing import span
+from .models import User
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 JWT_ALG = "HS256"
 
 
+@lru_cache(maxsize=1)
+def _pwd_context():
+    # passlib/bcrypt load on first use (login/register), not at worker boot
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
 def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+    return _pwd_context().hash(password)
 
 
 def verify_password(password: str, hashed: str) -> bool:
-    return pwd_context.verify(password, hashed)
+    return _pwd_context().verify(password, hashed)
+
 
+@dataclass(frozen=True)
+class Principal:
+    """The caller, as stated by a verified access token."""
+    id: str
+    username: str
+    family_id: str
 
-def create_access_token(user_id: str) -> str:
+
+def create_access_token(user: User, family_id: str) -> str:
     now = datetime.now(timezone.utc)
-    exp = now + timedelta(minutes=settings.jwt_expires_min)
+    exp = now + timedelta(minutes=settings.access_token_expires_min)
 
     payload = {
-        "sub": user_id,
+        "sub": user.id,
+        "usr": user.username,
+        "fam": family_id,
+        "typ": "access",
         "iat": int(now.timestamp()),
         "exp": int(exp.timestamp()),
         "jti": str(uuid.uuid4()),
@@ -49,26 +76,52 @@ def decode_token(token: str) -> dict:
     return jwt.decode(token, settings.jwt_secret, algorithms=[JWT_ALG])
 
 
-def get_current_user(
-    db: Session = Depends(get_db),
-    token: str = Depends(oauth2_scheme),
-) -> User:
+def _principal(token: str) -> Principal:
     try:
-        payload = decode_token(token)
-        user_id = payload.get("sub")
-        jti = payload.get("jti")
-        if not user_id or not jti:
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+        with span("auth.decode_jwt"):
+            payload = decode_token(token)
     except JWTError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    # Tokens from before refresh tokens have no typ/fam: those users log in again
+    if payload.get("typ") != "access" or not payload.get("sub") or not payload.get("fam"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token")
+    return Principal(id=payload["sub"], username=payload.get("usr") or "", family_id=payload["fam"])
 
-    # Check revocation (logout)
-    revoked = db.query(RevokedToken).filter(RevokedToken.jti == jti).first()
-    if revoked:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token revoked")
 
-    user = db.query(User).filter(User.id == user_id, User.is_deleted == False).first()  # noqa: E712
+def get_principal(token: str = Depends(oauth2_scheme)) -> Principal:
+    return _principal(token)
+
+
+def get_principal_write(
+    db: Session = Depends(get_db),
+    principal: Principal = Depends(get_principal),
+) -> Principal:
+    # Lets the session attribute its writes to this user (read_routing stickiness)
+    db.info["user_id"] = principal.id
+    return principal
+
+
+def _user_from_token(db: Session, token: str) -> User:
+    principal = _principal(token)
+    with span("auth.load_user"):
+        user = db.query(User).filter(User.id == principal.id, User.is_deleted == False).first()  # noqa: E712
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
 
+    db.info["user_id"] = user.id
     return user
+
+
+def get_current_user(
+    db: Session = Depends(get_db),
+    token: str = Depends(oauth2_scheme),
+) -> User:
+    return _user_from_token(db, token)
+
+
+def get_current_user_read(
+    db: Session = Depends(get_read_db),
+    token: str = Depends(oauth2_scheme),
+) -> User:
+    """For read-only routes: the user is loaded on the same read session the route uses."""
+    return _user_from_token(db, token)
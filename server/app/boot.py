@@ -0,0 +1,168 @@
+"""
+Boot helpers: timing report, one-time boot tasks, pool pre-warming, lazy admin UI.
+
+Key ideas:
+- every boot stage is timed into boot_report (shown on /monitor/stats and logged)
+- one-time tasks (migrations, admin seeding) run once per process tree:
+  with `gunicorn --preload` the master runs them before forking and the
+  workers inherit the "done" flag; without preload each worker runs them
+  (they are safe to race: advisory lock + IntegrityError handling)
+- the pool is pre-warmed in each worker after fork, never in the master,
+  so no connection is ever shared between processes
+- the sqladmin UI (sqladmin + jinja2 + wtforms) is imported on the first
+  /admin request instead of at worker boot
+"""
+
+import time
+
+# Taken before the heavier imports below: the earliest point we can observe
+_process_start = time.perf_counter()
+
+import logging
+import os
+from contextlib import contextmanager
+from typing import Dict, List
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .auth import hash_password
+from .db import SessionLocal, engine
+from .migrations import migrate_or_check
+from .models import User
+from .settings import settings
+from .storage import ensure_storage
+
+log = logging.getLogger(__name__)
+
+boot_report: Dict[str, object] = {"pid": os.getpid(), "stages_ms": {}}
+_boot_tasks_done = False
+
+
+@contextmanager
+def timed(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        boot_report["stages_ms"][stage] = round((time.perf_counter() - start) * 1000.0, 1)
+
+
+def mark_imports_done() -> None:
+    boot_report["stages_ms"]["imports"] = round((time.perf_counter() - _process_start) * 1000.0, 1)
+
+
+def mark_ready() -> None:
+    boot_report["pid"] = os.getpid()
+    boot_report["total_ms"] = round((time.perf_counter() - _process_start) * 1000.0, 1)
+    log.info("Boot finished in %sms: %s", boot_report["total_ms"], boot_report["stages_ms"])
+
+
+def seed_admin_if_configured() -> None:
+    if not settings.admin_email or not settings.admin_password:
+        return
+
+    db: Session = SessionLocal()
+    try:
+        # 1) Fast path: already exists -> ensure admin -> return
+        existing = (
+            db.query(User)
+            .filter(User.email == settings.admin_email, User.is_deleted == False)  # noqa: E712
+            .first()
+        )
+        if existing:
+            # Optional hardening: ensure the existing user is actually admin
+            if not existing.is_admin:
+                existing.is_admin = True
+                db.commit()
+            return
+
+        # 2) Create admin (fill ALL NOT NULL fields if your model doesn't default them)
+        admin = User(
+            email=settings.admin_email,
+            username="admin",
+            first_name="Admin",
+            last_name="User",
+            password_hash=hash_password(settings.admin_password),
+            is_admin=True,
+
+            # IMPORTANT: set these if your model doesn't provide defaults
+            app_data={},
+            travel_visible_to_friends=False,
+            is_deleted=False,
+        )
+
+        db.add(admin)
+
+        # 3) Commit safely under concurrency (Gunicorn workers)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Another worker probably inserted it first. Rollback and continue.
+            db.rollback()
+            return
+
+    finally:
+        db.close()
+
+
+def run_boot_tasks_once() -> None:
+    """Migrations + admin seeding. Safe to call from the gunicorn master."""
+    global _boot_tasks_done
+    if _boot_tasks_done:
+        return
+
+    with timed("storage"):
+        ensure_storage()
+    with timed("migrations"):
+        migrate_or_check(engine, apply=settings.migrate_on_startup)
+    with timed("seed_admin"):
+        seed_admin_if_configured()
+
+    # Don't hand pooled connections to forked workers
+    engine.dispose()
+    _boot_tasks_done = True
+
+
+def prewarm_pool(n: int) -> None:
+    """Open n pooled connections now, so the first requests don't pay for connects."""
+    if n <= 0:
+        return
+    conns: List = []
+    try:
+        for _ in range(n):
+            conns.append(engine.connect())
+    except Exception:
+        log.exception("Pool pre-warm stopped after %d connections", len(conns))
+    finally:
+        for c in conns:
+            c.close()
+
+
+class LazyAdminApp:
+    """
+    ASGI app mounted at /admin that builds the sqladmin app on first use.
+
+    sqladmin resolves its links with url_for("admin:..."), which goes through
+    the Mount's `routes`; we expose the real admin routes once it is built.
+    """
+
+    def __init__(self, engine):
+        self._engine = engine
+        self._app = None
+
+    def _build(self):
+        if self._app is None:
+            from starlette.applications import Starlette
+            from .admin import setup_admin
+
+            with timed("admin_ui_lazy_import"):
+                self._app = setup_admin(Starlette(), self._engine).admin
+        return self._app
+
+    @property
+    def routes(self):
+        return self._build().routes
+
+    async def __call__(self, scope, receive, send):
+        await self._build()(scope, receive, send)
@@ -0,0 +1,303 @@
+"""
+Account export / import (GET /data/export, POST /data/import).
+
+Export key ideas:
+- the archive is a zip with one NDJSON file per table plus the user's files
+- rows are read through server-side cursors (yield_per) and deflated as they
+  are written; compressed bytes are yielded in chunks, so memory stays flat
+  no matter how large the account is
+- zipfile writes to a non-seekable sink, which makes it use data descriptors
+  (no need to know sizes up front)
+
+Import key ideas:
+- rows are streamed with COPY into temp tables, then merged with one
+  INSERT ... SELECT ... ON CONFLICT DO NOTHING per table
+- ownership columns are forced to the importing user; activity and reaction
+  ids are derived from (user, id in the file), so an archive cannot collide
+  with other users' rows and re-importing it is harmless
+- archive timestamps are not trusted: created_at is capped at now and
+  expires_at at created_at + the normal activity TTL, so imported rows
+  neither outlive lifecycle expiry nor sit ahead of feed cursors
+- reactions are kept only on the user's own activities and on activities of
+  friends that the feed would show them
+- travel sharing is only changed if the archive states it explicitly
+- the archive's files are checked against the quota together before any is
+  written; if storing one fails, the new blobs written so far are removed
+"""
+
+import io
+import json
+import uuid
+import zipfile
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, Iterator, List, Tuple
+
+from sqlalchemy import select, text
+from sqlalchemy.orm import Session
+
+from .data_history import lock_user, record
+from .activity_queue import ACTIVITY_TTL
+from .friend_graph import friends_changed
+from .friend_suggestions import refresh as refresh_suggestions
+from .models import User, Friend, Activity, ActivityReaction, StoredFile
+from .read_routing import read_router
+from .storage import iter_sync, object_key, run_sync, storage
+from .storage_quota import check_quota_many, record_put
+from .travel_stats import update_for as update_travel_stats
+from .upsert import upsert
+from .visibility import VISIBILITY_FRIENDS, visibility_for
+
+CHUNK_SIZE = 64 * 1024
+EXPORT_FORMAT = "beenaround-server-export"
+EXPORT_VERSION = 1
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only, non-seekable buffer that the generator drains between writes."""
+
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+        self.pending = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        data = bytes(b)
+        self._chunks.append(data)
+        self._pos += len(data)
+        self.pending += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        out = b"".join(self._chunks)
+        self._chunks.clear()
+        self.pending = 0
+        return out
+
+
+def _rows(db: Session, stmt) -> Iterator[Dict[str, Any]]:
+    for row in db.execute(stmt.execution_options(yield_per=500)):
+        yield row._asdict()
+
+
+def _tables(db: Session, user_id: str) -> Iterator[Tuple[str, Iterator[Dict[str, Any]]]]:
+    yield "user.ndjson", _rows(db, select(
+        User.id, User.first_name, User.last_name, User.username, User.email,
+        User.profile_pic_path, User.app_data, User.travel_visible_to_friends, User.created_at,
+    ).where(User.id == user_id))
+
+    yield "friends.ndjson", _rows(db, select(
+        Friend.friend_id, User.username, Friend.created_at,
+    ).join(User, User.id == Friend.friend_id).where(Friend.user_id == user_id).order_by(Friend.created_at))
+
+    yield "activities.ndjson", _rows(db, select(
+        Activity.id, Activity.type, Activity.payload, Activity.created_at, Activity.expires_at,
+    ).where(Activity.actor_user_id == user_id).order_by(Activity.created_at))
+
+    yield "reactions.ndjson", _rows(db, select(
+        ActivityReaction.id, ActivityReaction.activity_id, ActivityReaction.reaction, ActivityReaction.created_at,
+    ).where(ActivityReaction.user_id == user_id).order_by(ActivityReaction.created_at))
+
+
+def export_stream(user_id: str) -> Iterator[bytes]:
+    sink = _ChunkSink()
+    db = read_router.session_for(user_id)
+    try:
+        with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("manifest.json", json.dumps({
+                "format": EXPORT_FORMAT,
+                "version": EXPORT_VERSION,
+                "exported_at": datetime.now(timezone.utc).isoformat(),
+            }))
+
+            for name, rows in _tables(db, user_id):
+                with zf.open(name, "w", force_zip64=True) as f:
+                    for row in rows:
+                        f.write(json.dumps(row, default=str).encode("utf-8") + b"\n")
+                        if sink.pending >= CHUNK_SIZE:
+                            yield sink.drain()
+                yield sink.drain()
+            db.close()  # done with the DB; don't hold a connection while sending files
+
+            prefix = f"{user_id}/"
+            for obj in run_sync(storage.list(prefix)):
+                arcname = "files/" + obj.key[len(prefix):]
+                with zf.open(arcname, "w", force_zip64=True) as dst:
+                    for buf in iter_sync(storage.get(obj.key, CHUNK_SIZE)):
+                        dst.write(buf)
+                        if sink.pending >= CHUNK_SIZE:
+                            yield sink.drain()
+                yield sink.drain()
+        yield sink.drain()
+    finally:
+        db.close()
+
+
+def _ndjson(zf: zipfile.ZipFile, name: str) -> Iterator[Dict[str, Any]]:
+    if name not in zf.namelist():
+        return
+    with zf.open(name) as f:
+        for line in io.TextIOWrapper(f, encoding="utf-8"):
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+async def _read_chunks(src) -> AsyncIterator[bytes]:
+    # Archive members are read from the request's spooled upload file
+    while True:
+        buf = src.read(CHUNK_SIZE)
+        if not buf:
+            break
+        yield buf
+
+
+def _copy_rows(db: Session, table: str, columns: Tuple[str, ...], rows: Iterator[tuple]) -> None:
+    raw = db.connection().connection.driver_connection
+    with raw.cursor() as cur:
+        with cur.copy(f"COPY {table} ({', '.join(columns)}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+
+
+def _imported_id(user_id: str, archive_id: str) -> str:
+    # Stable per (user, archive id): re-imports conflict with themselves only
+    return str(uuid.uuid5(uuid.NAMESPACE_URL, f"import:{user_id}:{archive_id}"))
+
+
+def import_archive(db: Session, user: User, fileobj) -> Tuple[Dict[str, int], List[str]]:
+    """
+    Merge an export archive into the current account.
+    Returns (counts, linked friend ids). Caller commits.
+    """
+    counts = {"friends": 0, "activities": 0, "reactions": 0, "files": 0}
+    other_ids: List[str] = []
+    now = datetime.now(timezone.utc)
+
+    with zipfile.ZipFile(fileobj) as zf:
+        manifest = json.loads(zf.read("manifest.json")) if "manifest.json" in zf.namelist() else {}
+        if manifest.get("format") != EXPORT_FORMAT:
+            raise ValueError("Not a server export archive")
+
+        # Files to store (name -> member; a later duplicate wins), checked
+        # against the quota as a whole before anything is written
+        members: Dict[str, zipfile.ZipInfo] = {}
+        for info in zf.infolist():
+            if not info.filename.startswith("files/") or info.is_dir():
+                continue
+            # Never trust archive paths: keep only the file name
+            try:
+                members[object_key(user.id, info.filename).split("/", 1)[1]] = info
+            except ValueError:
+                continue
+        check_quota_many(db, user.id, {name: info.file_size for name, info in members.items()})
+
+        lock_user(db, user)
+        for row in _ndjson(zf, "user.ndjson"):
+            new = row.get("app_data") or {}
+            record(db, user.id, user.app_data or {}, new)
+            update_travel_stats(db, user.id, user.app_data or {}, new, visibility_changed=True)
+            user.app_data = new
+            visible = row.get("travel_visible_to_friends")
+            if isinstance(visible, bool):
+                user.travel_visible_to_friends = visible
+        db.add(user)
+        db.flush()
+
+        # Friends: resolve usernames in one query, link with one upsert
+        usernames = {r["username"] for r in _ndjson(zf, "friends.ndjson") if r.get("username")}
+        usernames.discard(user.username)
+        if usernames:
+            other_ids = [r.id for r in db.query(User.id).filter(
+                User.username.in_(usernames), User.is_deleted == False,  # noqa: E712
+            )]
+            if other_ids:
+                rows = []
+                for other_id in other_ids:
+                    rows.append({"user_id": user.id, "friend_id": other_id})
+                    rows.append({"user_id": other_id, "friend_id": user.id})
+                db.execute(upsert(Friend, rows, constraint="uq_friend_pair"))
+                friends_changed(db, [user.id, *other_ids])
+                refresh_suggestions(db, [user.id, *other_ids])
+                counts["friends"] = len(other_ids)
+
+        db.execute(text(
+            "CREATE TEMP TABLE import_activities "
+            "(old_id VARCHAR, id VARCHAR, type VARCHAR, visibility VARCHAR, payload JSONB, "
+            "created_at TIMESTAMPTZ, expires_at TIMESTAMPTZ) "
+            "ON COMMIT DROP"
+        ))
+        _copy_rows(db, "import_activities", ("old_id", "id", "type", "visibility", "payload", "created_at", "expires_at"), (
+            (r["id"], _imported_id(user.id, r["id"]), r["type"], visibility_for(r["type"]),
+             json.dumps(r.get("payload") or {}), r["created_at"], r["expires_at"])
+            for r in _ndjson(zf, "activities.ndjson")
+        ))
+        db.execute(text(
+            "UPDATE import_activities SET created_at = LEAST(created_at, :now), "
+            "expires_at = LEAST(expires_at, LEAST(created_at, :now) + :ttl)"
+        ), {"now": now, "ttl": ACTIVITY_TTL})
+        # Re-importing into the same account: the user's own rows keep their ids
+        db.execute(text(
+            "UPDATE import_activities ia SET id = ia.old_id FROM activities a "
+            "WHERE a.id = ia.old_id AND a.actor_user_id = :uid"
+        ), {"uid": user.id})
+        counts["activities"] = db.execute(text(
+            "INSERT INTO activities (id, actor_user_id, type, visibility, payload, created_at, expires_at) "
+            "SELECT id, :uid, type, visibility, payload, created_at, expires_at FROM import_activities "
+            "WHERE expires_at > :now "
+            "ON CONFLICT (id) DO NOTHING"
+        ), {"uid": user.id, "now": now}).rowcount
+
+        db.execute(text(
+            "CREATE TEMP TABLE import_reactions "
+            "(id VARCHAR, activity_id VARCHAR, reaction VARCHAR, created_at TIMESTAMPTZ) "
+            "ON COMMIT DROP"
+        ))
+        _copy_rows(db, "import_reactions", ("id", "activity_id", "reaction", "created_at"), (
+            (_imported_id(user.id, r["id"]), r["activity_id"], r["reaction"], r["created_at"])
+            for r in _ndjson(zf, "reactions.ndjson")
+        ))
+        # Reactions on the user's own activities (as just imported, or already
+        # there) and on live activities of friends the feed would show them
+        counts["reactions"] = db.execute(text(
+            "INSERT INTO activity_reactions (id, activity_id, user_id, reaction, created_at) "
+            "SELECT r.id, a.id, :uid, r.reaction, LEAST(r.created_at, :now) "
+            "FROM import_reactions r "
+            "LEFT JOIN import_activities ia ON ia.old_id = r.activity_id "
+            "JOIN activities a ON a.id = COALESCE(ia.id, r.activity_id) "
+            "JOIN users u ON u.id = a.actor_user_id "
+            "WHERE a.actor_user_id = :uid OR ("
+            "  ia.id IS NULL AND a.expires_at > :now "
+            "  AND EXISTS (SELECT 1 FROM friends f WHERE f.user_id = :uid AND f.friend_id = a.actor_user_id) "
+            "  AND u.is_deleted = false "
+            "  AND (a.visibility = :friends_only OR u.travel_visible_to_friends = true)"
+            ") "
+            "ON CONFLICT DO NOTHING"
+        ), {"uid": user.id, "now": now, "friends_only": VISIBILITY_FRIENDS}).rowcount
+
+        existing = set(db.scalars(
+            select(StoredFile.name).where(StoredFile.user_id == user.id, StoredFile.name.in_(list(members)))
+        )) if members else set()
+        written: List[str] = []
+        try:
+            for name, info in members.items():
+                key = object_key(user.id, name)
+                with zf.open(info) as src:
+                    obj = run_sync(storage.put(key, _read_chunks(src)))
+                if name not in existing:
+                    written.append(key)
+                record_put(db, user.id, name, obj.size)
+                counts["files"] += 1
+        except BaseException:
+            # The caller rolls the accounting back: remove the blobs it would
+            # no longer know about (replaced files keep the archive's content)
+            for key in written:
+                run_sync(storage.delete(key))
+            raise
+
+    return counts, other_ids
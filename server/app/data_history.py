@@ -0,0 +1,176 @@
+"""
+Append-only app_data history (GET /data/history, POST /data/restore).
+
+Key ideas:
+- every change of users.app_data appends a revision in the same transaction
+- most revisions are deltas against the previous revision (a list of
+  set/delete operations on key paths); every HISTORY_SNAPSHOT_EVERY-th
+  revision is a full snapshot, so rebuilding any revision reads one snapshot
+  plus a bounded number of deltas
+- payloads are zlib-compressed JSON in a separate table whose column is
+  STORAGE EXTERNAL (no second compression pass by TOAST); the users row
+  does not grow
+- retention: when a snapshot is written, whole chains older than the
+  newest snapshot that is past HISTORY_MAX_REVISIONS / HISTORY_RETENTION_DAYS
+  are deleted, so a chain never loses its base snapshot
+"""
+
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, or_, select
+from sqlalchemy.orm import Session
+
+from .models import AppDataRevision
+from .settings import settings
+
+SNAPSHOT = "snapshot"
+DELTA = "delta"
+
+_MISSING = object()
+
+
+# -------- deltas --------
+
+def diff(old: Any, new: Any, path: Tuple[str, ...] = ()) -> List[list]:
+    """Operations turning `old` into `new`: ["set", path, value] / ["del", path]."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops: List[list] = []
+        for k in old.keys() - new.keys():
+            ops.append(["del", [*path, k]])
+        for k, v in new.items():
+            before = old.get(k, _MISSING)
+            if before is _MISSING:
+                ops.append(["set", [*path, k], v])
+            elif before != v:
+                ops.extend(diff(before, v, (*path, k)))
+        return ops
+    if old == new:
+        return []
+    return [["set", list(path), new]]
+
+
+def apply(data: Any, ops: List[list]) -> Any:
+    for op in ops:
+        kind, path = op[0], op[1]
+        if not path:
+            data = op[2] if kind == "set" else {}
+            continue
+        node = data
+        for k in path[:-1]:
+            node = node.setdefault(k, {})
+        if kind == "set":
+            node[path[-1]] = op[2]
+        else:
+            node.pop(path[-1], None)
+    return data
+
+
+def _pack(obj: Any) -> bytes:
+    return zlib.compress(json.dumps(obj, separators=(",", ":")).encode("utf-8"), 6)
+
+
+def _unpack(blob: bytes) -> Any:
+    return json.loads(zlib.decompress(blob))
+
+
+# -------- write path --------
+
+def latest_rev(db: Session, user_id: str) -> int:
+    return db.scalar(select(func.max(AppDataRevision.rev)).where(AppDataRevision.user_id == user_id)) or 0
+
+
+def lock_user(db: Session, user) -> None:
+    """
+    Re-read the user row FOR UPDATE before changing app_data: concurrent writes
+    then apply one after another, and each delta starts from the state the
+    previous revision produced.
+    """
+    db.refresh(user, with_for_update=True)
+
+
+def record(db: Session, user_id: str, old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> Optional[int]:
+    """
+    Append a revision for old -> new. Call with the user row locked (lock_user),
+    before commit. Returns the new rev, or None if nothing changed.
+    """
+    last = latest_rev(db, user_id)
+    if last == 0 and old:
+        # First change we see: keep what was there before as the base
+        blob = _pack(old)
+        db.add(AppDataRevision(user_id=user_id, rev=1, kind=SNAPSHOT, data=blob, size=len(blob)))
+        last = 1
+    if last and old == new:
+        return None
+
+    rev = last + 1
+    if last == 0 or (rev - 1) % settings.history_snapshot_every == 0:
+        kind, blob = SNAPSHOT, _pack(new)
+    else:
+        kind, blob = DELTA, _pack(diff(old or {}, new))
+
+    db.add(AppDataRevision(user_id=user_id, rev=rev, kind=kind, data=blob, size=len(blob)))
+    if kind == SNAPSHOT:
+        db.flush()
+        prune(db, user_id, rev)
+    return rev
+
+
+def prune(db: Session, user_id: str, newest_rev: int) -> int:
+    """Drop chains that end before the newest snapshot outside the retention window."""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=settings.history_retention_days)
+    base = db.scalar(
+        select(func.max(AppDataRevision.rev)).where(
+            AppDataRevision.user_id == user_id,
+            AppDataRevision.kind == SNAPSHOT,
+            or_(
+                AppDataRevision.rev <= newest_rev - settings.history_max_revisions,
+                AppDataRevision.created_at < cutoff,
+            ),
+        )
+    )
+    if not base:
+        return 0
+    return db.execute(
+        delete(AppDataRevision).where(AppDataRevision.user_id == user_id, AppDataRevision.rev < base)
+    ).rowcount
+
+
+# -------- read path --------
+
+def list_revisions(db: Session, user_id: str, limit: int, before: Optional[int]) -> List[Dict[str, Any]]:
+    q = select(
+        AppDataRevision.rev, AppDataRevision.kind, AppDataRevision.size, AppDataRevision.created_at,
+    ).where(AppDataRevision.user_id == user_id)
+    if before is not None:
+        q = q.where(AppDataRevision.rev < before)
+    rows = db.execute(q.order_by(AppDataRevision.rev.desc()).limit(limit)).all()
+    return [r._asdict() for r in rows]
+
+
+def reconstruct(db: Session, user_id: str, rev: int) -> Optional[Dict[str, Any]]:
+    """app_data as of `rev`: newest snapshot <= rev plus the deltas after it."""
+    base = db.scalar(
+        select(func.max(AppDataRevision.rev)).where(
+            AppDataRevision.user_id == user_id,
+            AppDataRevision.kind == SNAPSHOT,
+            AppDataRevision.rev <= rev,
+        )
+    )
+    if base is None:
+        return None
+    rows = db.execute(
+        select(AppDataRevision.rev, AppDataRevision.kind, AppDataRevision.data)
+        .where(AppDataRevision.user_id == user_id, AppDataRevision.rev >= base, AppDataRevision.rev <= rev)
+        .order_by(AppDataRevision.rev)
+    ).all()
+    if not rows or rows[-1].rev != rev:
+        return None
+
+    data: Any = {}
+    for r in rows:
+        payload = _unpack(r.data)
+        data = payload if r.kind == SNAPSHOT else apply(data, payload)
+    return data
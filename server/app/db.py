@@ -5,23 +5,40 @@ Key ideas:
 - engine: manages a connection pool to DB
 - SessionLocal: factory to create per-request sessions
 - get_db: FastAPI dependency that yields a session and closes it after request
+- read_engine / ReadSessionLocal: optional replica pool (see read_routing.py)
 """
 
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from .settings import settings
+from .tracing import instrument_engine, traced_checkout
 
 # Create SQLAlchemy engine (connection pool)
 engine = create_engine(
     settings.database_url,
     pool_pre_ping=True,  # checks connection health before using it
-    pool_size=5,         # base pool size (tune later)
-    max_overflow=10,     # extra connections if needed
+    pool_size=settings.db_pool_size,        # base pool size (per worker)
+    max_overflow=settings.db_max_overflow,  # extra connections if needed
 )
 
 # Create sessions bound to this engine
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Read replica pool, only when POSTGRES_REPLICA_HOST is set
+read_engine = create_engine(
+    settings.replica_database_url,
+    pool_pre_ping=True,
+    pool_size=settings.db_pool_size,
+    max_overflow=settings.db_max_overflow,
+) if settings.postgres_replica_host else None
+
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine) if read_engine is not None else None
+
+# SQL statements show up as spans in sampled traces
+instrument_engine(engine)
+if read_engine is not None:
+    instrument_engine(read_engine)
+
 
 def get_db():
     """
@@ -32,6 +49,7 @@ def get_db():
     """
     db = SessionLocal()
     try:
+        traced_checkout(db)
         yield db
     finally:
         db.close()
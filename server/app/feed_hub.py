@@ -0,0 +1,238 @@
+"""
+Feed push hub (fan-out for /feed/stream).
+
+Key ideas:
+- every worker keeps an in-process hub of live feed subscribers
+- events are published with Postgres NOTIFY inside the writing transaction,
+  so they are delivered only after commit and reach every worker
+- one LISTEN connection per worker forwards notifications into the hub
+  (other modules can register their own channels on the same connection)
+- each subscriber has a bounded queue; a client that falls behind is marked
+  "lagged" and catches up from its cursor with one DB query instead of
+  buffering without limit
+- when a subscriber's friend set changes (friend_graph's NOTIFY), its stream
+  is told to reload it and resubscribe, so unfriended users' events stop and
+  new friends' events arrive without a reconnect
+"""
+
+import asyncio
+import json
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional, Set
+
+import psycopg
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .models import Activity
+from .settings import settings
+
+log = logging.getLogger(__name__)
+
+FEED_CHANNEL = "feed_events"
+
+
+class Subscriber:
+    """One open stream. Lives on the event loop that created it."""
+
+    def __init__(self, user_id: str, friend_ids: Iterable[str], loop: asyncio.AbstractEventLoop):
+        self.user_id = user_id
+        self.friend_ids: Set[str] = set(friend_ids)
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.feed_queue_size)
+        self.lagged = False
+        self.friends_changed = False
+
+    def offer(self, event: Dict[str, Any]) -> None:
+        # Runs on self.loop. Never blocks: a full queue flips the lagged flag
+        # and the stream resumes from its cursor.
+        if self.lagged:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.lagged = True
+
+    def mark_friends_changed(self) -> None:
+        # Runs on self.loop. The marker only wakes the stream; the flag is what counts.
+        self.friends_changed = True
+        self.offer({"kind": "friends_changed"})
+
+
+class FeedHub:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # actor_user_id -> subscribers who follow that actor
+        self._by_actor: Dict[str, Set[Subscriber]] = {}
+        # user_id -> that user's own subscribers
+        self._by_user: Dict[str, Set[Subscriber]] = {}
+
+    def _add(self, sub: Subscriber) -> None:
+        for fid in sub.friend_ids:
+            self._by_actor.setdefault(fid, set()).add(sub)
+
+    def _remove(self, sub: Subscriber) -> None:
+        for fid in sub.friend_ids:
+            subs = self._by_actor.get(fid)
+            if subs is None:
+                continue
+            subs.discard(sub)
+            if not subs:
+                del self._by_actor[fid]
+
+    def subscribe(self, user_id: str, friend_ids: Iterable[str]) -> Subscriber:
+        sub = Subscriber(user_id, friend_ids, asyncio.get_running_loop())
+        with self._lock:
+            self._add(sub)
+            self._by_user.setdefault(user_id, set()).add(sub)
+        return sub
+
+    def resubscribe(self, sub: Subscriber, friend_ids: Iterable[str]) -> None:
+        """Replace the actors a subscriber follows (after its friend set changed)."""
+        with self._lock:
+            self._remove(sub)
+            sub.friend_ids = set(friend_ids)
+            self._add(sub)
+
+    def unsubscribe(self, sub: Subscriber) -> None:
+        with self._lock:
+            self._remove(sub)
+            own = self._by_user.get(sub.user_id)
+            if own is not None:
+                own.discard(sub)
+                if not own:
+                    del self._by_user[sub.user_id]
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len({s for subs in self._by_actor.values() for s in subs})
+
+    def dispatch(self, event: Dict[str, Any]) -> None:
+        """Thread-safe: hand an event to every interested subscriber."""
+        actor = event.get("actor_user_id")
+        with self._lock:
+            targets = list(self._by_actor.get(actor, ()))
+        for sub in targets:
+            sub.loop.call_soon_threadsafe(sub.offer, event)
+
+    def friends_changed(self, user_ids: Optional[Iterable[str]] = None) -> None:
+        """Thread-safe: these users' (None = everyone's) streams reload their friend set."""
+        with self._lock:
+            if user_ids is None:
+                targets = {s for subs in self._by_user.values() for s in subs}
+            else:
+                targets = {s for uid in user_ids for s in self._by_user.get(uid, ())}
+        for sub in targets:
+            sub.loop.call_soon_threadsafe(sub.mark_friends_changed)
+
+    def mark_all_lagged(self) -> None:
+        """Used after a LISTEN reconnect: notifications may have been missed."""
+        with self._lock:
+            targets = {s for subs in self._by_actor.values() for s in subs}
+        for sub in targets:
+            sub.loop.call_soon_threadsafe(setattr, sub, "lagged", True)
+
+
+hub = FeedHub()
+
+
+def activity_out(a: Activity, reactions: Optional[dict] = None) -> dict:
+    """Wire format of one activity (GET /feed and stream events)."""
+    return {
+        "id": a.id,
+        "actor_user_id": a.actor_user_id,
+        "type": a.type,
+        "visibility": a.visibility,
+        "payload": a.payload,
+        "created_at": a.created_at.isoformat(),
+        "expires_at": a.expires_at.isoformat(),
+        "reactions": reactions or {},
+    }
+
+
+# channel -> (on_message(payload_dict), on_reconnect())
+_channels: Dict[str, tuple] = {}
+
+
+def listen(channel: str, on_message: Callable[[Dict[str, Any]], None], on_reconnect: Optional[Callable[[], None]] = None) -> None:
+    """Register a NOTIFY channel on this worker's listener (call before startup)."""
+    _channels[channel] = (on_message, on_reconnect)
+
+
+if settings.feed_push_enabled:
+    listen(FEED_CHANNEL, hub.dispatch, hub.mark_all_lagged)
+
+
+def notify(db: Session, channel: str, message: Dict[str, Any]) -> None:
+    """Send a NOTIFY on the current transaction (delivered on commit)."""
+    db.execute(
+        text("SELECT pg_notify(:channel, :payload)"),
+        {"channel": channel, "payload": json.dumps(message, default=str)},
+    )
+
+
+def publish(db: Session, event: Dict[str, Any]) -> None:
+    """
+    Queue a feed event on the current transaction.
+    Postgres delivers it to all listeners when (and only if) the transaction commits.
+    """
+    if not settings.feed_push_enabled:
+        return
+    notify(db, FEED_CHANNEL, event)
+
+
+class FeedListener(threading.Thread):
+    """Background thread holding this worker's LISTEN connection."""
+
+    def __init__(self):
+        super().__init__(name="feed-listener", daemon=True)
+        self._stop_event = threading.Event()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def run(self) -> None:
+        first_connect = True
+        while not self._stop_event.is_set():
+            try:
+                with psycopg.connect(settings.database_dsn, autocommit=True) as conn:
+                    for channel in _channels:
+                        conn.execute(f"LISTEN {channel}")
+                    if not first_connect:
+                        for _, on_reconnect in _channels.values():
+                            if on_reconnect is not None:
+                                on_reconnect()
+                    first_connect = False
+                    while not self._stop_event.is_set():
+                        for n in conn.notifies(timeout=1.0):
+                            handler = _channels.get(n.channel)
+                            if handler is None:
+                                continue
+                            try:
+                                handler[0](json.loads(n.payload))
+                            except ValueError:
+                                log.warning("Dropping malformed event on %s", n.channel)
+            except psycopg.Error:
+                log.exception("Feed listener connection failed; retrying")
+                self._stop_event.wait(2.0)
+
+
+_listener: Optional[FeedListener] = None
+
+
+def start_listener() -> None:
+    global _listener
+    if not _channels or _listener is not None:
+        return
+    _listener = FeedListener()
+    _listener.start()
+
+
+def stop_listener() -> None:
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    _listener.join(timeout=5)
+    _listener = None
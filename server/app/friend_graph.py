@@ -0,0 +1,123 @@
+"""
+Per-worker friend adjacency cache.
+
+Key ideas:
+- friend ids per user are kept in memory (bounded LRU + TTL as a safety net)
+- every invalidation stamps the user with a new version; a read only stores
+  its result if the user was not invalidated while it was querying, so a
+  racing add/remove can never be overwritten by stale rows
+- invalidations go out with NOTIFY on the writing transaction, so other
+  workers drop their copy right after commit
+"""
+
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Iterable
+
+from sqlalchemy.orm import Session
+
+from .feed_hub import hub, listen, notify
+from .models import Friend
+from .read_routing import read_router
+from .settings import settings
+
+FRIEND_GRAPH_CHANNEL = "friend_graph"
+
+
+class FriendGraphCache:
+    def __init__(self, max_users: int, ttl_sec: float):
+        self.max_users = max_users
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._clock = itertools.count(1)
+        # user_id -> (friend ids, loaded_at)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # user_id -> stamp of the last invalidation (bounded, see _stale_since)
+        self._invalidated: "OrderedDict[str, int]" = OrderedDict()
+        self._evicted_stamp = 0
+
+    def _stale_since(self, user_id: str, stamp: int) -> bool:
+        # Invalidated after `stamp`? If the record was evicted we cannot tell,
+        # so be conservative and treat the read as stale.
+        last = self._invalidated.get(user_id)
+        if last is not None:
+            return last > stamp
+        return self._evicted_stamp > stamp
+
+    def friend_ids(self, db: Session, user_id: str) -> FrozenSet[str]:
+        now = time.monotonic()
+        with self._lock:
+            hit = self._entries.get(user_id)
+            if hit is not None and now - hit[1] < self.ttl_sec:
+                self._entries.move_to_end(user_id)
+                return hit[0]
+            stamp = next(self._clock)
+
+        ids = frozenset(
+            r.friend_id for r in db.query(Friend.friend_id).filter(Friend.user_id == user_id).all()
+        )
+
+        with self._lock:
+            if not self._stale_since(user_id, stamp):
+                self._entries[user_id] = (ids, now)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_users:
+                    self._entries.popitem(last=False)
+        return ids
+
+    def are_friends(self, db: Session, user_id: str, other_id: str) -> bool:
+        return other_id in self.friend_ids(db, user_id)
+
+    def invalidate(self, user_ids: Iterable[str]) -> None:
+        with self._lock:
+            for uid in user_ids:
+                self._entries.pop(uid, None)
+                self._invalidated[uid] = next(self._clock)
+                self._invalidated.move_to_end(uid)
+            while len(self._invalidated) > self.max_users * 4:
+                _, stamp = self._invalidated.popitem(last=False)
+                self._evicted_stamp = max(self._evicted_stamp, stamp)
+
+    def clear(self) -> None:
+        with self._lock:
+            for uid in list(self._entries):
+                self._invalidated[uid] = next(self._clock)
+            self._entries.clear()
+            self._evicted_stamp = next(self._clock)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"users": len(self._entries), "invalidations": len(self._invalidated)}
+
+
+friend_graph = FriendGraphCache(settings.friend_cache_size, settings.friend_cache_ttl_sec)
+
+def _on_friends_changed(msg: Dict) -> None:
+    user_ids = msg.get("user_ids") or []
+    friend_graph.invalidate(user_ids)
+    # Their next reads must see the new rows, not a lagging replica
+    read_router.mark_sticky(user_ids)
+    # Their open feed streams follow the new friend set
+    hub.friends_changed(user_ids)
+
+
+def _on_reconnect() -> None:
+    # Notifications may have been missed: forget everything
+    friend_graph.clear()
+    hub.friends_changed()
+
+
+listen(FRIEND_GRAPH_CHANNEL, _on_friends_changed, _on_reconnect)
+
+
+def friends_changed(db: Session, user_ids: Iterable[str]) -> None:
+    """
+    Call inside the transaction that adds/removes friend rows, then call
+    friend_graph.invalidate(...) after commit for this worker's read-your-writes.
+    """
+    user_ids = list(user_ids)
+    # NOTIFY payloads are capped at 8000 bytes; uuids are ~40 bytes each in JSON.
+    for i in range(0, len(user_ids), 100):
+        notify(db, FRIEND_GRAPH_CHANNEL, {"user_ids": user_ids[i:i + 100]})
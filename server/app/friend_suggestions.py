@@ -0,0 +1,209 @@
+"""
+Friend-of-friend suggestions (GET /friends/suggestions).
+
+Key ideas:
+- suggestions are precomputed into friend_suggestions (user, candidate,
+  mutual friend count); a request reads one user's top rows by index and
+  never walks the graph
+- counts come from one set-based statement per batch of users: friends
+  joined with friends (two hops), minus existing friends, grouped by
+  candidate; only the top SUGGESTIONS_PER_USER per user are kept
+- a background job rebuilds all lists in batches of users (one transaction
+  per batch); one worker per cluster does it (pg_try_advisory_lock)
+- adding/removing friends refreshes the affected rows in the same
+  transaction: the endpoints' own lists, and the (friend, endpoint) rows
+  of their friends, which are the only other counts an edge can change.
+  Those mirrored rows can push a list past the limit until the next rebuild
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal, engine
+from .settings import settings
+
+log = logging.getLogger(__name__)
+
+SUGGESTIONS_LOCK_KEY = 123456791
+
+_FOF = text(
+    "CREATE TEMP TABLE friend_fof ON COMMIT DROP AS "
+    "SELECT f1.user_id, f2.friend_id AS candidate_id, count(*)::int AS mutual "
+    "FROM friends f1 JOIN friends f2 ON f2.user_id = f1.friend_id "
+    "WHERE f1.user_id = ANY(:ids) AND f2.friend_id <> f1.user_id "
+    "AND NOT EXISTS (SELECT 1 FROM friends f3 WHERE f3.user_id = f1.user_id AND f3.friend_id = f2.friend_id) "
+    "GROUP BY f1.user_id, f2.friend_id"
+)
+
+_REPLACE_OWN = (
+    text("DELETE FROM friend_suggestions WHERE user_id = ANY(:ids)"),
+    text(
+        "INSERT INTO friend_suggestions (user_id, candidate_id, mutual, updated_at) "
+        "SELECT user_id, candidate_id, mutual, :now FROM ("
+        "  SELECT *, row_number() OVER (PARTITION BY user_id ORDER BY mutual DESC, candidate_id) AS pos "
+        "  FROM friend_fof"
+        ") ranked WHERE pos <= :keep ORDER BY user_id, candidate_id"
+    ),
+)
+
+# Friends of the changed users: their count towards a changed user may have moved
+_NEIGHBOURS = "SELECT friend_id FROM friends WHERE user_id = ANY(:ids)"
+
+_MIRROR = (
+    text(
+        "DELETE FROM friend_suggestions s "
+        "WHERE s.candidate_id = ANY(:ids) AND s.user_id <> ALL(:ids) "
+        f"AND s.user_id IN ({_NEIGHBOURS}) "
+        "AND NOT EXISTS (SELECT 1 FROM friend_fof f WHERE f.user_id = s.candidate_id AND f.candidate_id = s.user_id)"
+    ),
+    text(
+        "INSERT INTO friend_suggestions (user_id, candidate_id, mutual, updated_at) "
+        "SELECT candidate_id, user_id, mutual, :now FROM friend_fof "
+        f"WHERE candidate_id <> ALL(:ids) AND candidate_id IN ({_NEIGHBOURS}) "
+        "ORDER BY candidate_id, user_id "
+        "ON CONFLICT (user_id, candidate_id) DO UPDATE SET mutual = EXCLUDED.mutual, updated_at = EXCLUDED.updated_at"
+    ),
+)
+
+
+def _rebuild(db: Session, user_ids: List[str], mirror: bool) -> int:
+    params = {"ids": user_ids, "keep": settings.suggestions_per_user, "now": datetime.now(timezone.utc)}
+    db.execute(text("DROP TABLE IF EXISTS pg_temp.friend_fof"))
+    db.execute(_FOF, params)
+    db.execute(_REPLACE_OWN[0], params)
+    n = db.execute(_REPLACE_OWN[1], params).rowcount
+    if mirror:
+        for stmt in _MIRROR:
+            db.execute(stmt, params)
+    db.execute(text("DROP TABLE pg_temp.friend_fof"))
+    return n
+
+
+def refresh(db: Session, user_ids: Iterable[str]) -> None:
+    """
+    Call inside the transaction that adds/removes friend rows, after the
+    change, with every user whose friend list changed.
+    """
+    ids = sorted(set(user_ids))
+    if ids and settings.suggestions_enabled:
+        _rebuild(db, ids, mirror=True)
+
+
+def suggestions_for(db: Session, user_id: str, exclude: Iterable[str], limit: int) -> List[Dict[str, Any]]:
+    # Rows may lag a friendship made outside refresh(); never suggest current friends
+    exclude = set(exclude)
+    rows = db.execute(text(
+        "SELECT u.id, u.username, u.first_name, u.last_name, u.profile_pic_path, s.mutual "
+        "FROM friend_suggestions s JOIN users u ON u.id = s.candidate_id "
+        "WHERE s.user_id = :uid AND u.is_deleted = false "
+        "ORDER BY s.mutual DESC, s.candidate_id LIMIT :limit"
+    ), {"uid": user_id, "limit": limit + len(exclude)}).all()
+    return [{
+        "id": r.id,
+        "username": r.username,
+        "first_name": r.first_name,
+        "last_name": r.last_name,
+        "profile_pic_path": r.profile_pic_path,
+        "mutual_friends": r.mutual,
+    } for r in rows if r.id not in exclude][:limit]
+
+
+class SuggestionsWorker:
+    def __init__(self, interval_sec: float, batch_users: int):
+        self.interval_sec = interval_sec
+        self.batch_users = batch_users
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats: Dict[str, Any] = {
+            "state": "idle",
+            "runs": 0,
+            "skipped_locked": 0,
+            "errors": 0,
+            "last_run_at": None,
+            "last_run_ms": None,
+            "users_processed": 0,
+            "rows_written": 0,
+        }
+
+    def rebuild_all(self, db: Session) -> None:
+        """Walk users with friends in id order, one batch per transaction."""
+        after = ""
+        while not self._stop_event.is_set():
+            ids = list(db.scalars(text(
+                "SELECT DISTINCT user_id FROM friends WHERE user_id > :after ORDER BY user_id LIMIT :n"
+            ), {"after": after, "n": self.batch_users}))
+            if not ids:
+                break
+            self.stats["state"] = f"rebuilding after {after or '-'}"
+            self.stats["rows_written"] += _rebuild(db, ids, mirror=False)
+            db.commit()
+            self.stats["users_processed"] += len(ids)
+            after = ids[-1]
+
+        if not self._stop_event.is_set():
+            # Users left without friends keep no suggestions
+            db.execute(text(
+                "DELETE FROM friend_suggestions s "
+                "WHERE NOT EXISTS (SELECT 1 FROM friends f WHERE f.user_id = s.user_id)"
+            ))
+            db.commit()
+
+    def run_once(self) -> bool:
+        """One full rebuild. Returns False if another process holds the lock."""
+        with engine.connect() as lock_conn:
+            got = lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": SUGGESTIONS_LOCK_KEY}).scalar()
+            lock_conn.commit()
+            if not got:
+                self.stats["skipped_locked"] += 1
+                return False
+
+            start = time.perf_counter()
+            db = SessionLocal()
+            try:
+                self.rebuild_all(db)
+                self.stats["runs"] += 1
+            except Exception:
+                db.rollback()
+                self.stats["errors"] += 1
+                log.exception("Suggestions rebuild failed")
+            finally:
+                db.close()
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": SUGGESTIONS_LOCK_KEY})
+                lock_conn.commit()
+                self.stats["state"] = "idle"
+                self.stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+                self.stats["last_run_ms"] = round((time.perf_counter() - start) * 1000.0, 1)
+            return True
+
+    # -------- thread --------
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval_sec):
+            try:
+                self.run_once()
+            except Exception:
+                self.stats["errors"] += 1
+                log.exception("Suggestions rebuild failed")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="friend-suggestions", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+
+
+suggestions_worker = SuggestionsWorker(settings.suggestions_interval_sec, settings.suggestions_batch_users)
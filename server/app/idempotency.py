@@ -0,0 +1,254 @@
+"""
+Idempotency-Key support for mutating routes.
+
+Key ideas:
+- a POST/PUT/PATCH/DELETE sent with an Idempotency-Key header (by an
+  authenticated user) is executed at most once per key within
+  IDEMPOTENCY_TTL_SEC; retries get the saved response back without running
+  the route (no merge, no user row write, no extra activity)
+- the request is fingerprinted (method, path, query, body); reusing a key for
+  a different request is a 422
+- the first request reserves the key with one INSERT ... ON CONFLICT; a retry
+  that arrives while the first is still running gets 409 + Retry-After
+- responses live in the idempotency_keys table (shared by all workers) with a
+  small per-worker LRU in front, so hot retries don't touch the DB at all
+- only JSON responses below 500 (and not 409/429) are saved; otherwise the
+  reservation is released so the client can retry for real
+- expired keys are purged by the lifecycle worker
+"""
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response
+from sqlalchemy import and_, delete, or_, select, update
+
+from .auth import decode_token
+from .db import SessionLocal
+from .models import IdempotencyKey
+from .settings import settings
+from .upsert import upsert
+
+IDEMPOTENT_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+MAX_KEY_LENGTH = 255
+MAX_REQUEST_BODY = 1024 * 1024
+# A reservation older than this whose request never finished (worker crash) can be taken over
+STALE_RESERVATION = timedelta(seconds=60)
+NOT_SAVED_STATUSES = {409, 429}
+
+idempotency_stats = {"memory_hits": 0, "db_hits": 0, "saved": 0, "mismatched": 0, "in_progress": 0}
+
+
+class _Saved:
+    __slots__ = ("fingerprint", "status_code", "body", "expires")
+
+    def __init__(self, fingerprint: str, status_code: int, body: str, expires: float):
+        self.fingerprint = fingerprint
+        self.status_code = status_code
+        self.body = body
+        self.expires = expires  # monotonic
+
+
+class _ResponseCache:
+    def __init__(self, max_items: int):
+        self.max_items = max_items
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[Tuple[str, str], _Saved]" = OrderedDict()
+
+    def get(self, key: Tuple[str, str]) -> Optional[_Saved]:
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                return None
+            if hit.expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return hit
+
+    def put(self, key: Tuple[str, str], saved: _Saved) -> None:
+        with self._lock:
+            self._items[key] = saved
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+
+_cache = _ResponseCache(settings.idempotency_cache_size)
+
+
+def _fingerprint(request: Request, body: bytes) -> str:
+    h = hashlib.sha256()
+    h.update(f"{request.method} {request.url.path}?{request.url.query}\n".encode())
+    h.update(body)
+    return h.hexdigest()
+
+
+def _user_id(request: Request) -> Optional[str]:
+    auth = request.headers.get("authorization", "")
+    if not auth.lower().startswith("bearer "):
+        return None
+    try:
+        return decode_token(auth.split(" ", 1)[1].strip()).get("sub")
+    except Exception:
+        return None
+
+
+# -------- DB side (run in the threadpool) --------
+
+def _reserve(user_id: str, key: str, fingerprint: str):
+    """-> None if we own the key now, else the existing (fingerprint, status_code, response_body)."""
+    now = datetime.now(timezone.utc)
+    db = SessionLocal()
+    try:
+        stmt = upsert(
+            IdempotencyKey,
+            {
+                "user_id": user_id,
+                "idem_key": key,
+                "fingerprint": fingerprint,
+                "status_code": None,
+                "response_body": None,
+                "created_at": now,
+                "expires_at": now + timedelta(seconds=settings.idempotency_ttl_sec),
+            },
+            constraint="uq_idempotency_key",
+            update=["fingerprint", "status_code", "response_body", "created_at", "expires_at"],
+            # Take over only expired keys and abandoned reservations
+            where=or_(
+                IdempotencyKey.expires_at < now,
+                and_(IdempotencyKey.status_code.is_(None), IdempotencyKey.created_at < now - STALE_RESERVATION),
+            ),
+        ).returning(IdempotencyKey.id)
+        owned = db.execute(stmt).first() is not None
+        existing = None
+        if not owned:
+            existing = db.execute(
+                select(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.response_body)
+                .where(IdempotencyKey.user_id == user_id, IdempotencyKey.idem_key == key)
+            ).first()
+        db.commit()
+        return existing
+    finally:
+        db.close()
+
+
+def _complete(user_id: str, key: str, status_code: int, body: str) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.user_id == user_id, IdempotencyKey.idem_key == key)
+            .values(status_code=status_code, response_body=body)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _release(user_id: str, key: str) -> None:
+    db = SessionLocal()
+    try:
+        db.execute(
+            delete(IdempotencyKey)
+            .where(IdempotencyKey.user_id == user_id, IdempotencyKey.idem_key == key, IdempotencyKey.status_code.is_(None))
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+# -------- middleware --------
+
+def _mismatch() -> Response:
+    idempotency_stats["mismatched"] += 1
+    return JSONResponse({"detail": "Idempotency-Key was already used for a different request"}, status_code=422)
+
+
+def _replay(status_code: int, body: str) -> Response:
+    return Response(
+        content=body,
+        status_code=status_code,
+        media_type="application/json",
+        headers={"Idempotent-Replayed": "true"},
+    )
+
+
+async def idempotency_middleware(request: Request, call_next):
+    key = request.headers.get("idempotency-key")
+    if not key or request.method not in IDEMPOTENT_METHODS or not settings.idempotency_enabled:
+        return await call_next(request)
+    if len(key) > MAX_KEY_LENGTH:
+        return JSONResponse({"detail": "Idempotency-Key too long"}, status_code=400)
+
+    # Uploads are not fingerprinted (too large to buffer); they run as usual
+    if request.headers.get("content-type", "").startswith("multipart/"):
+        return await call_next(request)
+    if int(request.headers.get("content-length") or 0) > MAX_REQUEST_BODY:
+        return await call_next(request)
+
+    user_id = _user_id(request)
+    if user_id is None:
+        return await call_next(request)
+
+    fingerprint = _fingerprint(request, await request.body())
+    cache_key = (user_id, key)
+
+    hit = _cache.get(cache_key)
+    if hit is not None:
+        if hit.fingerprint != fingerprint:
+            return _mismatch()
+        idempotency_stats["memory_hits"] += 1
+        return _replay(hit.status_code, hit.body)
+
+    existing = await run_in_threadpool(_reserve, user_id, key, fingerprint)
+    if existing is not None:
+        if existing.fingerprint != fingerprint:
+            return _mismatch()
+        if existing.status_code is None:
+            idempotency_stats["in_progress"] += 1
+            return JSONResponse(
+                {"detail": "A request with this Idempotency-Key is still in progress"},
+                status_code=409,
+                headers={"Retry-After": "1"},
+            )
+        idempotency_stats["db_hits"] += 1
+        _cache.put(cache_key, _Saved(existing.fingerprint, existing.status_code, existing.response_body or "", time.monotonic() + settings.idempotency_ttl_sec))
+        return _replay(existing.status_code, existing.response_body or "")
+
+    try:
+        response = await call_next(request)
+    except Exception:
+        await run_in_threadpool(_release, user_id, key)
+        raise
+
+    cacheable = (
+        response.status_code < 500
+        and response.status_code not in NOT_SAVED_STATUSES
+        and response.headers.get("content-type", "").startswith("application/json")
+    )
+    if not cacheable:
+        await run_in_threadpool(_release, user_id, key)
+        return response
+
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    if len(body) > settings.idempotency_max_response_bytes:
+        await run_in_threadpool(_release, user_id, key)
+    else:
+        text_body = body.decode("utf-8")
+        await run_in_threadpool(_complete, user_id, key, response.status_code, text_body)
+        _cache.put(cache_key, _Saved(fingerprint, response.status_code, text_body, time.monotonic() + settings.idempotency_ttl_sec))
+        idempotency_stats["saved"] += 1
+
+    return Response(
+        content=body,
+        status_code=response.status_code,
+        headers=dict(response.headers),
+        media_type=response.media_type,
+    )
@@ -0,0 +1,253 @@
+"""
+Background data lifecycle jobs.
+
+Key ideas:
+- soft-deleted accounts (is_deleted) are hard-purged once they are older than
+  LIFECYCLE_PURGE_AFTER_HOURS: reactions, activities, friend rows, revoked
+  and refresh tokens, app_data history, travel stats, friend suggestions, storage
+  accounting, the user row and the user's stored files
+- expired activities (and their reactions), expired revoked and refresh
+  tokens and expired idempotency keys are removed here too, instead of on the request path
+- every DELETE touches at most LIFECYCLE_BATCH_SIZE rows and commits, so no
+  run holds long locks or builds a huge transaction
+- storage prefixes that belong to no user row are removed (orphaned blobs),
+  through the storage driver, so this works for local disk and S3 alike
+- blobs stored before quotas existed are accounted once per user
+  (storage_quota.reconcile), so they count against the quota and can be
+  deleted through the API
+- one worker per cluster does the work: pg_try_advisory_lock, others skip
+- progress and totals are exposed on /monitor/stats
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import delete, func, or_, select, text
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal, engine
+from .friend_graph import friend_graph, friends_changed
+from .models import (
+    User, Friend, Activity, ActivityReaction, RevokedToken, RefreshToken, IdempotencyKey, AppDataRevision, TravelStats,
+    FriendSuggestion, StoredFile, StorageUsage,
+)
+from .settings import settings
+from .storage import run_sync, storage
+from .storage_quota import reconcile, unreconciled
+
+log = logging.getLogger(__name__)
+
+LIFECYCLE_LOCK_KEY = 123456790
+
+# Prefixes with files younger than this are never treated as orphans (upload racing signup)
+ORPHAN_MIN_AGE_SEC = 3600
+
+
+class LifecycleWorker:
+    def __init__(self, interval_sec: float, purge_after: timedelta, batch_size: int, users_per_run: int):
+        self.interval_sec = interval_sec
+        self.purge_after = purge_after
+        self.batch_size = batch_size
+        self.users_per_run = users_per_run
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats: Dict[str, Any] = {
+            "state": "idle",
+            "runs": 0,
+            "skipped_locked": 0,
+            "errors": 0,
+            "last_run_at": None,
+            "last_run_ms": None,
+            "pending_users": None,
+            "users_purged": 0,
+            "orphan_dirs_removed": 0,
+            "users_reconciled": 0,
+            "files_reconciled": 0,
+            "rows_deleted": {},
+        }
+
+    # -------- helpers --------
+
+    def _count(self, table: str, n: int) -> None:
+        rows = self.stats["rows_deleted"]
+        rows[table] = rows.get(table, 0) + n
+
+    def _delete_batched(self, db: Session, model, pk, *where) -> int:
+        """DELETE ... WHERE pk IN (SELECT pk ... LIMIT batch), repeated until done."""
+        total = 0
+        while not self._stop_event.is_set():
+            batch = select(pk).where(*where).limit(self.batch_size)
+            n = db.execute(delete(model).where(pk.in_(batch))).rowcount
+            db.commit()
+            total += n
+            self._count(model.__tablename__, n)
+            if n < self.batch_size:
+                break
+        return total
+
+    def _delete_friend_rows(self, db: Session, user_ids: List[str]) -> None:
+        gone = set(user_ids)
+        while not self._stop_event.is_set():
+            batch = select(Friend.id).where(
+                or_(Friend.user_id.in_(user_ids), Friend.friend_id.in_(user_ids))
+            ).limit(self.batch_size)
+            rows = db.execute(
+                delete(Friend).where(Friend.id.in_(batch)).returning(Friend.user_id, Friend.friend_id)
+            ).all()
+            # Survivors lose a friend: drop their cached adjacency everywhere
+            affected = {uid for r in rows for uid in (r.user_id, r.friend_id)} - gone
+            if affected:
+                friends_changed(db, affected)
+            db.commit()
+            if affected:
+                friend_graph.invalidate(affected)
+            self._count(Friend.__tablename__, len(rows))
+            if len(rows) < self.batch_size:
+                break
+
+    # -------- jobs --------
+
+    def purge_deleted_users(self, db: Session) -> int:
+        cutoff = datetime.now(timezone.utc) - self.purge_after
+        deleted = (User.is_deleted == True, User.updated_at < cutoff)  # noqa: E712
+
+        self.stats["pending_users"] = db.scalar(select(func.count()).select_from(User).where(*deleted))
+        user_ids = list(db.scalars(select(User.id).where(*deleted).limit(self.users_per_run)))
+        if not user_ids:
+            return 0
+
+        self.stats["state"] = f"purging {len(user_ids)} users"
+        self._delete_batched(db, ActivityReaction, ActivityReaction.id, ActivityReaction.user_id.in_(user_ids))
+        self._delete_batched(db, ActivityReaction, ActivityReaction.id, ActivityReaction.activity_id.in_(
+            select(Activity.id).where(Activity.actor_user_id.in_(user_ids))
+        ))
+        self._delete_batched(db, Activity, Activity.id, Activity.actor_user_id.in_(user_ids))
+        self._delete_batched(db, FriendSuggestion, FriendSuggestion.user_id, FriendSuggestion.user_id.in_(user_ids))
+        self._delete_batched(db, FriendSuggestion, FriendSuggestion.candidate_id, FriendSuggestion.candidate_id.in_(user_ids))
+        self._delete_friend_rows(db, user_ids)
+        self._delete_batched(db, RevokedToken, RevokedToken.jti, RevokedToken.user_id.in_(user_ids))
+        self._delete_batched(db, RefreshToken, RefreshToken.id, RefreshToken.user_id.in_(user_ids))
+        self._delete_batched(db, IdempotencyKey, IdempotencyKey.id, IdempotencyKey.user_id.in_(user_ids))
+        self._delete_batched(db, AppDataRevision, AppDataRevision.id, AppDataRevision.user_id.in_(user_ids))
+        self._delete_batched(db, TravelStats, TravelStats.user_id, TravelStats.user_id.in_(user_ids))
+        self._delete_batched(db, StoredFile, StoredFile.user_id, StoredFile.user_id.in_(user_ids))
+        self._delete_batched(db, StorageUsage, StorageUsage.user_id, StorageUsage.user_id.in_(user_ids))
+        if self._stop_event.is_set():
+            return 0
+
+        n = db.execute(delete(User).where(User.id.in_(user_ids), *deleted)).rowcount
+        db.commit()
+        self._count(User.__tablename__, n)
+
+        for uid in user_ids:
+            self._count("blobs", run_sync(storage.delete_prefix(f"{uid}/")))
+
+        self.stats["users_purged"] += n
+        self.stats["pending_users"] = max(0, self.stats["pending_users"] - n)
+        return n
+
+    def purge_expired(self, db: Session) -> None:
+        self.stats["state"] = "purging expired rows"
+        now = datetime.now(timezone.utc)
+        self._delete_batched(db, ActivityReaction, ActivityReaction.id, ActivityReaction.activity_id.in_(
+            select(Activity.id).where(Activity.expires_at < now)
+        ))
+        self._delete_batched(db, Activity, Activity.id, Activity.expires_at < now)
+        self._delete_batched(db, RevokedToken, RevokedToken.jti, RevokedToken.expires_at < now)
+        self._delete_batched(db, RefreshToken, RefreshToken.id, RefreshToken.expires_at < now)
+        self._delete_batched(db, IdempotencyKey, IdempotencyKey.id, IdempotencyKey.expires_at < now)
+
+    def compact_orphaned_blobs(self, db: Session) -> int:
+        self.stats["state"] = "compacting storage"
+        old_enough = time.time() - ORPHAN_MIN_AGE_SEC
+        candidates = run_sync(storage.prefixes())
+
+        removed = 0
+        reconciled = 0
+        for i in range(0, len(candidates), self.batch_size):
+            chunk = candidates[i:i + self.batch_size]
+            known = set(db.scalars(select(User.id).where(User.id.in_(chunk))))
+            # Known users with blobs from before the accounting: fold them in
+            for uid in unreconciled(db, sorted(known))[:max(0, self.users_per_run - reconciled)]:
+                if self._stop_event.is_set():
+                    break
+                added = reconcile(db, uid, run_sync(storage.list(f"{uid}/")))
+                db.commit()
+                reconciled += 1
+                self.stats["users_reconciled"] += 1
+                self.stats["files_reconciled"] += added
+            for name in chunk:
+                if name in known or self._stop_event.is_set():
+                    continue
+                objs = run_sync(storage.list(f"{name}/"))
+                if all(o.modified < old_enough for o in objs):
+                    self._count("blobs", run_sync(storage.delete_prefix(f"{name}/")))
+                    removed += 1
+        self.stats["orphan_dirs_removed"] += removed
+        return removed
+
+    def run_once(self) -> bool:
+        """One pass of all jobs. Returns False if another process holds the lock."""
+        with engine.connect() as lock_conn:
+            got = lock_conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": LIFECYCLE_LOCK_KEY}).scalar()
+            lock_conn.commit()
+            if not got:
+                self.stats["skipped_locked"] += 1
+                return False
+
+            start = time.perf_counter()
+            db = SessionLocal()
+            try:
+                # Drain the backlog in bounded chunks of users
+                while self.purge_deleted_users(db) and not self._stop_event.is_set():
+                    pass
+                self.purge_expired(db)
+                self.compact_orphaned_blobs(db)
+                self.stats["runs"] += 1
+            except Exception:
+                db.rollback()
+                self.stats["errors"] += 1
+                log.exception("Lifecycle run failed")
+            finally:
+                db.close()
+                lock_conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": LIFECYCLE_LOCK_KEY})
+                lock_conn.commit()
+                self.stats["state"] = "idle"
+                self.stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+                self.stats["last_run_ms"] = round((time.perf_counter() - start) * 1000.0, 1)
+            return True
+
+    # -------- thread --------
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval_sec):
+            try:
+                self.run_once()
+            except Exception:
+                self.stats["errors"] += 1
+                log.exception("Lifecycle run failed")
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="lifecycle", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=10)
+        self._thread = None
+
+
+lifecycle_worker = LifecycleWorker(
+    settings.lifecycle_interval_sec,
+    timedelta(hours=settings.lifecycle_purge_after_hours),
+    settings.lifecycle_batch_size,
+    settings.lifecycle_users_per_run,
+)
@@ -1,21 +1,31 @@
 """
 FastAPI entry point.
+
+create_app() builds the app; `app` below is what gunicorn/uvicorn import.
+The app is safe to build in a preloading gunicorn master (see
+gunicorn.conf.py): nothing here opens DB connections or starts threads,
+that happens in the per-worker startup hook.
 """
 
+from .boot import timed, run_boot_tasks_once, prewarm_pool, mark_imports_done, mark_ready, LazyAdminApp
+
 from fastapi import FastAPI, Request
 from starlette.middleware.base import BaseHTTPMiddleware
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import text
-from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
 
 from .settings import settings
-from .db import engine, SessionLocal
-from .models import Base, User
-from .storage import ensure_storage_dir
-from .auth import hash_password
+from .db import engine
 from .monitoring import monitoring_middleware
-from .admin import setup_admin
+from .tracing import tracing_middleware, exporter as trace_exporter
+from .ratelimit import rate_limit_middleware
+from .idempotency import idempotency_middleware
+from .feed_hub import start_listener, stop_listener
+from .activity_queue import activity_queue
+from .lifecycle import lifecycle_worker
+from .friend_suggestions import suggestions_worker
+from .read_routing import read_router
+from .storage import storage, stop_sync_loop
+from .map_cache import map_images
 
 # Routers
 from .api.routes.health import router as health_router
@@ -30,8 +40,7 @@ from .api.routes.monitor import router as monitor_router
 from fastapi.responses import RedirectResponse
 from starlette.middleware.sessions import SessionMiddleware
 
-
-app = FastAPI(title="Server API", version="1.0.0")
+mark_imports_done()
 
 class ProtectInternalPagesMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
@@ -55,115 +64,115 @@ class ProtectInternalPagesMiddleware(BaseHTTPMiddleware):
         return await call_next(request)
 
 
-app.add_middleware(ProtectInternalPagesMiddleware)
-
-app.add_middleware(
-    SessionMiddleware,
-    secret_key=settings.jwt_secret,
-    same_site="lax",
-    #https_only=(settings.env == "prod"),
-    https_only=False,
-)
-
-def seed_admin_if_configured() -> None:
-    if not settings.admin_email or not settings.admin_password:
-        return
-
-    db: Session = SessionLocal()
-    try:
-        # 1) Fast path: already exists -> ensure admin -> return
-        existing = (
-            db.query(User)
-            .filter(User.email == settings.admin_email, User.is_deleted == False)  # noqa: E712
-            .first()
-        )
-        if existing:
-            # Optional hardening: ensure the existing user is actually admin
-            if not existing.is_admin:
-                existing.is_admin = True
-                db.commit()
-            return
-
-        # 2) Create admin (fill ALL NOT NULL fields if your model doesn't default them)
-        admin = User(
-            email=settings.admin_email,
-            username="admin",
-            first_name="Admin",
-            last_name="User",
-            password_hash=hash_password(settings.admin_password),
-            is_admin=True,
-
-            # IMPORTANT: set these if your model doesn't provide defaults
-            app_data={},
-            travel_visible_to_friends=False,
-            is_deleted=False,
-        )
-
-        db.add(admin)
-
-        # 3) Commit safely under concurrency (Gunicorn workers)
-        try:
-            db.commit()
-        except IntegrityError:
-            # Another worker probably inserted it first. Rollback and continue.
-            db.rollback()
-            return
-
-    finally:
-        db.close()
-
-
-@app.on_event("startup")
-def on_startup():
-    ensure_storage_dir()
-
-    # Ensure schema init runs once even if multiple workers boot.
-    with engine.begin() as conn:
-        conn.execute(text("SELECT pg_advisory_lock(123456789);"))
-        try:
-            Base.metadata.create_all(bind=conn)
-        finally:
-            conn.execute(text("SELECT pg_advisory_unlock(123456789);"))
-
-    seed_admin_if_configured()
-
-
-# CORS
-origins = [o.strip() for o in settings.cors_origins.split(",")] if settings.cors_origins else ["*"]
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-# Monitoring middleware
-app.middleware("http")(monitoring_middleware)
-
-# Admin DB UI at /db
-setup_admin(app, engine)
-
-# Routers
-app.include_router(health_router, tags=["health"])
-app.include_router(auth_router, prefix="/auth", tags=["auth"])
-app.include_router(users_router, prefix="/users", tags=["users"])
-app.include_router(files_router, prefix="/files", tags=["files"])
-app.include_router(data_router, prefix="/data", tags=["data"])
-app.include_router(friends_router, prefix="/friends", tags=["friends"])
-app.include_router(feed_router, prefix="/feed", tags=["feed"])
-app.include_router(monitor_router, tags=["monitor"])
-
-# /doc -> /docs
-@app.get("/doc", include_in_schema=False)
-def doc_redirect():
-    return RedirectResponse(url="/docs")
-
-@app.get("/db", include_in_schema=False)
-def db_redirect():
-    return RedirectResponse(url="/admin", status_code=307)
-
-@app.get("/db/{path:path}", include_in_schema=False)
-def db_redirect_path(path: str):
-    return RedirectResponse(url=f"/admin/{path}", status_code=307)
-
+def create_app() -> FastAPI:
+    app = FastAPI(title="Server API", version="1.0.0")
+
+    app.add_middleware(ProtectInternalPagesMiddleware)
+
+    app.add_middleware(
+        SessionMiddleware,
+        secret_key=settings.jwt_secret,
+        same_site="lax",
+        #https_only=(settings.env == "prod"),
+        https_only=False,
+    )
+
+    @app.on_event("startup")
+    def on_startup():
+        # Migrations + admin seeding; a no-op if a preloading master already ran them
+        run_boot_tasks_once()
+
+        with timed("pool_prewarm"):
+            prewarm_pool(settings.db_pool_prewarm)
+
+        # Per-worker LISTEN connection feeding /feed/stream subscribers
+        with timed("background_threads"):
+            start_listener()
+            read_router.start()
+            if trace_exporter is not None:
+                trace_exporter.start()
+            activity_queue.start()
+            if settings.lifecycle_enabled:
+                lifecycle_worker.start()
+            if settings.suggestions_enabled:
+                suggestions_worker.start()
+
+        mark_ready()
+
+    @app.on_event("shutdown")
+    def on_shutdown():
+        # Flush buffered activities before the worker exits
+        lifecycle_worker.stop()
+        suggestions_worker.stop()
+        activity_queue.stop()
+        stop_listener()
+        read_router.stop()
+        if trace_exporter is not None:
+            trace_exporter.stop()
+        stop_sync_loop()
+        map_images.stop()
+
+    @app.on_event("shutdown")
+    async def close_storage():
+        # Pooled storage connections of the request event loop
+        await storage.close()
+
+
+    # Idempotency-Key replays (inside rate limiting: retries still count)
+    app.middleware("http")(idempotency_middleware)
+
+    # Rate limiting / load shedding (inside monitoring, so 429s show up in stats)
+    app.middleware("http")(rate_limit_middleware)
+
+    # Monitoring middleware
+    app.middleware("http")(monitoring_middleware)
+
+    # Request id + sampled traces (everything below is inside the trace)
+    app.middleware("http")(tracing_middleware)
+
+    # CORS (outermost: 429s, 503s and error responses from the middlewares
+    # above still carry CORS headers, so browsers can read them)
+    origins = [o.strip() for o in settings.cors_origins.split(",")] if settings.cors_origins else ["*"]
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    # Admin DB UI at /db (sqladmin is imported on the first request)
+    if settings.lazy_admin_ui:
+        app.mount("/admin", LazyAdminApp(engine), name="admin")
+    else:
+        from .admin import setup_admin
+        setup_admin(app, engine)
+
+    # Routers
+    app.include_router(health_router, tags=["health"])
+    app.include_router(auth_router, prefix="/auth", tags=["auth"])
+    app.include_router(users_router, prefix="/users", tags=["users"])
+    app.include_router(files_router, prefix="/files", tags=["files"])
+    app.include_router(data_router, prefix="/data", tags=["data"])
+    app.include_router(friends_router, prefix="/friends", tags=["friends"])
+    app.include_router(feed_router, prefix="/feed", tags=["feed"])
+    app.include_router(monitor_router, tags=["monitor"])
+
+    # /doc -> /docs
+    @app.get("/doc", include_in_schema=False)
+    def doc_redirect():
+        return RedirectResponse(url="/docs")
+
+    @app.get("/db", include_in_schema=False)
+    def db_redirect():
+        return RedirectResponse(url="/admin", status_code=307)
+
+    @app.get("/db/{path:path}", include_in_schema=False)
+    def db_redirect_path(path: str):
+        return RedirectResponse(url=f"/admin/{path}", status_code=307)
+
+    return app
+
+
+with timed("create_app"):
+    app = create_app()
@@ -0,0 +1,219 @@
+"""
+Rendered map images: process pool plus a shared on-disk LRU cache.
+
+Key ideas:
+- an image is a pure function of (visited ISO2 set, style, map geometry), so
+  its cache key is a hash of exactly those; the key doubles as a strong ETag,
+  and a matching If-None-Match is answered before any render or disk read
+- renders run in a small pool of spawned processes (map_render.py), each of
+  which parses the map outlines once; the event loop only awaits the result
+- concurrent requests for the same image in one worker share one render;
+  across workers the cache file is written to a temp name and renamed into
+  place, so a duplicate render is wasted work, never a torn file
+- the cache directory is bounded by MAP_CACHE_MAX_MB: a hit bumps the file's
+  mtime, and after each write the least recently used files are removed
+- at most MAP_RENDER_QUEUE renders may wait per worker; beyond that requests
+  get 503 + Retry-After instead of piling up behind the pool
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from . import map_render
+from .map_render import MapStyle
+from .settings import settings
+
+log = logging.getLogger(__name__)
+
+# Bump when the rasterizer's output changes, so cached images are not reused
+RENDER_VERSION = 1
+
+map_stats = {"hits": 0, "misses": 0, "not_modified": 0, "renders": 0, "render_ms": 0.0, "evicted": 0, "rejected": 0}
+
+
+class RenderBusy(Exception):
+    pass
+
+
+def visited_ids(app_data_selected: Any) -> Tuple[str, ...]:
+    """Sorted ISO2 ids from app_data["selectedCountries"] (list, or v2 dict keyed by ISO2)."""
+    if isinstance(app_data_selected, dict):
+        ids: Iterable[Any] = app_data_selected.keys()
+    elif isinstance(app_data_selected, list):
+        ids = app_data_selected
+    else:
+        ids = ()
+    return tuple(sorted({str(i).strip().upper() for i in ids if str(i).strip()}))
+
+
+class MapImageCache:
+    def __init__(self, svg_path: str, cache_dir: str, max_bytes: int, processes: int, max_queue: int):
+        self.svg_path = svg_path
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.processes = max(1, processes)
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._geometry_digest: Optional[str] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._queued = 0
+
+    # -------- keys --------
+
+    def _digest(self) -> str:
+        # Geometry is part of the key: a new world.svg must not serve old images
+        if self._geometry_digest is None:
+            self._geometry_digest = hashlib.sha256(Path(self.svg_path).read_bytes()).hexdigest()
+        return self._geometry_digest
+
+    def key(self, selected: Tuple[str, ...], style: MapStyle) -> str:
+        raw = json.dumps([RENDER_VERSION, self._digest(), selected, list(style)], separators=(",", ":"))
+        return hashlib.sha256(raw.encode()).hexdigest()[:40]
+
+    @staticmethod
+    def etag(key: str) -> str:
+        return f'"{key}"'
+
+    # -------- disk --------
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.png"
+
+    def _read(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # LRU: most recently used = newest mtime
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write(self, key: str, data: bytes) -> None:
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        self._evict()
+
+    def _evict(self) -> None:
+        files = []
+        total = 0
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                if not e.name.endswith(".png") or e.name.startswith("."):
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+        if total <= self.max_bytes:
+            return
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                map_stats["evicted"] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    # -------- rendering --------
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # spawn, not fork: the API worker has threads and open connections
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=map_render.init_worker,
+                    initargs=(self.svg_path,),
+                )
+            return self._pool
+
+    def _reset_pool(self, broken: ProcessPoolExecutor) -> None:
+        with self._lock:
+            if self._pool is broken:
+                self._pool = None
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    async def _render(self, key: str, selected: Tuple[str, ...], style: MapStyle) -> bytes:
+        loop = asyncio.get_running_loop()
+        pool = self._executor()
+        started = time.perf_counter()
+        try:
+            data = await loop.run_in_executor(pool, map_render.render_png, selected, style)
+        except BrokenProcessPool:
+            # A render process died (e.g. OOM-killed): start a fresh pool next time
+            log.warning("Map render pool broke; recreating it")
+            self._reset_pool(pool)
+            raise
+        map_stats["renders"] += 1
+        map_stats["render_ms"] += (time.perf_counter() - started) * 1000
+        await asyncio.to_thread(self._write, key, data)
+        return data
+
+    async def get(self, key: str, selected: Tuple[str, ...], style: MapStyle) -> bytes:
+        """PNG for `key`, from disk or rendered (one render per key per worker at a time)."""
+        data = await asyncio.to_thread(self._read, key)
+        if data is not None:
+            map_stats["hits"] += 1
+            return data
+        map_stats["misses"] += 1
+
+        task = self._inflight.get(key)
+        if task is None:
+            if self._queued >= self.max_queue:
+                map_stats["rejected"] += 1
+                raise RenderBusy()
+            # Its own task: a client that goes away does not cancel the render others wait for
+            task = asyncio.ensure_future(self._render(key, selected, style))
+            self._inflight[key] = task
+            self._queued += 1
+            task.add_done_callback(lambda t: self._done(key, t))
+        return await asyncio.shield(task)
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        self._queued -= 1
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # retrieved: failures are raised to the waiting requests
+
+    def stats(self) -> Dict[str, Any]:
+        return {**map_stats, "queued": self._queued, "pool_started": self._pool is not None}
+
+    def stop(self) -> None:
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+map_images = MapImageCache(
+    svg_path=settings.map_svg_path,
+    cache_dir=settings.map_cache_dir,
+    max_bytes=settings.map_cache_max_mb * 1024 * 1024,
+    processes=settings.map_render_processes,
+    max_queue=settings.map_render_queue,
+)
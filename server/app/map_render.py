@@ -0,0 +1,289 @@
+"""
+World map rasterizer (GET /users/{username}/map.png), run in worker processes.
+
+Key ideas:
+- the country outlines of assets/maps/world.svg (the file the app draws its
+  map from) are parsed once per render process into flat polygon rings, with
+  bounding boxes and a "has holes" flag; each render only scales them
+- colours and fill order follow the app's WorldMapPainter: grey for unvisited,
+  the selected colour (or a palette colour picked by a stable hash of the
+  country name) for visited, a thin border on top
+- countries with holes (South Africa around Lesotho, Italy around San Marino,
+  ...) are filled even-odd through a mask, so enclaves drawn earlier stay
+  visible; everything else is a plain polygon fill
+- drawn at 2x and downsampled, for anti-aliased edges
+- this module only imports the standard library at the top: it is what the
+  spawned render processes import (Pillow is loaded there, not in the API)
+"""
+
+import io
+import re
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+SUPERSAMPLE = 2
+
+UNSELECTED = (0x9E, 0x9E, 0x9E, 0xFF)
+# AppSettingsController.countryColorPalette (Material blue, teal, green, amber,
+# orange, pink, purple, red)
+PALETTE = (
+    (0x21, 0x96, 0xF3), (0x00, 0x96, 0x88), (0x4C, 0xAF, 0x50), (0xFF, 0xC1, 0x07),
+    (0xFF, 0x98, 0x00), (0xE9, 0x1E, 0x63), (0x9C, 0x27, 0xB0), (0xF4, 0x43, 0x36),
+)
+# The app's outlineVariant border, per theme (with its alpha)
+BORDERS = {"light": (0xC4, 0xC6, 0xD0, 180), "dark": (0x44, 0x47, 0x4F, 125)}
+
+Ring = List[Tuple[float, float]]
+
+_TOKEN = re.compile(r"[MmLlHhVvZz]|[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?|[A-Za-z]")
+
+
+class Country(NamedTuple):
+    id: str
+    name: str
+    rings: Tuple[Ring, ...]
+    bbox: Tuple[float, float, float, float]
+    has_holes: bool
+
+
+class MapGeometry(NamedTuple):
+    width: float
+    height: float
+    countries: Tuple[Country, ...]
+
+
+class MapStyle(NamedTuple):
+    width: int
+    height: int
+    color: Tuple[int, int, int]
+    multicolor: bool
+    theme: str
+
+
+# -------- geometry --------
+
+def parse_path(d: str) -> List[Ring]:
+    """Polygon rings of an SVG path made of move/line/close commands."""
+    rings: List[Ring] = []
+    ring: Ring = []
+    x = y = 0.0
+    cmd = None
+    tokens = _TOKEN.findall(d)
+    i = 0
+
+    def num() -> float:
+        nonlocal i
+        v = float(tokens[i])
+        i += 1
+        return v
+
+    while i < len(tokens):
+        t = tokens[i]
+        if t.isalpha():
+            if t not in "MmLlHhVvZz":
+                raise ValueError(f"Unsupported path command {t!r}")
+            i += 1
+            if t in "Zz":
+                if ring:
+                    rings.append(ring)
+                    x, y = ring[0]
+                ring = []
+                cmd = None
+                continue
+            cmd = t
+            if t in "Mm":
+                if ring:
+                    rings.append(ring)
+                dx, dy = num(), num()
+                x, y = (x + dx, y + dy) if t == "m" else (dx, dy)
+                ring = [(x, y)]
+                # Further pairs after a moveto are implicit linetos
+                cmd = "l" if t == "m" else "L"
+            continue
+        if cmd is None:
+            raise ValueError("Path data must start with a moveto")
+        if not ring:
+            # Drawing on after a closepath starts a new subpath at the current point
+            ring = [(x, y)]
+        if cmd == "l":
+            dx, dy = num(), num()
+            x, y = x + dx, y + dy
+        elif cmd == "L":
+            x, y = num(), num()
+        elif cmd == "h":
+            x += num()
+        elif cmd == "H":
+            x = num()
+        elif cmd == "v":
+            y += num()
+        elif cmd == "V":
+            y = num()
+        ring.append((x, y))
+    if ring:
+        rings.append(ring)
+    return [r for r in rings if len(r) >= 3]
+
+
+def _bbox(points: Sequence[Tuple[float, float]]) -> Tuple[float, float, float, float]:
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    return min(xs), min(ys), max(xs), max(ys)
+
+
+def _inside(p: Tuple[float, float], ring: Ring) -> bool:
+    px, py = p
+    inside = False
+    bx, by = ring[-1]
+    for ax, ay in ring:
+        if (ay > py) != (by > py) and px < (bx - ax) * (py - ay) / (by - ay) + ax:
+            inside = not inside
+        bx, by = ax, ay
+    return inside
+
+
+def _has_holes(rings: List[Ring]) -> bool:
+    boxes = [_bbox(r) for r in rings]
+    for i, r in enumerate(rings):
+        x, y = r[0]
+        for j, o in enumerate(rings):
+            b = boxes[j]
+            if i != j and b[0] <= x <= b[2] and b[1] <= y <= b[3] and _inside(r[0], o):
+                return True
+    return False
+
+
+def _number(v: Optional[str]) -> Optional[float]:
+    m = re.match(r"\s*([-+]?(?:\d+\.?\d*|\.\d+))", v or "")
+    return float(m.group(1)) if m else None
+
+
+def load_geometry(svg_path: str) -> MapGeometry:
+    """Countries (one per <path id=...>) in document order, in SVG user units."""
+    root = ET.parse(svg_path).getroot()
+    countries = []
+    for node in root.iter():
+        if node.tag.rsplit("}", 1)[-1] != "path":
+            continue
+        cid = (node.get("id") or "").strip()
+        d = node.get("d") or ""
+        if not cid or not d.strip():
+            continue
+        rings = parse_path(d)
+        if not rings:
+            continue
+        name = (node.get("title") or "").strip() or cid
+        box = _bbox([p for r in rings for p in r])
+        countries.append(Country(cid.upper(), name, tuple(rings), box, len(rings) > 1 and _has_holes(rings)))
+    if not countries:
+        raise ValueError(f"No country paths in {svg_path}")
+
+    view_box = [float(v) for v in re.split(r"[\s,]+", (root.get("viewBox") or "").strip()) if v]
+    if len(view_box) == 4:
+        # Fold the viewBox origin into the outlines
+        ox, oy = view_box[0], view_box[1]
+        if ox or oy:
+            countries = [
+                c._replace(
+                    rings=tuple([(x - ox, y - oy) for x, y in r] for r in c.rings),
+                    bbox=(c.bbox[0] - ox, c.bbox[1] - oy, c.bbox[2] - ox, c.bbox[3] - oy),
+                )
+                for c in countries
+            ]
+        width, height = view_box[2], view_box[3]
+    else:
+        width, height = _number(root.get("width")), _number(root.get("height"))
+        if not width or not height:
+            width = max(c.bbox[2] for c in countries)
+            height = max(c.bbox[3] for c in countries)
+    return MapGeometry(width, height, tuple(countries))
+
+
+# -------- colours --------
+
+def _fnv1a32(s: str) -> int:
+    # Same hash as the app (over UTF-16 code units), so colours match
+    h = 0x811C9DC5
+    units = s.encode("utf-16-le")
+    for i in range(0, len(units), 2):
+        h ^= units[i] | (units[i + 1] << 8)
+        h = (h * 0x01000193) & 0xFFFFFFFF
+    return h
+
+
+def palette_color(name: str) -> Tuple[int, int, int]:
+    return PALETTE[_fnv1a32(name.strip().lower()) % len(PALETTE)]
+
+
+# -------- render process --------
+
+_geometry: Optional[MapGeometry] = None
+
+
+def init_worker(svg_path: str) -> None:
+    """Process pool initializer: parse the outlines once per process."""
+    global _geometry
+    _geometry = load_geometry(svg_path)
+
+
+@lru_cache(maxsize=8)
+def _scaled(width: int, height: int) -> List[Tuple[List[Ring], Tuple[int, int, int, int]]]:
+    """Per country: rings in (supersampled) output pixels, BoxFit.contain and centred, and a pixel bbox."""
+    g = _geometry
+    w, h = width * SUPERSAMPLE, height * SUPERSAMPLE
+    fit = min(w / g.width, h / g.height)
+    dx = (w - g.width * fit) / 2
+    dy = (h - g.height * fit) / 2
+    out = []
+    for c in g.countries:
+        rings = [[(x * fit + dx, y * fit + dy) for x, y in r] for r in c.rings]
+        x0, y0, x1, y1 = c.bbox
+        box = (
+            max(0, int(x0 * fit + dx) - 1), max(0, int(y0 * fit + dy) - 1),
+            min(w, int(x1 * fit + dx) + 2), min(h, int(y1 * fit + dy) + 2),
+        )
+        out.append((rings, box))
+    return out
+
+
+def render_png(selected: Sequence[str], style: MapStyle) -> bytes:
+    """PNG bytes of the world map with the `selected` ISO2 ids highlighted."""
+    from PIL import Image, ImageChops, ImageDraw
+
+    g = _geometry
+    if g is None:
+        raise RuntimeError("init_worker() was not called in this process")
+    chosen = set(selected)
+    scaled = _scaled(style.width, style.height)
+    w, h = style.width * SUPERSAMPLE, style.height * SUPERSAMPLE
+
+    img = Image.new("RGBA", (w, h), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img, "RGBA")
+    border = BORDERS.get(style.theme, BORDERS["light"])
+
+    for c, (rings, box) in zip(g.countries, scaled):
+        if c.id in chosen:
+            fill = (*(palette_color(c.name) if style.multicolor else style.color), 0xFF)
+        else:
+            fill = UNSELECTED
+        if c.has_holes:
+            bw, bh = box[2] - box[0], box[3] - box[1]
+            if bw > 0 and bh > 0:
+                mask = Image.new("1", (bw, bh), 0)
+                for r in rings:
+                    layer = Image.new("1", (bw, bh), 0)
+                    ImageDraw.Draw(layer).polygon([(x - box[0], y - box[1]) for x, y in r], fill=1)
+                    mask = ImageChops.logical_xor(mask, layer)
+                img.paste(fill, box[:2], mask)
+        else:
+            for r in rings:
+                draw.polygon(r, fill=fill)
+        for r in rings:
+            draw.line(r + r[:1], fill=border, width=1)
+
+    if SUPERSAMPLE > 1:
+        img = img.resize((style.width, style.height), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
@@ -0,0 +1,502 @@
+"""
+Versioned schema migrations.
+
+Key ideas:
+- MIGRATIONS is an ordered list; each migration has a version, a name and
+  plain SQL statements (models.py mirrors the result for the ORM)
+- applied versions are recorded in schema_migrations together with a checksum
+  of their SQL, so editing an already-applied migration is caught at startup
+- "concurrent" migrations run outside a transaction, one statement at a time,
+  so indexes can be built with CREATE INDEX CONCURRENTLY on a live database
+- one advisory lock makes sure only one process migrates at a time; it is
+  polled with pg_try_advisory_lock, because a session blocked in
+  pg_advisory_lock holds a transaction open that CREATE INDEX CONCURRENTLY
+  in the migrating session would wait for (a deadlock)
+- on startup we either apply pending migrations (MIGRATE_ON_STARTUP=1) or
+  just check that the schema is current and refuse to boot if it is not
+
+Run by hand:
+    python -m app.migrations          # apply pending
+    python -m app.migrations --check  # exit 1 if anything is pending
+"""
+
+import hashlib
+import re
+import sys
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+MIGRATION_LOCK_KEY = 123456789
+# How long a process waits for another one's migrations before giving up
+MIGRATION_LOCK_TIMEOUT_SEC = 900
+MIGRATION_LOCK_POLL_SEC = 1.0
+
+_CREATED_INDEX = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.I)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: Tuple[str, ...]
+    concurrent: bool = False
+
+    @property
+    def built_indexes(self) -> Tuple[str, ...]:
+        """Names of the indexes this migration builds CONCURRENTLY."""
+        return tuple(m.group(1) for s in self.statements for m in [_CREATED_INDEX.search(s)] if m)
+
+    @property
+    def checksum(self) -> str:
+        body = "\n;\n".join(s.strip() for s in self.statements)
+        return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+MIGRATIONS: List[Migration] = [
+    # Matches what create_all() produced before migrations existed, so
+    # existing databases adopt it as a no-op.
+    Migration(1, "baseline", (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id VARCHAR NOT NULL,
+            first_name VARCHAR NOT NULL,
+            last_name VARCHAR NOT NULL,
+            username VARCHAR NOT NULL,
+            email VARCHAR NOT NULL,
+            profile_pic_path VARCHAR,
+            password_hash VARCHAR NOT NULL,
+            app_data JSONB NOT NULL,
+            travel_visible_to_friends BOOLEAN NOT NULL,
+            is_admin BOOLEAN NOT NULL,
+            is_deleted BOOLEAN NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id)
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_email ON users (email)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_users_username ON users (username)",
+        """
+        CREATE TABLE IF NOT EXISTS activities (
+            id VARCHAR NOT NULL,
+            actor_user_id VARCHAR NOT NULL,
+            type VARCHAR NOT NULL,
+            payload JSONB NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            FOREIGN KEY (actor_user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_activities_expires_at ON activities (expires_at)",
+        "CREATE INDEX IF NOT EXISTS ix_activities_actor_user_id ON activities (actor_user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_activities_type ON activities (type)",
+        """
+        CREATE TABLE IF NOT EXISTS friends (
+            id VARCHAR NOT NULL,
+            user_id VARCHAR NOT NULL,
+            friend_id VARCHAR NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_friend_pair UNIQUE (user_id, friend_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (friend_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_friends_user_id ON friends (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_friends_friend_id ON friends (friend_id)",
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            jti VARCHAR NOT NULL,
+            user_id VARCHAR NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (jti),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires_at ON revoked_tokens (expires_at)",
+        "CREATE INDEX IF NOT EXISTS ix_revoked_tokens_user_id ON revoked_tokens (user_id)",
+        """
+        CREATE TABLE IF NOT EXISTS activity_reactions (
+            id VARCHAR NOT NULL,
+            activity_id VARCHAR NOT NULL,
+            user_id VARCHAR NOT NULL,
+            reaction VARCHAR NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_react_once UNIQUE (activity_id, user_id),
+            FOREIGN KEY (activity_id) REFERENCES activities (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_activity_reactions_user_id ON activity_reactions (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_activity_reactions_activity_id ON activity_reactions (activity_id)",
+    )),
+
+    # Hot-path indexes:
+    # - feed: friends' activities newest first; expires_at rides along so the
+    #   expiry filter is answered from the index
+    # - username/email lookups only ever look at live users
+    # - login's "email = x OR username = x" becomes a BitmapOr of the two
+    #   partial indexes instead of a scan
+    Migration(2, "hot_query_indexes", (
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_activities_actor_created
+            ON activities (actor_user_id, created_at DESC) INCLUDE (expires_at)
+        """,
+        # Superseded by the composite index above (same leading column)
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_activities_actor_user_id",
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_live
+            ON users (username) WHERE is_deleted = false
+        """,
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_email_live
+            ON users (email) WHERE is_deleted = false
+        """,
+    ), concurrent=True),
+
+    # User search (/users/search): trigram matching needs pg_trgm
+    Migration(3, "pg_trgm", (
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    )),
+    Migration(4, "user_search_indexes", (
+        # Substring/trigram match over "username first last" of live users
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_search_trgm
+            ON users USING gin ((lower(username || ' ' || first_name || ' ' || last_name)) gin_trgm_ops)
+            WHERE is_deleted = false
+        """,
+        # Short queries (< 3 chars) have no trigrams; serve them as username prefix scans
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_username_prefix
+            ON users (lower(username) text_pattern_ops)
+            WHERE is_deleted = false
+        """,
+    ), concurrent=True),
+
+    # Lifecycle worker: find soft-deleted accounts due for purging without a scan
+    Migration(5, "deleted_users_index", (
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_deleted
+            ON users (updated_at) WHERE is_deleted = true
+        """,
+    ), concurrent=True),
+
+    # Idempotency-Key support for mutating routes (app/idempotency.py)
+    Migration(6, "idempotency_keys", (
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            id VARCHAR NOT NULL,
+            user_id VARCHAR NOT NULL,
+            idem_key VARCHAR NOT NULL,
+            fingerprint VARCHAR NOT NULL,
+            status_code INTEGER,
+            response_body VARCHAR,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_idempotency_key UNIQUE (user_id, idem_key),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_user_id ON idempotency_keys (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_idempotency_keys_expires_at ON idempotency_keys (expires_at)",
+    )),
+
+    # app_data history (app/data_history.py). The unique (user_id, rev) index
+    # serves every history query. Payloads are already compressed, so TOAST
+    # stores them out of line without trying to compress them again.
+    Migration(7, "app_data_revisions", (
+        """
+        CREATE TABLE IF NOT EXISTS app_data_revisions (
+            id VARCHAR NOT NULL,
+            user_id VARCHAR NOT NULL,
+            rev INTEGER NOT NULL,
+            kind VARCHAR NOT NULL,
+            data BYTEA NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id),
+            CONSTRAINT uq_app_data_rev UNIQUE (user_id, rev),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "ALTER TABLE app_data_revisions ALTER COLUMN data SET STORAGE EXTERNAL",
+    )),
+
+    # Per-user travel counts for the friends leaderboard (app/travel_stats.py).
+    # Filled on app_data writes; users without a row are backfilled on first read.
+    Migration(8, "travel_stats", (
+        """
+        CREATE TABLE IF NOT EXISTS travel_stats (
+            user_id VARCHAR NOT NULL,
+            countries INTEGER NOT NULL,
+            cities INTEGER NOT NULL,
+            continents INTEGER NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+    )),
+
+    # Precomputed friend-of-friend suggestions (app/friend_suggestions.py).
+    # The primary key serves per-user deletes; ix_friend_suggestions_rank the reads.
+    Migration(9, "friend_suggestions", (
+        """
+        CREATE TABLE IF NOT EXISTS friend_suggestions (
+            user_id VARCHAR NOT NULL,
+            candidate_id VARCHAR NOT NULL,
+            mutual INTEGER NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, candidate_id),
+            FOREIGN KEY (user_id) REFERENCES users (id),
+            FOREIGN KEY (candidate_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_friend_suggestions_rank ON friend_suggestions (user_id, mutual DESC)",
+    )),
+
+    # Feed visibility in SQL (app/visibility.py): activities carry their
+    # visibility class; the feed index covers it next to expires_at, and the
+    # actor check is an index-only probe of live users. Existing rows are all
+    # "data_updated", i.e. "travel", the column default.
+    Migration(10, "activity_visibility", (
+        "ALTER TABLE activities ADD COLUMN IF NOT EXISTS visibility VARCHAR NOT NULL DEFAULT 'travel'",
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_activities_actor_feed
+            ON activities (actor_user_id, created_at DESC) INCLUDE (expires_at, visibility)
+        """,
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_activities_actor_created",
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_feed_visible
+            ON users (id) INCLUDE (travel_visible_to_friends) WHERE is_deleted = false
+        """,
+    ), concurrent=True),
+
+    # Storage accounting (app/storage_quota.py): one row per stored blob and a
+    # running total per user; the bytes index serves the heaviest-users report.
+    Migration(11, "storage_usage", (
+        """
+        CREATE TABLE IF NOT EXISTS stored_files (
+            user_id VARCHAR NOT NULL,
+            name VARCHAR NOT NULL,
+            size BIGINT NOT NULL,
+            content_type VARCHAR,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, name),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS storage_usage (
+            user_id VARCHAR NOT NULL,
+            bytes BIGINT NOT NULL DEFAULT 0,
+            files INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            PRIMARY KEY (user_id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_storage_usage_bytes ON storage_usage (bytes DESC)",
+    )),
+
+    # Admin list pages (app/admin.py) walk big tables newest first by seeking
+    # on (sort column, unique id): each needs an index in exactly that order.
+    # The revoked-token one replaces the plain expires_at index (the lifecycle
+    # purge's range scan uses its leading column just the same).
+    Migration(12, "admin_list_indexes", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_activities_created ON activities (created_at, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_activity_reactions_created ON activity_reactions (created_at, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_friends_created ON friends (created_at, id)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_revoked_tokens_expires_jti ON revoked_tokens (expires_at, jti)",
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_revoked_tokens_expires_at",
+    ), concurrent=True),
+
+    # Short-lived access tokens + rotating refresh tokens (app/refresh_tokens.py).
+    # Tokens are looked up by id, families revoked by family_id; created_at
+    # serves the admin list, expires_at the lifecycle purge.
+    Migration(13, "refresh_tokens", (
+        """
+        CREATE TABLE IF NOT EXISTS refresh_tokens (
+            id VARCHAR NOT NULL,
+            family_id VARCHAR NOT NULL,
+            user_id VARCHAR NOT NULL,
+            token_hash VARCHAR NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            used_at TIMESTAMP WITH TIME ZONE,
+            revoked_at TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (id),
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_family ON refresh_tokens (family_id)",
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_user_id ON refresh_tokens (user_id)",
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_expires_at ON refresh_tokens (expires_at)",
+        "CREATE INDEX IF NOT EXISTS ix_refresh_tokens_created ON refresh_tokens (created_at, id)",
+    )),
+
+    # The live-user partial indexes of migration 2 duplicate the unique
+    # ix_users_username / ix_users_email: write cost, no plan uses them.
+    Migration(14, "drop_duplicate_user_indexes", (
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_users_username_live",
+        "DROP INDEX CONCURRENTLY IF EXISTS ix_users_email_live",
+    ), concurrent=True),
+
+    # Blobs stored before migration 11 have no stored_files rows; the lifecycle
+    # worker folds them in once per user (storage_quota.reconcile)
+    Migration(15, "storage_reconciled_at", (
+        "ALTER TABLE storage_usage ADD COLUMN IF NOT EXISTS reconciled_at TIMESTAMP WITH TIME ZONE",
+    )),
+]
+
+
+class SchemaOutOfDate(RuntimeError):
+    pass
+
+
+def _ensure_table(conn: Connection) -> None:
+    conn.exec_driver_sql(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR NOT NULL,
+            checksum VARCHAR NOT NULL,
+            applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+            duration_ms INTEGER NOT NULL DEFAULT 0
+        )
+        """
+    )
+
+
+def _applied(conn: Connection) -> Dict[int, str]:
+    rows = conn.exec_driver_sql("SELECT version, checksum FROM schema_migrations").all()
+    return {r.version: r.checksum for r in rows}
+
+
+def _verify(applied: Dict[int, str]) -> List[Migration]:
+    """Check checksums of applied migrations; return the pending ones in order."""
+    known = {m.version: m for m in MIGRATIONS}
+    for version, checksum in applied.items():
+        m = known.get(version)
+        if m is None:
+            raise SchemaOutOfDate(f"Database has migration {version}, which this code does not know (newer build?)")
+        if m.checksum != checksum:
+            raise SchemaOutOfDate(f"Migration {version} ({m.name}) was edited after it was applied")
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m.version) if m.version not in applied]
+
+
+def _drop_invalid_indexes(conn: Connection, m: Migration) -> None:
+    # A failed CREATE INDEX CONCURRENTLY leaves an INVALID index behind, which
+    # IF NOT EXISTS would then happily skip. Clear those before retrying -
+    # only this migration's own: other invalid indexes may be builds in progress.
+    names = m.built_indexes
+    if not names:
+        return
+    rows = conn.execute(
+        text(
+            """
+            SELECT quote_ident(n.nspname) || '.' || quote_ident(c.relname) AS name
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE NOT i.indisvalid AND n.nspname = current_schema()
+              AND c.relname = ANY(:names)
+            """
+        ),
+        {"names": list(names)},
+    ).all()
+    for r in rows:
+        conn.exec_driver_sql(f"DROP INDEX CONCURRENTLY IF EXISTS {r.name}")
+
+
+def _apply(conn: Connection, m: Migration) -> None:
+    start = time.perf_counter()
+    record = text(
+        "INSERT INTO schema_migrations (version, name, checksum, duration_ms) "
+        "VALUES (:v, :n, :c, :d)"
+    )
+
+    if m.concurrent:
+        _drop_invalid_indexes(conn, m)
+        for stmt in m.statements:
+            conn.exec_driver_sql(stmt)
+        ms = int((time.perf_counter() - start) * 1000)
+        conn.execute(record, {"v": m.version, "n": m.name, "c": m.checksum, "d": ms})
+        return
+
+    conn.exec_driver_sql("BEGIN")
+    try:
+        for stmt in m.statements:
+            conn.exec_driver_sql(stmt)
+        ms = int((time.perf_counter() - start) * 1000)
+        conn.execute(record, {"v": m.version, "n": m.name, "c": m.checksum, "d": ms})
+        conn.exec_driver_sql("COMMIT")
+    except Exception:
+        conn.exec_driver_sql("ROLLBACK")
+        raise
+
+
+def pending_migrations(engine: Engine) -> List[Migration]:
+    with engine.connect() as conn:
+        exists = conn.exec_driver_sql("SELECT to_regclass('schema_migrations') IS NOT NULL").scalar()
+        applied = _applied(conn) if exists else {}
+    return _verify(applied)
+
+
+def _lock(conn: Connection) -> None:
+    # Poll instead of blocking: waiting inside pg_advisory_lock keeps a
+    # transaction open, and the migrating process's CREATE INDEX CONCURRENTLY
+    # waits for every open transaction to finish.
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT_SEC
+    while not conn.execute(text("SELECT pg_try_advisory_lock(:k)"), {"k": MIGRATION_LOCK_KEY}).scalar():
+        if time.monotonic() >= deadline:
+            raise SchemaOutOfDate(f"Another process held the migration lock for over {MIGRATION_LOCK_TIMEOUT_SEC}s")
+        time.sleep(MIGRATION_LOCK_POLL_SEC)
+
+
+def migrate(engine: Engine) -> List[Migration]:
+    """Apply pending migrations in order. Returns what was applied."""
+    # Autocommit connection: CONCURRENTLY cannot run inside a transaction,
+    # and the session-level advisory lock must survive individual COMMITs.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        _lock(conn)
+        try:
+            _ensure_table(conn)
+            # Read after locking: whoever held the lock may have applied some
+            todo = _verify(_applied(conn))
+            for m in todo:
+                _apply(conn, m)
+            return todo
+        finally:
+            conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_KEY})
+
+
+def migrate_or_check(engine: Engine, apply: bool) -> None:
+    """Startup hook: migrate, or fail fast if the schema is behind."""
+    if apply:
+        migrate(engine)
+        return
+    todo = pending_migrations(engine)
+    if todo:
+        names = ", ".join(f"{m.version}:{m.name}" for m in todo)
+        raise SchemaOutOfDate(f"Pending migrations ({names}); run `python -m app.migrations`")
+
+
+if __name__ == "__main__":
+    from .db import engine
+
+    if "--check" in sys.argv:
+        todo = pending_migrations(engine)
+        for m in todo:
+            print(f"pending: {m.version} {m.name}")
+        sys.exit(1 if todo else 0)
+
+    for m in migrate(engine):
+        print(f"applied: {m.version} {m.name}")
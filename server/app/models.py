@@ -1,11 +1,11 @@
 """
 SQLAlchemy ORM models (tables).
 
-No migrations:
-    Base.metadata.create_all(bind=engine) on startup.
+Schema changes are made by migrations (app/migrations.py); keep these
+models in sync with them. Indexes declared here document what exists.
 """
 
-from sqlalchemy import Column, String, Boolean, DateTime, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, String, Boolean, Integer, BigInteger, LargeBinary, DateTime, ForeignKey, UniqueConstraint, Index, text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime, timezone, timedelta
@@ -21,6 +21,28 @@ def utcnow():
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        # /users/search (see migrations 3-4)
+        Index(
+            "ix_users_search_trgm",
+            text("lower(username || ' ' || first_name || ' ' || last_name) gin_trgm_ops"),
+            postgresql_using="gin",
+            postgresql_where=text("is_deleted = false"),
+        ),
+        Index(
+            "ix_users_username_prefix",
+            text("lower(username) text_pattern_ops"),
+            postgresql_where=text("is_deleted = false"),
+        ),
+        # Lifecycle purge of soft-deleted accounts (migration 5)
+        Index("ix_users_deleted", "updated_at", postgresql_where=text("is_deleted = true")),
+        # Feed visibility join against the actor (migration 10)
+        Index(
+            "ix_users_feed_visible", "id",
+            postgresql_include=["travel_visible_to_friends"],
+            postgresql_where=text("is_deleted = false"),
+        ),
+    )
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
 
@@ -49,7 +71,11 @@ class User(Base):
 
 class Friend(Base):
     __tablename__ = "friends"
-    __table_args__ = (UniqueConstraint("user_id", "friend_id", name="uq_friend_pair"),)
+    __table_args__ = (
+        UniqueConstraint("user_id", "friend_id", name="uq_friend_pair"),
+        # Admin list, newest first (migration 12)
+        Index("ix_friends_created", "created_at", "id"),
+    )
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
@@ -59,11 +85,22 @@ class Friend(Base):
 
 class Activity(Base):
     __tablename__ = "activities"
+    __table_args__ = (
+        # Feed: friends' activities newest first; the filter columns ride along (migration 10)
+        Index(
+            "ix_activities_actor_feed",
+            "actor_user_id", text("created_at DESC"),
+            postgresql_include=["expires_at", "visibility"],
+        ),
+        # Admin list, newest first (migration 12)
+        Index("ix_activities_created", "created_at", "id"),
+    )
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    actor_user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    actor_user_id = Column(String, ForeignKey("users.id"), nullable=False)
 
     type = Column(String, index=True, nullable=False)      # e.g. "travel_updated"
+    visibility = Column(String, nullable=False, default="travel", server_default="travel")  # see visibility.py
     payload = Column(JSONB, nullable=False, default=dict)  # details for feed
 
     created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
@@ -72,7 +109,11 @@ class Activity(Base):
 
 class ActivityReaction(Base):
     __tablename__ = "activity_reactions"
-    __table_args__ = (UniqueConstraint("activity_id", "user_id", name="uq_react_once"),)
+    __table_args__ = (
+        UniqueConstraint("activity_id", "user_id", name="uq_react_once"),
+        # Admin list, newest first (migration 12)
+        Index("ix_activity_reactions_created", "created_at", "id"),
+    )
 
     id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
     activity_id = Column(String, ForeignKey("activities.id"), index=True, nullable=False)
@@ -84,10 +125,117 @@ class ActivityReaction(Base):
 
 class RevokedToken(Base):
     """
-    Supports real logout for JWT by revoking token IDs (jti).
+    Revoked token IDs (jti) of the former long-lived JWTs. No longer written
+    (logout revokes refresh token families); old rows expire via lifecycle.
     """
     __tablename__ = "revoked_tokens"
+    # Expiry purge and admin list (migration 12)
+    __table_args__ = (Index("ix_revoked_tokens_expires_jti", "expires_at", "jti"),)
 
     jti = Column(String, primary_key=True)  # token id
     user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class RefreshToken(Base):
+    """Rotating refresh tokens, one family per login (see refresh_tokens.py)."""
+    __tablename__ = "refresh_tokens"
+    __table_args__ = (
+        Index("ix_refresh_tokens_family", "family_id"),
+        Index("ix_refresh_tokens_user_id", "user_id"),
+        Index("ix_refresh_tokens_expires_at", "expires_at"),
+        Index("ix_refresh_tokens_created", "created_at", "id"),
+    )
+
+    id = Column(String, primary_key=True)
+    family_id = Column(String, nullable=False)
+    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    token_hash = Column(String, nullable=False)  # sha256 of the secret part
+    created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    used_at = Column(DateTime(timezone=True), nullable=True)  # rotated: presenting it again is reuse
+    revoked_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class IdempotencyKey(Base):
+    """
+    Idempotency-Key store: the first request with a key reserves the row,
+    its response is saved, and retries with the same key replay it.
+    """
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (UniqueConstraint("user_id", "idem_key", name="uq_idempotency_key"),)
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, ForeignKey("users.id"), index=True, nullable=False)
+    idem_key = Column(String, nullable=False)
+    fingerprint = Column(String, nullable=False)  # sha256 of method, path and body
+
+    # NULL while the first request is still running
+    status_code = Column(Integer, nullable=True)
+    response_body = Column(String, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
     expires_at = Column(DateTime(timezone=True), index=True, nullable=False)
+
+
+class AppDataRevision(Base):
+    """
+    app_data history (see data_history.py): zlib-compressed JSON, either a full
+    snapshot or a delta against the previous revision.
+    """
+    __tablename__ = "app_data_revisions"
+    __table_args__ = (UniqueConstraint("user_id", "rev", name="uq_app_data_rev"),)
+
+    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    user_id = Column(String, ForeignKey("users.id"), nullable=False)
+    rev = Column(Integer, nullable=False)
+    kind = Column(String, nullable=False)  # "snapshot" | "delta"
+    data = Column(LargeBinary, nullable=False)
+    size = Column(Integer, nullable=False)  # compressed bytes
+    created_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class TravelStats(Base):
+    """Visited countries / cities / continents per user, derived from app_data (see travel_stats.py)."""
+    __tablename__ = "travel_stats"
+
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    countries = Column(Integer, nullable=False, default=0)
+    cities = Column(Integer, nullable=False, default=0)
+    continents = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class FriendSuggestion(Base):
+    """Friend-of-friend candidate with its mutual friend count (see friend_suggestions.py)."""
+    __tablename__ = "friend_suggestions"
+    __table_args__ = (Index("ix_friend_suggestions_rank", "user_id", text("mutual DESC")),)
+
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    candidate_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    mutual = Column(Integer, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class StoredFile(Base):
+    """One stored blob ("<user_id>/<name>" in the storage driver), see storage_quota.py."""
+    __tablename__ = "stored_files"
+
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    name = Column(String, primary_key=True)
+    size = Column(BigInteger, nullable=False)
+    content_type = Column(String, nullable=True)
+    updated_at = Column(DateTime(timezone=True), default=utcnow, nullable=False)
+
+
+class StorageUsage(Base):
+    """Running per-user totals of stored_files."""
+    __tablename__ = "storage_usage"
+    __table_args__ = (Index("ix_storage_usage_bytes", text("bytes DESC")),)
+
+    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
+    bytes = Column(BigInteger, nullable=False, default=0, server_default="0")
+    files = Column(Integer, nullable=False, default=0, server_default="0")
+    updated_at = Column(DateTime(timezone=True), default=utcnow, server_default=text("now()"), nullable=False)
+    # Set once the user's existing blobs were folded in (storage_quota.reconcile)
+    reconciled_at = Column(DateTime(timezone=True), nullable=True)
@@ -3,6 +3,8 @@ from collections import deque
 from typing import Deque, Dict, Any
 from fastapi import Request
 
+from .tracing import current_request_id
+
 MAX_LOGS = 200
 
 request_logs: Deque[Dict[str, Any]] = deque(maxlen=MAX_LOGS)
@@ -18,7 +20,8 @@ stats = {
 
 async def monitoring_middleware(request: Request, call_next):
 
-    if request.url.path in ("/monitor/stats", "/monitor/requests", "/admin"):
+    path = request.url.path
+    if path in ("/monitor/stats", "/monitor/requests", "/monitor/traces", "/admin") or path.startswith("/monitor/traces/"):
         return await call_next(request)
 
     start = time.perf_counter()
@@ -42,6 +45,7 @@ async def monitoring_middleware(request: Request, call_next):
     safe_path = path if not path.startswith("/auth") else "/auth/*"
 
     request_logs.appendleft({
+        "request_id": current_request_id(),
         "method": request.method,
         "path": safe_path,
         "status": response.status_code,
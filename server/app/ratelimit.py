@@ -0,0 +1,249 @@
+"""
+Rate limiting + admission control.
+
+Key ideas:
+- token buckets per (route group, user or IP); each bucket is two floats
+- state lives in a backend with a fixed memory bound and O(1) work per request
+  - "memory": per-worker LRU dict (default with a single worker)
+  - "shm": fixed slot table in shared memory, so all gunicorn workers on a
+    host share the same buckets (default when WEB_CONCURRENCY > 1)
+- route groups and their limits come from RATE_LIMITS, e.g.
+    auth=10/60:ip,contacts=10/3600:user,write=60/60:user,default=300/60:user
+  (group=<burst>/<seconds>:<scope>)
+- load shedding: when too many requests are in flight in this worker,
+  new ones get 429 + Retry-After right away instead of queueing
+"""
+
+import fcntl
+import hashlib
+import math
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request
+from fastapi.responses import JSONResponse
+
+from .auth import decode_token
+from .settings import settings
+
+
+@dataclass(frozen=True)
+class Limit:
+    burst: float
+    per_sec: float
+    scope: str  # "user" or "ip"
+
+
+def parse_limits(spec: str) -> Dict[str, Limit]:
+    limits = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        group, rule = part.split("=", 1)
+        rule, _, scope = rule.partition(":")
+        count, seconds = rule.split("/", 1)
+        limits[group.strip()] = Limit(
+            burst=float(count),
+            per_sec=float(count) / float(seconds),
+            scope=(scope or "user").strip(),
+        )
+    return limits
+
+
+# (methods or None for any, path prefix, group) - first match wins
+ROUTE_GROUPS = [
+    ({"POST"}, "/auth/login", "auth"),
+    ({"POST"}, "/auth/register", "auth"),
+    ({"POST"}, "/internal/login", "auth"),
+    ({"POST"}, "/friends/actions/match", "contacts"),
+    ({"PUT", "POST", "PATCH", "DELETE"}, "/data", "write"),
+    ({"PUT", "POST", "PATCH", "DELETE"}, "/files", "write"),
+    ({"PUT", "POST", "PATCH", "DELETE"}, "/friends", "write"),
+    ({"PUT", "POST", "PATCH", "DELETE"}, "/feed", "write"),
+]
+
+UNLIMITED_PREFIXES = ("/health", "/docs", "/doc", "/openapi.json")
+
+# Long-lived streams would pin the in-flight counter
+NOT_IN_FLIGHT = ("/feed/stream",)
+
+
+def route_group(method: str, path: str) -> Optional[str]:
+    if path.startswith(UNLIMITED_PREFIXES):
+        return None
+    for methods, prefix, group in ROUTE_GROUPS:
+        if path.startswith(prefix) and (methods is None or method in methods):
+            return group
+    return "default"
+
+
+def _refill(tokens: float, ts: float, now: float, limit: Limit) -> float:
+    return min(limit.burst, tokens + (now - ts) * limit.per_sec)
+
+
+def _decide(tokens: float, limit: Limit) -> Tuple[bool, float, float]:
+    # -> (allowed, tokens_after, retry_after_sec)
+    if tokens >= 1.0:
+        return True, tokens - 1.0, 0.0
+    return False, tokens, (1.0 - tokens) / limit.per_sec
+
+
+class MemoryBackend:
+    """Per-worker buckets in an LRU dict capped at max_keys."""
+
+    def __init__(self, max_keys: int):
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+
+    def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        now = time.time()
+        with self._lock:
+            tokens, ts = self._buckets.get(key, (limit.burst, now))
+            allowed, tokens, retry = _decide(_refill(tokens, ts, now, limit), limit)
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry
+
+
+class SharedMemoryBackend:
+    """
+    Buckets shared by all workers on the host.
+
+    Fixed table of slots (key hash u64, tokens f64, last update f64), looked up
+    with a short linear probe. On a full probe the least recently touched slot
+    is recycled, so memory never grows. A file lock serializes updates.
+    """
+
+    SLOT = struct.Struct("<Qdd")
+    PROBE = 4
+
+    def __init__(self, name: str, slots: int):
+        self.slots = slots
+        size = self.SLOT.size * slots
+        try:
+            self._shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            self._shm = shared_memory.SharedMemory(name=name)
+        try:
+            # Workers attach and detach; the segment must outlive any one of them.
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self._shm._name, "shared_memory")
+        except Exception:
+            pass
+        self._lock_file = open(os.path.join(tempfile.gettempdir(), f"{name}.lock"), "a+")
+        self._thread_lock = threading.Lock()
+
+    def take(self, key: str, limit: Limit) -> Tuple[bool, float]:
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+        now = time.time()
+        buf = self._shm.buf
+        with self._thread_lock:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                slot = None
+                oldest, oldest_ts = None, math.inf
+                for i in range(self.PROBE):
+                    idx = (h + i) % self.slots
+                    kh, tokens, ts = self.SLOT.unpack_from(buf, idx * self.SLOT.size)
+                    if kh == h:
+                        slot = idx
+                        break
+                    if kh == 0 or ts < oldest_ts:
+                        oldest, oldest_ts = idx, (-1.0 if kh == 0 else ts)
+
+                if slot is None:
+                    slot, tokens, ts = oldest, limit.burst, now
+
+                allowed, tokens, retry = _decide(_refill(tokens, ts, now, limit), limit)
+                self.SLOT.pack_into(buf, slot * self.SLOT.size, h, tokens, now)
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        return allowed, retry
+
+
+def _make_backend():
+    if settings.rate_limit_backend == "shm":
+        return SharedMemoryBackend(settings.rate_limit_shm_name, settings.rate_limit_max_keys)
+    return MemoryBackend(settings.rate_limit_max_keys)
+
+
+limits = parse_limits(settings.rate_limits)
+# a RATE_LIMITS without "contacts" keeps contact matching as strict as writes
+if "contacts" not in limits and "write" in limits:
+    limits["contacts"] = limits["write"]
+
+_backend = None
+_inflight = 0
+_inflight_lock = threading.Lock()
+
+rate_limit_stats = {"limited": 0, "shed": 0}
+
+
+def _backend_instance():
+    global _backend
+    if _backend is None:
+        _backend = _make_backend()
+    return _backend
+
+
+def _client_key(request: Request, scope: str) -> str:
+    if scope == "user":
+        auth = request.headers.get("authorization", "")
+        if auth.lower().startswith("bearer "):
+            try:
+                sub = decode_token(auth.split(" ", 1)[1].strip()).get("sub")
+                if sub:
+                    return f"u:{sub}"
+            except Exception:
+                pass
+    host = request.client.host if request.client else "unknown"
+    return f"ip:{host}"
+
+
+def _too_many(retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        {"detail": "Too many requests"},
+        status_code=429,
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+async def rate_limit_middleware(request: Request, call_next):
+    global _inflight
+
+    if not settings.rate_limit_enabled:
+        return await call_next(request)
+
+    path = request.url.path
+    group = route_group(request.method, path)
+    limit = limits.get(group) if group else None
+    if limit is not None:
+        allowed, retry = _backend_instance().take(f"{group}:{_client_key(request, limit.scope)}", limit)
+        if not allowed:
+            rate_limit_stats["limited"] += 1
+            return _too_many(retry)
+
+    if settings.max_inflight <= 0 or path.startswith(NOT_IN_FLIGHT):
+        return await call_next(request)
+
+    with _inflight_lock:
+        if _inflight >= settings.max_inflight:
+            rate_limit_stats["shed"] += 1
+            return _too_many(1)
+        _inflight += 1
+    try:
+        return await call_next(request)
+    finally:
+        with _inflight_lock:
+            _inflight -= 1
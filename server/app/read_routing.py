@@ -0,0 +1,189 @@
+"""
+Read/write routing between the primary and an optional read replica.
+
+Key ideas:
+- write routes keep using get_db (primary); read-only routes use get_read_db,
+  which hands out a replica session when that is safe and a primary session
+  otherwise
+- read-your-writes: a session that writes on behalf of a user makes that user
+  "sticky" for REPLICA_STICKY_SEC, so their next reads go to the primary.
+  The mark is sent with NOTIFY in the writing transaction, so every worker
+  sees it, not just the one that handled the write
+- users whose friend list changed are made sticky the same way
+- a background thread measures replica lag; while the replica is unreachable
+  or further behind than REPLICA_MAX_LAG_SEC, all reads go to the primary
+- with no replica configured get_read_db is just get_db (nothing else runs)
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from fastapi import Request
+from jose import jwt
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal, ReadSessionLocal, read_engine
+from .feed_hub import listen, notify
+from .settings import settings
+from .tracing import traced_checkout
+
+log = logging.getLogger(__name__)
+
+READ_STICKY_CHANNEL = "read_sticky"
+MAX_STICKY_USERS = 100_000
+
+_LAG_SQL = text(
+    "SELECT CASE "
+    "WHEN NOT pg_is_in_recovery() THEN 0 "
+    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class ReadRouter:
+    def __init__(self, max_lag_sec: float, sticky_sec: float, check_sec: float):
+        self.enabled = ReadSessionLocal is not None
+        self.max_lag_sec = max_lag_sec
+        self.sticky_sec = sticky_sec
+        self.check_sec = check_sec
+        self._lock = threading.Lock()
+        # user_id -> monotonic time until which their reads go to the primary
+        self._sticky: "OrderedDict[str, float]" = OrderedDict()
+        self._healthy = False
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"replica_reads": 0, "primary_reads": 0, "sticky_hits": 0, "lag_sec": None, "healthy": False}
+
+    # -------- stickiness --------
+
+    def mark_sticky(self, user_ids: Iterable[str]) -> None:
+        if not self.enabled:
+            return
+        until = time.monotonic() + self.sticky_sec
+        with self._lock:
+            for uid in user_ids:
+                self._sticky[uid] = until
+                self._sticky.move_to_end(uid)
+            while len(self._sticky) > MAX_STICKY_USERS:
+                self._sticky.popitem(last=False)
+
+    def is_sticky(self, user_id: Optional[str]) -> bool:
+        if not user_id:
+            return False
+        with self._lock:
+            until = self._sticky.get(user_id)
+            if until is None:
+                return False
+            if until < time.monotonic():
+                del self._sticky[user_id]
+                return False
+            return True
+
+    # -------- routing --------
+
+    def session_for(self, user_id: Optional[str]) -> Session:
+        if self.enabled and self._healthy:
+            if not self.is_sticky(user_id):
+                self.stats["replica_reads"] += 1
+                db = ReadSessionLocal()
+                db.info["replica"] = True
+                return db
+            self.stats["sticky_hits"] += 1
+        self.stats["primary_reads"] += 1
+        return SessionLocal()
+
+    # -------- lag monitor --------
+
+    def check_lag(self) -> None:
+        try:
+            with read_engine.connect() as conn:
+                lag = float(conn.execute(_LAG_SQL).scalar() or 0.0)
+        except Exception:
+            if self._healthy:
+                log.warning("Read replica unreachable; routing reads to the primary", exc_info=True)
+            self._healthy = False
+            self.stats.update(healthy=False, lag_sec=None)
+            return
+        healthy = lag <= self.max_lag_sec
+        if healthy != self._healthy:
+            log.info("Read replica %s (lag %.2fs)", "in use" if healthy else "lagging, using primary", lag)
+        self._healthy = healthy
+        self.stats.update(healthy=healthy, lag_sec=round(lag, 3))
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self.check_lag()
+            self._stop_event.wait(self.check_sec)
+
+    def start(self) -> None:
+        if not self.enabled or self._thread is not None:
+            return
+        self._stop_event.clear()
+        self.check_lag()
+        self._thread = threading.Thread(target=self._run, name="replica-lag", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+
+
+read_router = ReadRouter(settings.replica_max_lag_sec, settings.replica_sticky_sec, settings.replica_check_sec)
+
+
+def _request_user_id(request: Request) -> Optional[str]:
+    # Only picks a pool; the token is verified by the route's auth dependency
+    auth = request.headers.get("authorization", "")
+    if not auth.lower().startswith("bearer "):
+        return None
+    try:
+        return jwt.get_unverified_claims(auth.split(" ", 1)[1].strip()).get("sub")
+    except Exception:
+        return None
+
+
+def get_read_db(request: Request):
+    """
+    FastAPI dependency for read-only routes:
+    replica session unless the caller just wrote or the replica is unhealthy.
+    """
+    db = read_router.session_for(_request_user_id(request))
+    try:
+        traced_checkout(db)
+        yield db
+    finally:
+        db.close()
+
+
+if read_router.enabled:
+    # Sessions learn their user from get_principal_write / get_current_user (db.info["user_id"]).
+    @event.listens_for(SessionLocal, "before_commit")
+    def _announce_write(session: Session) -> None:
+        user_id = session.info.get("user_id")
+        if user_id and (session.info.get("wrote") or session.new or session.dirty or session.deleted):
+            session.info["wrote"] = True
+            notify(session, READ_STICKY_CHANNEL, {"user_ids": [user_id]})
+
+    @event.listens_for(SessionLocal, "after_flush")
+    def _flushed(session: Session, _ctx) -> None:
+        session.info["wrote"] = True
+
+    @event.listens_for(SessionLocal, "do_orm_execute")
+    def _executed(state) -> None:
+        if state.is_insert or state.is_update or state.is_delete:
+            state.session.info["wrote"] = True
+
+    @event.listens_for(SessionLocal, "after_commit")
+    def _sticky_locally(session: Session) -> None:
+        # Don't wait for our own NOTIFY to come back
+        if session.info.pop("wrote", False) and session.info.get("user_id"):
+            read_router.mark_sticky([session.info["user_id"]])
+
+    listen(READ_STICKY_CHANNEL, lambda msg: read_router.mark_sticky(msg.get("user_ids") or []))
@@ -0,0 +1,142 @@
+"""
+Rotating refresh tokens (POST /auth/refresh) with reuse detection.
+
+Key ideas:
+- access tokens are short-lived JWTs checked without the database (auth.py);
+  staying logged in goes through refresh tokens, which live server-side
+- a refresh token is "<id>.<secret>"; only a SHA-256 of the secret is stored,
+  and the row is found by primary key
+- every login starts a family; each refresh marks the presented token used
+  and issues the next one in the same family
+- a successor is derived from the token it replaces (HMAC with the server
+  secret), so it can be handed out again without storing it: a token
+  presented again within REFRESH_REUSE_GRACE_SEC of its use (parallel
+  requests that all got 401 and all refresh) gets the same successor
+- presenting a used token after that means two parties hold the same chain
+  (stolen token, or a replay): the whole family is revoked, so both the
+  thief and the victim have to log in again
+- logout revokes the family named in the access token (its "fam" claim);
+  access tokens already issued stay valid until they expire
+  (ACCESS_TOKEN_EXPIRES_MIN)
+- the row of the presented token is locked while it is rotated, so two
+  concurrent refreshes with one token cannot both succeed
+"""
+
+import base64
+import hashlib
+import hmac
+import secrets
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+from sqlalchemy import update
+from sqlalchemy.orm import Session
+
+from .models import RefreshToken, User
+from .settings import settings
+
+refresh_stats = {"issued": 0, "rotated": 0, "grace_reused": 0, "reused": 0, "families_revoked": 0}
+
+
+class InvalidRefreshToken(Exception):
+    pass
+
+
+class RefreshTokenReused(InvalidRefreshToken):
+    pass
+
+
+def _hash(secret: str) -> str:
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+def _successor(raw: str) -> Tuple[str, str]:
+    """(id, secret) of the token that replaces `raw`; only the server can compute it."""
+    digest = hmac.new(settings.jwt_secret.encode(), b"refresh:" + raw.encode(), hashlib.sha512).digest()
+    return digest[:16].hex(), base64.urlsafe_b64encode(digest[16:48]).rstrip(b"=").decode()
+
+
+def issue(db: Session, user_id: str, family_id: Optional[str] = None, parent: Optional[str] = None) -> Tuple[str, str]:
+    """
+    New refresh token (raw value, family id); a new family unless one is given.
+    With `parent` (the raw token being rotated) the token is its successor. Caller commits.
+    """
+    now = datetime.now(timezone.utc)
+    if parent is not None:
+        token_id, secret = _successor(parent)
+    else:
+        token_id, secret = uuid.uuid4().hex, secrets.token_urlsafe(32)
+    family_id = family_id or uuid.uuid4().hex
+    db.add(RefreshToken(
+        id=token_id,
+        family_id=family_id,
+        user_id=user_id,
+        token_hash=_hash(secret),
+        created_at=now,
+        expires_at=now + timedelta(days=settings.refresh_token_expires_days),
+    ))
+    refresh_stats["issued"] += 1
+    return f"{token_id}.{secret}", family_id
+
+
+def revoke_family(db: Session, family_id: str, user_id: Optional[str] = None) -> int:
+    """Revoke every live token of a family (optionally only if it is `user_id`'s). Caller commits."""
+    stmt = (
+        update(RefreshToken)
+        .where(RefreshToken.family_id == family_id, RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=datetime.now(timezone.utc))
+    )
+    if user_id is not None:
+        stmt = stmt.where(RefreshToken.user_id == user_id)
+    n = db.execute(stmt).rowcount
+    if n:
+        refresh_stats["families_revoked"] += 1
+    return n
+
+
+def rotate(db: Session, raw: str) -> Tuple[User, str, str]:
+    """
+    Exchange a refresh token for the next one: (user, new raw token, family id).
+    Commits. Raises InvalidRefreshToken, or RefreshTokenReused after revoking the family.
+    """
+    token_id, _, secret = (raw or "").partition(".")
+    if not token_id or not secret:
+        raise InvalidRefreshToken("Malformed refresh token")
+
+    row = db.query(RefreshToken).filter(RefreshToken.id == token_id).with_for_update().first()
+    if row is None or not hmac.compare_digest(row.token_hash, _hash(secret)):
+        raise InvalidRefreshToken("Unknown refresh token")
+    if row.revoked_at is not None:
+        raise InvalidRefreshToken("Refresh token revoked")
+
+    now = datetime.now(timezone.utc)
+    if row.used_at is not None and now - row.used_at <= timedelta(seconds=settings.refresh_reuse_grace_sec):
+        # A concurrent refresh with the same token: hand out the same successor
+        successor_id, successor_secret = _successor(raw)
+        successor = db.get(RefreshToken, successor_id)
+        user = db.query(User).filter(User.id == row.user_id, User.is_deleted == False).first()  # noqa: E712
+        db.commit()  # nothing changed; ends the transaction and the row lock
+        if successor is None or successor.revoked_at is not None or user is None:
+            raise InvalidRefreshToken("Refresh token revoked")
+        refresh_stats["grace_reused"] += 1
+        return user, f"{successor_id}.{successor_secret}", row.family_id
+    if row.used_at is not None:
+        revoke_family(db, row.family_id)
+        db.commit()
+        refresh_stats["reused"] += 1
+        raise RefreshTokenReused("Refresh token reuse detected; all sessions of this login were revoked")
+    if row.expires_at <= now:
+        raise InvalidRefreshToken("Refresh token expired")
+
+    user = db.query(User).filter(User.id == row.user_id, User.is_deleted == False).first()  # noqa: E712
+    if user is None:
+        revoke_family(db, row.family_id)
+        db.commit()
+        raise InvalidRefreshToken("User not found")
+
+    row.used_at = now
+    new_raw, family_id = issue(db, user.id, row.family_id, parent=raw)
+    db.commit()
+    refresh_stats["rotated"] += 1
+    return user, new_raw, family_id
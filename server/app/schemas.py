@@ -23,6 +23,12 @@ class UserLogin(BaseModel):
 class TokenResponse(BaseModel):
     access_token: str
     token_type: str = "bearer"
+    expires_in: int  # seconds until access_token expires
+    refresh_token: str
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 # -------------------------
@@ -49,6 +55,12 @@ class UserPublic(BaseModel):
     travel_visible_to_friends: bool
 
 
+class UserSearchResult(BaseModel):
+    items: List[UserPublic]
+    # pass as ?after= to get the next page (None = no more results)
+    next_after: Optional[str] = None
+
+
 # -------------------------
 # App Data
 # -------------------------
@@ -62,6 +74,35 @@ class AppDataUpdate(BaseModel):
     app_data: Dict[str, Any]
 
 
+# -------------------------
+# Friends
+# -------------------------
+
+class FriendBulkRequest(BaseModel):
+    usernames: List[str] = Field(min_length=1, max_length=500)
+
+
+class FriendBulkResult(BaseModel):
+    usernames: List[str]
+    not_found: List[str]
+
+
+class ContactMatchRequest(BaseModel):
+    # contact-import style matching: any mix of usernames and emails,
+    # kept small so one call can't probe a large list of addresses
+    usernames: List[str] = Field(default_factory=list, max_length=100)
+    emails: List[str] = Field(default_factory=list, max_length=100)
+
+
+class ContactMatch(BaseModel):
+    id: str
+    username: str
+    first_name: str
+    last_name: str
+    profile_pic_path: Optional[str] = None
+    is_friend: bool
+
+
 # -------------------------
 # Feed
 # -------------------------
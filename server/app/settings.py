@@ -8,6 +8,7 @@ We keep all environment variable reading here so:
 """
 
 import os
+from pathlib import Path
 from pydantic import BaseModel
 
 
@@ -24,18 +25,141 @@ class Settings(BaseModel):
 
     # JWT config
     jwt_secret: str = os.getenv("JWT_SECRET", "change_me")
-    jwt_expires_min: int = int(os.getenv("JWT_EXPIRES_MIN", "10080"))
+    # Access tokens are checked without the DB, so they are short-lived;
+    # refresh tokens (rotated on every use) keep a login alive
+    access_token_expires_min: int = int(os.getenv("ACCESS_TOKEN_EXPIRES_MIN", "15"))
+    refresh_token_expires_days: int = int(os.getenv("REFRESH_TOKEN_EXPIRES_DAYS", "30"))
+    # A just-used refresh token still yields its successor this long (parallel refreshes)
+    refresh_reuse_grace_sec: int = int(os.getenv("REFRESH_REUSE_GRACE_SEC", "10"))
 
     # CORS configuration (comma-separated list)
     cors_origins: str = os.getenv("CORS_ORIGINS", "*")
 
-    # File storage root directory
+    # File storage: "local" (STORAGE_DIR) or "s3" (any S3-compatible service)
+    storage_backend: str = os.getenv("STORAGE_BACKEND", "local")
     storage_dir: str = os.getenv("STORAGE_DIR", "/data/storage")
+    s3_bucket: str = os.getenv("S3_BUCKET", "")
+    # e.g. http://minio:9000 for a local stand-in (empty = AWS)
+    s3_endpoint_url: str = os.getenv("S3_ENDPOINT_URL", "")
+    s3_region: str = os.getenv("S3_REGION", "")
+    s3_access_key: str = os.getenv("S3_ACCESS_KEY", "")
+    s3_secret_key: str = os.getenv("S3_SECRET_KEY", "")
+    s3_part_size_mb: int = int(os.getenv("S3_PART_SIZE_MB", "8"))
+    s3_upload_concurrency: int = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+    s3_max_pool_connections: int = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "20"))
+    # Per-user limits (0 = unlimited)
+    storage_quota_mb: int = int(os.getenv("STORAGE_QUOTA_MB", "500"))
+    storage_max_files: int = int(os.getenv("STORAGE_MAX_FILES", "1000"))
 
     # Optional "seed admin" values (for quick bootstrap)
     admin_email: str = os.getenv("ADMIN_EMAIL", "")
     admin_password: str = os.getenv("ADMIN_PASSWORD", "")
 
+    # DB connection pool (per worker); prewarm opens that many connections at worker boot
+    db_pool_size: int = int(os.getenv("DB_POOL_SIZE", "5"))
+    db_max_overflow: int = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+    db_pool_prewarm: int = int(os.getenv("DB_POOL_PREWARM", "2"))
+
+    # Optional read replica (empty host = all reads go to the primary)
+    postgres_replica_host: str = os.getenv("POSTGRES_REPLICA_HOST", "")
+    postgres_replica_port: int = int(os.getenv("POSTGRES_REPLICA_PORT", os.getenv("POSTGRES_PORT", "5432")))
+    # Reads fall back to the primary while the replica is further behind than this
+    replica_max_lag_sec: float = float(os.getenv("REPLICA_MAX_LAG_SEC", "2"))
+    # After a user's own write, their reads stay on the primary this long
+    replica_sticky_sec: float = float(os.getenv("REPLICA_STICKY_SEC", "5"))
+    replica_check_sec: float = float(os.getenv("REPLICA_CHECK_SEC", "1"))
+
+    # Import sqladmin (admin UI) on the first /admin request instead of at boot
+    lazy_admin_ui: bool = os.getenv("LAZY_ADMIN_UI", "1") == "1"
+
+    # /users/search first-page cache (per worker)
+    search_cache_size: int = int(os.getenv("SEARCH_CACHE_SIZE", "1024"))
+    search_cache_ttl_sec: float = float(os.getenv("SEARCH_CACHE_TTL_SEC", "30"))
+
+    # Apply pending schema migrations on boot; if off, boot fails when the schema is behind
+    migrate_on_startup: bool = os.getenv("MIGRATE_ON_STARTUP", "1") == "1"
+
+    # Feed push (/feed/stream over SSE, fan-out via Postgres LISTEN/NOTIFY)
+    feed_push_enabled: bool = os.getenv("FEED_PUSH_ENABLED", "1") == "1"
+    feed_heartbeat_sec: float = float(os.getenv("FEED_HEARTBEAT_SEC", "15"))
+    feed_queue_size: int = int(os.getenv("FEED_QUEUE_SIZE", "100"))
+
+    # /monitor: one shared stats snapshot per worker, pushed to open pages over SSE
+    monitor_snapshot_sec: float = float(os.getenv("MONITOR_SNAPSHOT_SEC", "2"))
+    monitor_push_sec: float = float(os.getenv("MONITOR_PUSH_SEC", "2"))
+
+    # Write-behind activity ingestion (coalescing window + flush cadence)
+    activity_coalesce_sec: float = float(os.getenv("ACTIVITY_COALESCE_SEC", "30"))
+    activity_flush_sec: float = float(os.getenv("ACTIVITY_FLUSH_SEC", "5"))
+    activity_max_pending: int = int(os.getenv("ACTIVITY_MAX_PENDING", "5000"))
+
+    # Rate limiting: "<group>=<burst>/<seconds>:<user|ip>,..." (see app/ratelimit.py)
+    rate_limit_enabled: bool = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+    rate_limits: str = os.getenv("RATE_LIMITS", "auth=10/60:ip,contacts=10/3600:user,write=60/60:user,default=600/60:user")
+    # memory | shm. "memory" buckets are per worker, so with N gunicorn workers a
+    # client effectively gets N times each limit; default to shm when forking.
+    rate_limit_backend: str = os.getenv(
+        "RATE_LIMIT_BACKEND", "shm" if int(os.getenv("WEB_CONCURRENCY", "1")) > 1 else "memory"
+    )
+    rate_limit_max_keys: int = int(os.getenv("RATE_LIMIT_MAX_KEYS", "65536"))
+    rate_limit_shm_name: str = os.getenv("RATE_LIMIT_SHM_NAME", "beenaround_ratelimit")
+
+    # Load shedding: max concurrent requests per worker before answering 429 (0 = off)
+    max_inflight: int = int(os.getenv("MAX_INFLIGHT", "200"))
+
+    # Per-worker friend adjacency cache
+    friend_cache_size: int = int(os.getenv("FRIEND_CACHE_SIZE", "10000"))
+    friend_cache_ttl_sec: float = float(os.getenv("FRIEND_CACHE_TTL_SEC", "300"))
+
+    # Server-rendered map images (GET /users/{username}/map.png)
+    # Defaults to the app's assets/maps/world.svg (/assets/maps in the container)
+    map_svg_path: str = os.getenv(
+        "MAP_SVG_PATH", str(Path(__file__).resolve().parents[2] / "assets" / "maps" / "world.svg")
+    )
+    map_cache_dir: str = os.getenv("MAP_CACHE_DIR", "/data/map-cache")
+    map_cache_max_mb: int = int(os.getenv("MAP_CACHE_MAX_MB", "256"))
+    map_render_processes: int = int(os.getenv("MAP_RENDER_PROCESSES", "2"))
+    # Renders allowed to wait per worker before requests get 503
+    map_render_queue: int = int(os.getenv("MAP_RENDER_QUEUE", "16"))
+    map_max_px: int = int(os.getenv("MAP_MAX_PX", "4096"))
+
+    # Per-worker friends leaderboard cache (entries are also dropped on change)
+    leaderboard_cache_size: int = int(os.getenv("LEADERBOARD_CACHE_SIZE", "10000"))
+    leaderboard_cache_ttl_sec: float = float(os.getenv("LEADERBOARD_CACHE_TTL_SEC", "300"))
+
+    # app_data history: full snapshot every N revisions; older chains pruned
+    history_snapshot_every: int = int(os.getenv("HISTORY_SNAPSHOT_EVERY", "20"))
+    history_max_revisions: int = int(os.getenv("HISTORY_MAX_REVISIONS", "200"))
+    history_retention_days: int = int(os.getenv("HISTORY_RETENTION_DAYS", "90"))
+
+    # Idempotency-Key replay window and per-worker response cache
+    idempotency_enabled: bool = os.getenv("IDEMPOTENCY_ENABLED", "1") == "1"
+    idempotency_ttl_sec: int = int(os.getenv("IDEMPOTENCY_TTL_SEC", "86400"))
+    idempotency_cache_size: int = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+    idempotency_max_response_bytes: int = int(os.getenv("IDEMPOTENCY_MAX_RESPONSE_BYTES", "65536"))
+
+    # Request tracing: fraction of requests traced (0 = only forced ones, see below)
+    trace_sample_rate: float = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+    trace_store_size: int = int(os.getenv("TRACE_STORE_SIZE", "200"))
+    # Honour "X-Trace: 1" from clients (debugging only: anyone can send it)
+    trace_header_enabled: bool = os.getenv("TRACE_HEADER_ENABLED", "0") == "1"
+    # OTLP/HTTP JSON endpoint, e.g. http://localhost:4318/v1/traces (empty = no export)
+    trace_otlp_endpoint: str = os.getenv("TRACE_OTLP_ENDPOINT", "")
+    trace_service_name: str = os.getenv("TRACE_SERVICE_NAME", "server-api")
+
+    # Background data lifecycle: purge deleted accounts, expired rows, orphaned files
+    lifecycle_enabled: bool = os.getenv("LIFECYCLE_ENABLED", "1") == "1"
+    lifecycle_interval_sec: float = float(os.getenv("LIFECYCLE_INTERVAL_SEC", "300"))
+    lifecycle_purge_after_hours: float = float(os.getenv("LIFECYCLE_PURGE_AFTER_HOURS", "72"))
+    lifecycle_batch_size: int = int(os.getenv("LIFECYCLE_BATCH_SIZE", "1000"))
+    lifecycle_users_per_run: int = int(os.getenv("LIFECYCLE_USERS_PER_RUN", "50"))
+
+    # Friend-of-friend suggestions: periodic full rebuild plus updates on friend changes
+    suggestions_enabled: bool = os.getenv("SUGGESTIONS_ENABLED", "1") == "1"
+    suggestions_interval_sec: float = float(os.getenv("SUGGESTIONS_INTERVAL_SEC", "3600"))
+    suggestions_per_user: int = int(os.getenv("SUGGESTIONS_PER_USER", "50"))
+    suggestions_batch_users: int = int(os.getenv("SUGGESTIONS_BATCH_USERS", "500"))
+
     @property
     def database_url(self) -> str:
         """
@@ -48,6 +172,24 @@ class Settings(BaseModel):
             f"@{self.postgres_host}:{self.postgres_port}/{self.postgres_db}"
         )
 
+    @property
+    def replica_database_url(self) -> str:
+        return (
+            f"postgresql+psycopg://{self.postgres_user}:{self.postgres_password}"
+            f"@{self.postgres_replica_host}:{self.postgres_replica_port}/{self.postgres_db}"
+        )
+
+    @property
+    def database_dsn(self) -> str:
+        """
+        Plain libpq connection string, for raw psycopg connections
+        (e.g. the LISTEN connection used by the feed hub).
+        """
+        return (
+            f"postgresql://{self.postgres_user}:{self.postgres_password}"
+            f"@{self.postgres_host}:{self.postgres_port}/{self.postgres_db}"
+        )
+
 
 # A single settings instance used across the app
 settings = Settings()
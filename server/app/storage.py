@@ -1,46 +1,258 @@
 """
-File storage helpers.
+Blob storage behind a small async driver interface.
 
-We keep file handling in its own module so you can later replace it with:
-- S3 storage
-- Azure Blob storage
-- GCS
-without touching endpoints much.
+Key ideas:
+- endpoints and jobs address blobs by key ("<user_id>/<name>"), never by
+  path; STORAGE_BACKEND picks the driver: "local" (files under STORAGE_DIR)
+  or "s3" (any S3-compatible service, see storage_s3.py), so several API
+  nodes can share uploads without a shared volume
+- put() consumes an async iterator of chunks and get() yields chunks, so
+  uploads and downloads are never held in memory whole
+- local driver: blocking filesystem calls run in a thread, never on the
+  event loop; writes go to a temp file that is renamed into place, so
+  readers never see half a file
+- sync code (export/import, the lifecycle thread) calls the same drivers
+  through run_sync() / iter_sync(), which run the coroutines on one
+  background event loop per worker
 """
 
-from pathlib import Path
-from fastapi import UploadFile
+import asyncio
+import os
+import shutil
+import threading
+import uuid
+from dataclasses import dataclass
+from pathlib import Path, PurePosixPath
+from typing import AsyncIterator, Awaitable, Iterator, List, Optional, TypeVar
+
 import aiofiles
+from fastapi import UploadFile
 
 from .settings import settings
 
+CHUNK_SIZE = 1024 * 1024
+
+T = TypeVar("T")
+
+
+@dataclass(frozen=True)
+class StoredObject:
+    key: str
+    size: int
+    modified: float  # unix time
+    etag: Optional[str] = None
+
+
+def safe_name(name: Optional[str]) -> str:
+    """Last path component of a client-supplied file name; rejects empty / dot names."""
+    base = PurePosixPath((name or "").replace("\\", "/")).name
+    if base in ("", ".", ".."):
+        raise ValueError("Invalid file name")
+    return base
+
+
+def object_key(user_id: str, name: str) -> str:
+    return f"{user_id}/{safe_name(name)}"
+
+
+async def upload_chunks(file: UploadFile, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class Storage:
+    """Driver interface. Missing keys raise FileNotFoundError (get) or return None (stat)."""
+
+    async def ensure(self) -> None:
+        """Create the root directory / bucket if needed."""
+        raise NotImplementedError
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None) -> StoredObject:
+        raise NotImplementedError
+
+    def get(self, key: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+    async def stat(self, key: str) -> Optional[StoredObject]:
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def list(self, prefix: str) -> List[StoredObject]:
+        raise NotImplementedError
+
+    async def delete_prefix(self, prefix: str) -> int:
+        raise NotImplementedError
+
+    async def prefixes(self) -> List[str]:
+        """Top-level key prefixes (one per user)."""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Release connections held for the running event loop."""
+
+
+class LocalStorage(Storage):
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    def _path(self, key: str) -> Path:
+        parts = PurePosixPath(key).parts
+        if not parts or any(p in ("", ".", "..", "/") for p in parts):
+            raise ValueError(f"Invalid storage key: {key!r}")
+        return self.root.joinpath(*parts)
+
+    def _stat(self, key: str, path: Path) -> Optional[StoredObject]:
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        return StoredObject(key, st.st_size, st.st_mtime)
+
+    async def ensure(self) -> None:
+        await asyncio.to_thread(self.root.mkdir, parents=True, exist_ok=True)
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None) -> StoredObject:
+        path = self._path(key)
+        await asyncio.to_thread(path.parent.mkdir, parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            async with aiofiles.open(tmp, "wb") as out:
+                async for chunk in chunks:
+                    await out.write(chunk)
+            await asyncio.to_thread(os.replace, tmp, path)
+        except BaseException:
+            await asyncio.to_thread(tmp.unlink, missing_ok=True)
+            raise
+        return await asyncio.to_thread(self._stat, key, path)
+
+    async def get(self, key: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        async with aiofiles.open(self._path(key), "rb") as src:
+            while True:
+                chunk = await src.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def stat(self, key: str) -> Optional[StoredObject]:
+        return await asyncio.to_thread(self._stat, key, self._path(key))
+
+    async def delete(self, key: str) -> None:
+        await asyncio.to_thread(self._path(key).unlink, missing_ok=True)
+
+    def _list(self, prefix: str) -> List[StoredObject]:
+        base = self._path(prefix.rstrip("/"))
+        if not base.is_dir():
+            return []
+        out = []
+        for p in sorted(base.rglob("*")):
+            # Skip in-flight writes
+            if p.is_file() and not (p.name.startswith(".") and p.name.endswith(".tmp")):
+                st = p.stat()
+                out.append(StoredObject(p.relative_to(self.root).as_posix(), st.st_size, st.st_mtime))
+        return out
+
+    async def list(self, prefix: str) -> List[StoredObject]:
+        return await asyncio.to_thread(self._list, prefix)
+
+    def _delete_prefix(self, prefix: str) -> int:
+        n = len(self._list(prefix))
+        shutil.rmtree(self._path(prefix.rstrip("/")), ignore_errors=True)
+        return n
+
+    async def delete_prefix(self, prefix: str) -> int:
+        return await asyncio.to_thread(self._delete_prefix, prefix)
+
+    def _prefixes(self) -> List[str]:
+        if not self.root.is_dir():
+            return []
+        return sorted(p.name for p in self.root.iterdir() if p.is_dir())
+
+    async def prefixes(self) -> List[str]:
+        return await asyncio.to_thread(self._prefixes)
+
+
+def _create() -> Storage:
+    if settings.storage_backend == "s3":
+        from .storage_s3 import S3Storage
+        return S3Storage(
+            bucket=settings.s3_bucket,
+            endpoint_url=settings.s3_endpoint_url or None,
+            region=settings.s3_region or None,
+            access_key=settings.s3_access_key or None,
+            secret_key=settings.s3_secret_key or None,
+            part_size=settings.s3_part_size_mb * 1024 * 1024,
+            concurrency=settings.s3_upload_concurrency,
+            max_pool_connections=settings.s3_max_pool_connections,
+        )
+    if settings.storage_backend == "local":
+        return LocalStorage(settings.storage_dir)
+    raise ValueError(f"Unknown STORAGE_BACKEND: {settings.storage_backend!r}")
+
+
+storage = _create()
+
+
+# -------- sync bridge --------
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop() -> asyncio.AbstractEventLoop:
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="storage-io", daemon=True)
+            _loop_thread.start()
+        return _loop
+
 
-def ensure_storage_dir() -> Path:
-    """
-    Ensure the storage directory exists (create if missing).
-    Called on app startup.
-    """
-    root = Path(settings.storage_dir)
-    root.mkdir(parents=True, exist_ok=True)
-    return root
+def run_sync(aw: Awaitable[T]) -> T:
+    """Run a storage coroutine from sync code (never from the event loop itself)."""
+    async def _run():
+        return await aw
+    return asyncio.run_coroutine_threadsafe(_run(), _background_loop()).result()
 
 
-async def save_upload(file: UploadFile, subdir: str = "") -> Path:
-    """
-    Save an uploaded file to disk.
+def iter_sync(chunks: AsyncIterator[bytes]) -> Iterator[bytes]:
+    """Iterate an async chunk stream (e.g. storage.get(...)) from sync code."""
+    try:
+        while True:
+            try:
+                yield run_sync(chunks.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        run_sync(chunks.aclose())
 
-    This simple version reads file into memory then writes it.
-    For large files, you would stream chunks.
-    """
-    root = ensure_storage_dir()
-    target_dir = root / subdir
-    target_dir.mkdir(parents=True, exist_ok=True)
 
-    # WARNING: in real production, sanitize filenames or generate unique names
-    target_path = target_dir / file.filename
+def ensure_storage() -> None:
+    """Boot hook (may run in the gunicorn master): create the directory / bucket."""
+    async def _ensure():
+        try:
+            await storage.ensure()
+        finally:
+            await storage.close()
+    asyncio.run(_ensure())
 
-    async with aiofiles.open(target_path, "wb") as out:
-        content = await file.read()
-        await out.write(content)
 
-    return target_path
+def stop_sync_loop() -> None:
+    """Worker shutdown: close the background loop's connections and stop it."""
+    global _loop, _loop_thread
+    with _loop_lock:
+        loop, thread = _loop, _loop_thread
+        _loop = _loop_thread = None
+    if loop is None:
+        return
+    try:
+        asyncio.run_coroutine_threadsafe(storage.close(), loop).result(timeout=5)
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
@@ -0,0 +1,171 @@
+"""
+Per-user storage accounting and quotas.
+
+Key ideas:
+- stored_files has one row per stored blob (user, name, size) and
+  storage_usage one running total per user; both change in the same
+  transaction on upload, replace and delete, so "how much does this user
+  store" is a primary-key lookup, never a directory walk / bucket listing
+- writers lock the user's storage_usage row first, which serialises the
+  accounting of one user's concurrent uploads (and fixes the lock order)
+- the quota check runs before any byte reaches the storage driver, using the
+  upload's size; a replace only counts the difference to the old file.
+  Concurrent uploads by the same user can each pass the check, so usage may
+  overshoot by at most the files in flight
+- the heaviest users are read off ix_storage_usage_bytes (admin report)
+- blobs stored before this accounting existed are folded in once per user by
+  reconcile() (run from the lifecycle worker): missing stored_files rows are
+  added from a listing of the user's prefix and the totals recomputed
+"""
+
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+
+from .models import StoredFile, StorageUsage, User
+from .settings import settings
+from .storage import StoredObject
+from .upsert import upsert
+
+
+class QuotaExceeded(ValueError):
+    pass
+
+
+def usage(db: Session, user_id: str) -> Dict[str, Any]:
+    row = db.get(StorageUsage, user_id)
+    return {
+        "bytes": row.bytes if row else 0,
+        "files": row.files if row else 0,
+        "quota_bytes": settings.storage_quota_mb * 1024 * 1024 or None,
+        "max_files": settings.storage_max_files or None,
+    }
+
+
+def check_quota(db: Session, user_id: str, name: str, size: int) -> None:
+    """Raise QuotaExceeded if storing `size` bytes as `name` would go over the limits."""
+    check_quota_many(db, user_id, {name: size})
+
+
+def check_quota_many(db: Session, user_id: str, sizes: Dict[str, int]) -> None:
+    """Same for storing several files at once (name -> size), e.g. an import."""
+    quota = settings.storage_quota_mb * 1024 * 1024
+    max_files = settings.storage_max_files
+    if (not quota and not max_files) or not sizes:
+        return
+    row = db.get(StorageUsage, user_id)
+    old = dict(db.execute(
+        select(StoredFile.name, StoredFile.size).where(StoredFile.user_id == user_id, StoredFile.name.in_(list(sizes)))
+    ).all())
+    total = (row.bytes if row else 0) + sum(size - old.get(name, 0) for name, size in sizes.items())
+    files = (row.files if row else 0) + sum(1 for name in sizes if name not in old)
+    if quota and total > quota:
+        raise QuotaExceeded(f"Storage quota exceeded ({total} of {quota} bytes)")
+    if max_files and files > max_files:
+        raise QuotaExceeded(f"Too many files ({files} of {max_files})")
+
+
+def _lock_usage(db: Session, user_id: str) -> None:
+    db.execute(upsert(StorageUsage, {"user_id": user_id, "bytes": 0, "files": 0}, index_elements=["user_id"]))
+    db.execute(select(StorageUsage.user_id).where(StorageUsage.user_id == user_id).with_for_update())
+
+
+def record_put(db: Session, user_id: str, name: str, size: int, content_type: Optional[str] = None) -> None:
+    """Account a stored (or replaced) blob. Caller commits."""
+    now = datetime.now(timezone.utc)
+    _lock_usage(db, user_id)
+    old = db.scalar(select(StoredFile.size).where(StoredFile.user_id == user_id, StoredFile.name == name))
+    db.execute(upsert(
+        StoredFile,
+        {"user_id": user_id, "name": name, "size": size, "content_type": content_type, "updated_at": now},
+        index_elements=["user_id", "name"],
+        update=["size", "content_type", "updated_at"],
+    ))
+    db.execute(
+        update(StorageUsage)
+        .where(StorageUsage.user_id == user_id)
+        .values(
+            bytes=StorageUsage.bytes + size - (old or 0),
+            files=StorageUsage.files + (0 if old is not None else 1),
+            updated_at=now,
+        )
+    )
+
+
+def record_delete(db: Session, user_id: str, name: str) -> bool:
+    """Account a removed blob. Caller commits. False if it was not recorded."""
+    _lock_usage(db, user_id)
+    old = db.scalar(
+        delete(StoredFile).where(StoredFile.user_id == user_id, StoredFile.name == name).returning(StoredFile.size)
+    )
+    if old is None:
+        return False
+    db.execute(
+        update(StorageUsage)
+        .where(StorageUsage.user_id == user_id)
+        .values(bytes=StorageUsage.bytes - old, files=StorageUsage.files - 1, updated_at=datetime.now(timezone.utc))
+    )
+    return True
+
+
+def unreconciled(db: Session, user_ids: List[str]) -> List[str]:
+    """Those of `user_ids` whose stored blobs have not been reconciled yet."""
+    done = set(db.scalars(
+        select(StorageUsage.user_id).where(StorageUsage.user_id.in_(user_ids), StorageUsage.reconciled_at.is_not(None))
+    ))
+    return [u for u in user_ids if u not in done]
+
+
+def reconcile(db: Session, user_id: str, objects: Iterable[StoredObject]) -> int:
+    """
+    Add stored_files rows for blobs of `user_id` that have none, then recompute
+    the user's totals and mark them reconciled. Caller commits. Returns rows added.
+    """
+    now = datetime.now(timezone.utc)
+    _lock_usage(db, user_id)
+    rows = [
+        {"user_id": user_id, "name": o.key.split("/", 1)[1], "size": o.size, "content_type": None,
+         "updated_at": datetime.fromtimestamp(o.modified, tz=timezone.utc)}
+        for o in objects
+    ]
+    added = 0
+    if rows:
+        # Rows written by uploads meanwhile are newer than the listing: keep them
+        added = db.execute(upsert(StoredFile, rows, index_elements=["user_id", "name"])).rowcount
+    size, count = db.execute(
+        select(func.coalesce(func.sum(StoredFile.size), 0), func.count()).where(StoredFile.user_id == user_id)
+    ).one()
+    db.execute(
+        update(StorageUsage)
+        .where(StorageUsage.user_id == user_id)
+        .values(bytes=size, files=count, updated_at=now, reconciled_at=now)
+    )
+    return added
+
+
+def list_files(db: Session, user_id: str) -> List[Dict[str, Any]]:
+    rows = db.execute(
+        select(StoredFile.name, StoredFile.size, StoredFile.content_type, StoredFile.updated_at)
+        .where(StoredFile.user_id == user_id)
+        .order_by(StoredFile.name)
+    ).all()
+    return [r._asdict() for r in rows]
+
+
+def heaviest_users(db: Session, limit: int) -> List[Dict[str, Any]]:
+    rows = db.execute(
+        select(User.id, User.username, User.email, StorageUsage.bytes, StorageUsage.files, StorageUsage.updated_at)
+        .join(User, User.id == StorageUsage.user_id)
+        .order_by(StorageUsage.bytes.desc())
+        .limit(limit)
+    ).all()
+    return [r._asdict() for r in rows]
+
+
+def totals(db: Session) -> Dict[str, int]:
+    row = db.execute(select(
+        func.count(), func.coalesce(func.sum(StorageUsage.bytes), 0), func.coalesce(func.sum(StorageUsage.files), 0),
+    )).one()
+    return {"users": row[0], "bytes": int(row[1]), "files": int(row[2])}
@@ -0,0 +1,224 @@
+"""
+S3-compatible storage driver (AWS S3, MinIO, R2, ...). Needs aiobotocore.
+
+Key ideas:
+- one aiobotocore client per event loop, created on first use and kept, so
+  requests reuse pooled keep-alive connections (S3_MAX_POOL_CONNECTIONS)
+- put() streams: an upload smaller than one part is a single PutObject;
+  larger ones become a multipart upload with up to S3_UPLOAD_CONCURRENCY
+  parts in flight, so memory stays bounded by concurrency x part size.
+  A failed multipart upload is aborted (no orphaned parts left behind)
+- get() streams the object body in chunks
+- S3_ENDPOINT_URL points the driver at a local stand-in (MinIO, see
+  docker-compose.yml) for development and tests
+"""
+
+import asyncio
+import logging
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+from .storage import CHUNK_SIZE, Storage, StoredObject
+
+log = logging.getLogger(__name__)
+
+# S3 rejects multipart parts below 5 MiB (except the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+DELETE_BATCH = 1000
+NOT_FOUND_CODES = {"404", "NoSuchKey", "NotFound", "NoSuchBucket"}
+
+
+class S3Storage(Storage):
+    def __init__(
+        self,
+        bucket: str,
+        endpoint_url: Optional[str],
+        region: Optional[str],
+        access_key: Optional[str],
+        secret_key: Optional[str],
+        part_size: int,
+        concurrency: int,
+        max_pool_connections: int,
+    ):
+        try:
+            from aiobotocore.config import AioConfig
+            from aiobotocore.session import get_session
+            from botocore.exceptions import ClientError
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=s3 needs aiobotocore (pip install aiobotocore)") from e
+
+        if not bucket:
+            raise ValueError("STORAGE_BACKEND=s3 needs S3_BUCKET")
+        self.bucket = bucket
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.concurrency = max(1, concurrency)
+        self._ClientError = ClientError
+        self._session = get_session()
+        self._client_kwargs = {
+            "endpoint_url": endpoint_url,
+            "region_name": region,
+            "aws_access_key_id": access_key,
+            "aws_secret_access_key": secret_key,
+            "config": AioConfig(
+                max_pool_connections=max_pool_connections,
+                # Path-style works with every S3-compatible server (MinIO included)
+                s3={"addressing_style": "path"},
+                retries={"max_attempts": 3, "mode": "standard"},
+            ),
+        }
+        self._region = region
+        # event loop -> task resolving to (context manager, client)
+        self._clients: Dict[asyncio.AbstractEventLoop, asyncio.Task] = {}
+
+    # -------- clients --------
+
+    async def _open_client(self):
+        ctx = self._session.create_client("s3", **self._client_kwargs)
+        return ctx, await ctx.__aenter__()
+
+    async def _client(self):
+        loop = asyncio.get_running_loop()
+        task = self._clients.get(loop)
+        if task is None:
+            task = loop.create_task(self._open_client())
+            self._clients[loop] = task
+        return (await task)[1]
+
+    async def close(self) -> None:
+        task = self._clients.pop(asyncio.get_running_loop(), None)
+        if task is not None:
+            ctx, _ = await task
+            await ctx.__aexit__(None, None, None)
+
+    def _not_found(self, e: Exception) -> bool:
+        return isinstance(e, self._ClientError) and str(e.response.get("Error", {}).get("Code")) in NOT_FOUND_CODES
+
+    # -------- driver --------
+
+    async def ensure(self) -> None:
+        client = await self._client()
+        try:
+            await client.head_bucket(Bucket=self.bucket)
+        except Exception as e:
+            if not self._not_found(e):
+                raise
+            kwargs = {"Bucket": self.bucket}
+            if self._region and self._region != "us-east-1":
+                kwargs["CreateBucketConfiguration"] = {"LocationConstraint": self._region}
+            await client.create_bucket(**kwargs)
+
+    async def put(self, key: str, chunks: AsyncIterator[bytes], content_type: Optional[str] = None) -> StoredObject:
+        client = await self._client()
+        extra = {"ContentType": content_type} if content_type else {}
+        source = chunks.__aiter__()
+
+        async def next_part() -> bytes:
+            buf = bytearray()
+            while len(buf) < self.part_size:
+                try:
+                    buf += await source.__anext__()
+                except StopAsyncIteration:
+                    break
+            return bytes(buf)
+
+        body = await next_part()
+        if len(body) < self.part_size:
+            r = await client.put_object(Bucket=self.bucket, Key=key, Body=body, **extra)
+            return StoredObject(key, len(body), time.time(), r.get("ETag"))
+
+        upload_id = (await client.create_multipart_upload(Bucket=self.bucket, Key=key, **extra))["UploadId"]
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks: List[asyncio.Task] = []
+
+        async def send(number: int, data: bytes) -> Dict[str, object]:
+            try:
+                r = await client.upload_part(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data,
+                )
+                return {"PartNumber": number, "ETag": r["ETag"]}
+            finally:
+                slots.release()
+
+        size = 0
+        try:
+            while body:
+                # Wait for a free slot before reading the next part: bounded memory
+                await slots.acquire()
+                failed = next((t for t in tasks if t.done() and t.exception()), None)
+                if failed is not None:
+                    slots.release()
+                    raise failed.exception()
+                size += len(body)
+                tasks.append(asyncio.create_task(send(len(tasks) + 1, body)))
+                body = await next_part()
+            parts = await asyncio.gather(*tasks)
+            r = await client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            try:
+                await client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            except Exception:
+                log.warning("Could not abort multipart upload of %s", key, exc_info=True)
+            raise
+        return StoredObject(key, size, time.time(), r.get("ETag"))
+
+    async def get(self, key: str, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        client = await self._client()
+        try:
+            r = await client.get_object(Bucket=self.bucket, Key=key)
+        except Exception as e:
+            if self._not_found(e):
+                raise FileNotFoundError(key) from e
+            raise
+        body = r["Body"]
+        try:
+            while True:
+                chunk = await body.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            body.close()
+
+    async def stat(self, key: str) -> Optional[StoredObject]:
+        client = await self._client()
+        try:
+            r = await client.head_object(Bucket=self.bucket, Key=key)
+        except Exception as e:
+            if self._not_found(e):
+                return None
+            raise
+        return StoredObject(key, r["ContentLength"], r["LastModified"].timestamp(), r.get("ETag"))
+
+    async def delete(self, key: str) -> None:
+        client = await self._client()
+        await client.delete_object(Bucket=self.bucket, Key=key)
+
+    async def list(self, prefix: str) -> List[StoredObject]:
+        client = await self._client()
+        out = []
+        async for page in client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for o in page.get("Contents", []):
+                out.append(StoredObject(o["Key"], o["Size"], o["LastModified"].timestamp(), o.get("ETag")))
+        return out
+
+    async def delete_prefix(self, prefix: str) -> int:
+        client = await self._client()
+        keys = [o.key for o in await self.list(prefix)]
+        for i in range(0, len(keys), DELETE_BATCH):
+            await client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i:i + DELETE_BATCH]], "Quiet": True},
+            )
+        return len(keys)
+
+    async def prefixes(self) -> List[str]:
+        client = await self._client()
+        out = []
+        async for page in client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Delimiter="/"):
+            out.extend(p["Prefix"].rstrip("/") for p in page.get("CommonPrefixes", []))
+        return out
@@ -0,0 +1,295 @@
+"""
+Lightweight request tracing.
+
+Key ideas:
+- every request gets a request id (incoming X-Request-ID if it is short and
+  plain, else a new one), kept in a contextvar and returned as the
+  X-Request-ID response header
+- a fraction of requests (TRACE_SAMPLE_RATE, or any request sent with
+  "X-Trace: 1" when TRACE_HEADER_ENABLED=1) is traced: span("name") blocks
+  record their timing and nesting; SQL statements and pool checkouts are
+  recorded automatically
+- unsampled requests pay one contextvar lookup per span / query
+- finished traces go to a bounded in-memory store (/monitor/traces) and,
+  if TRACE_OTLP_ENDPOINT is set, to an OTLP/HTTP (JSON) collector from a
+  background thread; export never blocks a request and drops on overflow
+"""
+
+import json
+import logging
+import os
+import queue
+import random
+import re
+import threading
+import time
+import urllib.request
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, List, Optional
+
+from fastapi import Request
+from sqlalchemy import event
+
+from .settings import settings
+
+log = logging.getLogger(__name__)
+
+# Incoming X-Request-ID values are echoed and stored: only short, plain ones
+_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,64}")
+
+
+class Trace:
+    __slots__ = ("trace_id", "request_id", "start_ns", "start", "spans", "_next_id")
+
+    def __init__(self, request_id: str):
+        self.trace_id = uuid.uuid4().hex
+        self.request_id = request_id
+        self.start_ns = time.time_ns()
+        self.start = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self._next_id = 0
+
+    def new_span_id(self) -> str:
+        # 16 hex chars, unique within the trace
+        self._next_id += 1
+        return f"{self._next_id:016x}"
+
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.start) * 1000.0
+
+
+_request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+_trace: ContextVar[Optional[Trace]] = ContextVar("trace", default=None)
+_parent: ContextVar[Optional[str]] = ContextVar("span_parent", default=None)
+
+traces: Deque[Dict[str, Any]] = deque(maxlen=settings.trace_store_size)
+trace_stats = {"sampled": 0, "exported": 0, "export_errors": 0, "export_dropped": 0}
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def sampled() -> bool:
+    return _trace.get() is not None
+
+
+def _record(trace: Trace, name: str, span_id: str, parent: Optional[str], start_ms: float, attrs: Dict[str, Any]) -> None:
+    trace.spans.append({
+        "name": name,
+        "span_id": span_id,
+        "parent_id": parent,
+        "start_ms": round(start_ms, 3),
+        "ms": round(trace.elapsed_ms() - start_ms, 3),
+        "attrs": attrs,
+    })
+
+
+@contextmanager
+def span(name: str, **attrs):
+    trace = _trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = trace.new_span_id()
+    parent = _parent.get()
+    token = _parent.set(span_id)
+    start_ms = trace.elapsed_ms()
+    try:
+        yield
+    finally:
+        _parent.reset(token)
+        _record(trace, name, span_id, parent, start_ms, attrs)
+
+
+# -------- automatic DB spans --------
+
+def instrument_engine(engine) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        if _trace.get() is not None:
+            conn.info.setdefault("trace_start", []).append(_trace.get().elapsed_ms())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        trace = _trace.get()
+        starts = conn.info.get("trace_start")
+        if trace is None or not starts:
+            return
+        _record(trace, "db.query", trace.new_span_id(), _parent.get(), starts.pop(), {
+            "db.statement": " ".join(statement.split())[:300],
+            "db.rows": cursor.rowcount,
+        })
+
+
+def traced_checkout(db) -> None:
+    """Acquire the session's connection now, so pool wait shows up as a span."""
+    if _trace.get() is not None:
+        with span("db.checkout"):
+            db.connection()
+
+
+# -------- OTLP export --------
+
+def _otlp_attrs(attrs: Dict[str, Any]) -> List[Dict[str, Any]]:
+    out = []
+    for k, v in attrs.items():
+        if isinstance(v, bool):
+            out.append({"key": k, "value": {"boolValue": v}})
+        elif isinstance(v, int):
+            out.append({"key": k, "value": {"intValue": str(v)}})
+        elif isinstance(v, float):
+            out.append({"key": k, "value": {"doubleValue": v}})
+        else:
+            out.append({"key": k, "value": {"stringValue": str(v)}})
+    return out
+
+
+def _otlp_spans(t: Dict[str, Any]) -> List[Dict[str, Any]]:
+    base = t["start_ns"]
+    spans = []
+    for s in t["spans"]:
+        start = base + int(s["start_ms"] * 1e6)
+        item = {
+            "traceId": t["trace_id"],
+            "spanId": s["span_id"],
+            "name": s["name"],
+            "kind": 2 if s["parent_id"] is None else 1,  # SERVER root, INTERNAL children
+            "startTimeUnixNano": str(start),
+            "endTimeUnixNano": str(start + int(s["ms"] * 1e6)),
+            "attributes": _otlp_attrs(s["attrs"]),
+        }
+        if s["parent_id"]:
+            item["parentSpanId"] = s["parent_id"]
+        spans.append(item)
+    return spans
+
+
+class OTLPExporter:
+    def __init__(self, endpoint: str, service_name: str, max_queue: int = 1000, interval_sec: float = 2.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.interval_sec = interval_sec
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=max_queue)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, t: Dict[str, Any]) -> None:
+        try:
+            self._queue.put_nowait(t)
+        except queue.Full:
+            trace_stats["export_dropped"] += 1
+
+    def _drain(self) -> List[Dict[str, Any]]:
+        batch = []
+        while len(batch) < 200:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _send(self, batch: List[Dict[str, Any]]) -> None:
+        body = {"resourceSpans": [{
+            "resource": {"attributes": _otlp_attrs({"service.name": self.service_name, "process.pid": os.getpid()})},
+            "scopeSpans": [{
+                "scope": {"name": "app.tracing"},
+                "spans": [s for t in batch for s in _otlp_spans(t)],
+            }],
+        }]}
+        req = urllib.request.Request(
+            self.endpoint,
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(req, timeout=5):
+                pass
+            trace_stats["exported"] += len(batch)
+        except Exception:
+            trace_stats["export_errors"] += 1
+            log.debug("OTLP export failed", exc_info=True)
+
+    def _run(self) -> None:
+        while not self._stop_event.wait(self.interval_sec):
+            while True:
+                batch = self._drain()
+                if not batch:
+                    break
+                self._send(batch)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="otlp-export", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout=5)
+        self._thread = None
+        batch = self._drain()
+        if batch:
+            self._send(batch)
+
+
+exporter = OTLPExporter(settings.trace_otlp_endpoint, settings.trace_service_name) if settings.trace_otlp_endpoint else None
+
+
+# -------- middleware --------
+
+def _incoming_request_id(request: Request) -> Optional[str]:
+    value = request.headers.get("x-request-id")
+    return value if value and _REQUEST_ID.fullmatch(value) else None
+
+
+async def tracing_middleware(request: Request, call_next):
+    request_id = _incoming_request_id(request) or uuid.uuid4().hex
+    rid_token = _request_id.set(request_id)
+
+    trace = None
+    # Forced tracing is opt-in: traces hold SQL text and the store is bounded
+    forced = settings.trace_header_enabled and request.headers.get("x-trace") == "1"
+    if forced or (
+        settings.trace_sample_rate > 0 and random.random() < settings.trace_sample_rate
+    ):
+        trace = Trace(request_id)
+    trace_token = _trace.set(trace)
+
+    status = 500
+    try:
+        if trace is None:
+            response = await call_next(request)
+        else:
+            with span(f"{request.method} {request.url.path}", **{"http.method": request.method, "http.target": request.url.path}):
+                response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        _trace.reset(trace_token)
+        _request_id.reset(rid_token)
+        if trace is not None:
+            root = trace.spans[-1]  # the request span closes last
+            root["attrs"]["http.status_code"] = status
+            item = {
+                "trace_id": trace.trace_id,
+                "request_id": trace.request_id,
+                "method": request.method,
+                "path": request.url.path,
+                "status": status,
+                "ms": root["ms"],
+                "start_ns": trace.start_ns,
+                "spans": sorted(trace.spans, key=lambda s: s["start_ms"]),
+            }
+            traces.appendleft(item)
+            trace_stats["sampled"] += 1
+            if exporter is not None:
+                exporter.submit(item)
@@ -0,0 +1,229 @@
+"""
+Per-user travel counts and the friends leaderboard (/friends/leaderboard).
+
+Key ideas:
+- countries / cities / continents visited are derived from app_data once per
+  write and stored in the small travel_stats table, so ranking friends never
+  loads anyone's app_data blob (users without a row yet are backfilled once)
+- a change in someone's counts or visibility is announced with NOTIFY (only
+  when something actually changed, not on every autosave)
+- each worker caches the stats rows of a user's leaderboard (the user plus
+  friends) in an LRU; entries are dropped when a member's counts change, and
+  rebuilt when the friend set no longer matches friend_graph
+- users with travel_visible_to_friends = false are left out of other
+  people's leaderboards
+"""
+
+import csv
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from .db import SessionLocal
+from .feed_hub import listen, notify
+from .friend_graph import friend_graph
+from .models import User, TravelStats
+from .settings import settings
+from .upsert import upsert
+
+TRAVEL_STATS_CHANNEL = "travel_stats"
+SORT_KEYS = ("countries", "cities", "continents")
+
+_CONTINENTS_CSV = Path(__file__).parent / "data" / "country_continents.csv"
+
+
+def _load_continents() -> Dict[str, str]:
+    out = {}
+    with _CONTINENTS_CSV.open(encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            out[row["ISO2"].strip().upper()] = row["Continent"].strip()
+    return out
+
+
+ISO2_TO_CONTINENT = _load_continents()
+
+
+def compute(app_data: Dict[str, Any]) -> Tuple[int, int, int]:
+    """(countries, cities, continents) from an app_data blob."""
+    selected = (app_data or {}).get("selectedCountries")
+    continents: Set[str] = set()
+    if isinstance(selected, dict):
+        # v2: ISO2 -> {name, continent}
+        isos = {str(k).upper() for k in selected}
+        for iso, meta in selected.items():
+            c = meta.get("continent") if isinstance(meta, dict) else None
+            continents.add(c or ISO2_TO_CONTINENT.get(str(iso).upper(), ""))
+    elif isinstance(selected, list):
+        isos = {str(x).upper() for x in selected}
+        continents = {ISO2_TO_CONTINENT.get(iso, "") for iso in isos}
+    else:
+        isos = set()
+
+    cities_by_country = (app_data or {}).get("citiesByCountry")
+    cities = 0
+    if isinstance(cities_by_country, dict):
+        cities = sum(len(v) for v in cities_by_country.values() if isinstance(v, list))
+
+    continents -= {"", "Unknown"}
+    return len(isos), cities, len(continents)
+
+
+def _row(user_id: str, counts: Tuple[int, int, int]) -> Dict[str, Any]:
+    return {
+        "user_id": user_id,
+        "countries": counts[0],
+        "cities": counts[1],
+        "continents": counts[2],
+        "updated_at": datetime.now(timezone.utc),
+    }
+
+
+def update_for(db: Session, user_id: str, old: Optional[Dict[str, Any]], new: Dict[str, Any], visibility_changed: bool = False) -> None:
+    """Keep travel_stats in step with an app_data write (same transaction)."""
+    counts = compute(new)
+    if old is not None and compute(old) == counts:
+        # Autosaves that don't touch visited places: only make sure a row exists
+        db.execute(upsert(TravelStats, _row(user_id, counts), index_elements=["user_id"]))
+    else:
+        db.execute(upsert(
+            TravelStats, _row(user_id, counts),
+            index_elements=["user_id"],
+            update=["countries", "cities", "continents", "updated_at"],
+        ))
+        visibility_changed = True
+    if visibility_changed:
+        notify(db, TRAVEL_STATS_CHANNEL, {"user_ids": [user_id]})
+
+
+def backfill(db: Session, user_ids: List[str]) -> Dict[str, Tuple[int, int, int]]:
+    """Compute and store counts for users that have no travel_stats row yet."""
+    rows = db.execute(select(User.id, User.app_data).where(User.id.in_(user_ids))).all()
+    out = {r.id: compute(r.app_data or {}) for r in rows}
+    if out:
+        # Its own short transaction on the primary: the caller's session may be
+        # a replica, and a GET must not commit whatever the request has pending
+        write = SessionLocal()
+        try:
+            write.execute(upsert(TravelStats, [_row(uid, c) for uid, c in out.items()], index_elements=["user_id"]))
+            write.commit()
+        finally:
+            write.close()
+    return out
+
+
+class LeaderboardCache:
+    """owner -> (friend set, member rows, loaded_at); reverse index member -> owners."""
+
+    def __init__(self, max_users: int, ttl_sec: float):
+        self.max_users = max_users
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._owners_of: Dict[str, Set[str]] = {}
+
+    def _drop(self, owner: str) -> None:
+        entry = self._entries.pop(owner, None)
+        if entry is None:
+            return
+        for member in {owner, *entry[0]}:
+            owners = self._owners_of.get(member)
+            if owners is not None:
+                owners.discard(owner)
+                if not owners:
+                    del self._owners_of[member]
+
+    def get(self, owner: str, friend_ids: FrozenSet[str]) -> Optional[List[Dict[str, Any]]]:
+        with self._lock:
+            entry = self._entries.get(owner)
+            if entry is None:
+                return None
+            if entry[0] != friend_ids or time.monotonic() - entry[2] > self.ttl_sec:
+                self._drop(owner)
+                return None
+            self._entries.move_to_end(owner)
+            return entry[1]
+
+    def put(self, owner: str, friend_ids: FrozenSet[str], rows: List[Dict[str, Any]]) -> None:
+        with self._lock:
+            self._drop(owner)
+            self._entries[owner] = (friend_ids, rows, time.monotonic())
+            # Indexed by friend set, not rows: hidden friends can become visible
+            for member in {owner, *friend_ids}:
+                self._owners_of.setdefault(member, set()).add(owner)
+            while len(self._entries) > self.max_users:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, user_ids: List[str]) -> None:
+        with self._lock:
+            for uid in user_ids:
+                for owner in list(self._owners_of.get(uid, ())):
+                    self._drop(owner)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._owners_of.clear()
+
+
+leaderboard_cache = LeaderboardCache(settings.leaderboard_cache_size, settings.leaderboard_cache_ttl_sec)
+
+listen(
+    TRAVEL_STATS_CHANNEL,
+    lambda msg: leaderboard_cache.invalidate(msg.get("user_ids") or []),
+    leaderboard_cache.clear,
+)
+
+
+def _members(db: Session, user_id: str, friend_ids: FrozenSet[str]) -> List[Dict[str, Any]]:
+    ids = [user_id, *friend_ids]
+    rows = db.execute(
+        select(
+            User.id, User.username, User.first_name, User.last_name, User.travel_visible_to_friends,
+            TravelStats.countries, TravelStats.cities, TravelStats.continents,
+        )
+        .outerjoin(TravelStats, TravelStats.user_id == User.id)
+        .where(User.id.in_(ids), User.is_deleted == False)  # noqa: E712
+    ).all()
+
+    missing = [r.id for r in rows if r.countries is None and (r.id == user_id or r.travel_visible_to_friends)]
+    filled = backfill(db, missing) if missing else {}
+
+    members = []
+    for r in rows:
+        if r.id != user_id and not r.travel_visible_to_friends:
+            continue
+        counts = filled.get(r.id) or (r.countries, r.cities, r.continents)
+        members.append({
+            "user_id": r.id,
+            "username": r.username,
+            "first_name": r.first_name,
+            "last_name": r.last_name,
+            "countries": counts[0] or 0,
+            "cities": counts[1] or 0,
+            "continents": counts[2] or 0,
+        })
+    return members
+
+
+def leaderboard(db: Session, user_id: str, sort: str) -> List[Dict[str, Any]]:
+    friend_ids = friend_graph.friend_ids(db, user_id)
+    members = leaderboard_cache.get(user_id, friend_ids)
+    if members is None:
+        members = _members(db, user_id, friend_ids)
+        leaderboard_cache.put(user_id, friend_ids, members)
+
+    others = [k for k in SORT_KEYS if k != sort]
+    ranked = sorted(members, key=lambda m: (-m[sort], -m[others[0]], -m[others[1]], m["username"]))
+
+    out, rank, prev = [], 0, None
+    for i, m in enumerate(ranked):
+        if m[sort] != prev:
+            rank, prev = i + 1, m[sort]
+        out.append({**m, "rank": rank, "is_me": m["user_id"] == user_id})
+    return out
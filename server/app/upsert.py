@@ -0,0 +1,64 @@
+"""
+Upsert helpers on top of Postgres INSERT ... ON CONFLICT.
+
+Key ideas:
+- one statement instead of SELECT-then-INSERT/UPDATE (no race window
+  against unique constraints, one round trip)
+- helpers return statements, not results, so callers can add
+  .returning(...) or wrap them in a CTE to read the new state back
+  in the same round trip
+- `update` is either a list of column names (take the incoming value) or
+  a dict of column name -> SQL expression (e.g. counters)
+- `where` limits which conflicting rows get updated (others are left alone
+  and not returned)
+"""
+
+from typing import Any, Dict, Iterable, List, Optional, Union
+
+from sqlalchemy import Select
+from sqlalchemy.dialects.postgresql import Insert, insert as pg_insert
+
+Update = Union[Iterable[str], Dict[str, Any], None]
+
+
+def _on_conflict(stmt: Insert, constraint: Optional[str], index_elements: Optional[List[str]], update: Update, where=None) -> Insert:
+    target = {"constraint": constraint} if constraint else {"index_elements": index_elements}
+    if not update:
+        return stmt.on_conflict_do_nothing(**target)
+
+    if isinstance(update, dict):
+        set_ = dict(update)
+    else:
+        set_ = {name: stmt.excluded[name] for name in update}
+    return stmt.on_conflict_do_update(set_=set_, where=where, **target)
+
+
+def upsert(
+    model,
+    rows: Union[Dict[str, Any], List[Dict[str, Any]]],
+    *,
+    constraint: Optional[str] = None,
+    index_elements: Optional[List[str]] = None,
+    update: Update = None,
+    where=None,
+) -> Insert:
+    """INSERT rows; on conflict update the given columns (or do nothing if none)."""
+    return _on_conflict(pg_insert(model).values(rows), constraint, index_elements, update, where)
+
+
+def upsert_from_select(
+    model,
+    columns: List[str],
+    select: Select,
+    *,
+    constraint: Optional[str] = None,
+    index_elements: Optional[List[str]] = None,
+    update: Update = None,
+) -> Insert:
+    """
+    INSERT ... SELECT with ON CONFLICT. Useful when the rows depend on other
+    tables (an empty SELECT inserts nothing, e.g. when a parent row is missing).
+    Pass every column explicitly: Python-side defaults are not applied here.
+    """
+    stmt = pg_insert(model).from_select(columns, select, include_defaults=False)
+    return _on_conflict(stmt, constraint, index_elements, update)
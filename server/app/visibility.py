@@ -0,0 +1,60 @@
+"""
+Activity visibility classes.
+
+Key ideas:
+- every activity type belongs to a visibility class that says which friends
+  may see it: "friends" (all friends) or "travel" (only while the actor has
+  travel_visible_to_friends on)
+- the class is stored on the activity row, so feed queries filter in SQL with
+  a join against the actor's users row (covered by ix_users_feed_visible);
+  nothing is loaded per activity, and a privacy change applies to the very
+  next read
+- unknown types get the strictest class
+"""
+
+from typing import Any, Dict, List
+
+from sqlalchemy import and_, or_
+
+from .models import Activity, User
+
+VISIBILITY_FRIENDS = "friends"
+VISIBILITY_TRAVEL = "travel"
+
+ACTIVITY_VISIBILITY = {
+    "data_updated": VISIBILITY_TRAVEL,
+}
+
+
+def visibility_for(activity_type: str) -> str:
+    return ACTIVITY_VISIBILITY.get(activity_type, VISIBILITY_TRAVEL)
+
+
+def visible_to_friends():
+    """
+    WHERE clause for activities joined with their actor (users): live actors
+    only, travel-class activities only while the actor shares travel.
+    """
+    return and_(
+        User.is_deleted == False,  # noqa: E712
+        or_(Activity.visibility == VISIBILITY_FRIENDS, User.travel_visible_to_friends == True),  # noqa: E712
+    )
+
+
+def visible_now(db, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The activity rows (dicts) friends may see right now; one query for the batch."""
+    actor_ids = {r["actor_user_id"] for r in rows}
+    if not actor_ids:
+        return []
+    actors = {
+        a.id: a for a in db.query(User.id, User.is_deleted, User.travel_visible_to_friends)
+        .filter(User.id.in_(actor_ids))
+    }
+    out = []
+    for r in rows:
+        a = actors.get(r["actor_user_id"])
+        if a is None or a.is_deleted:
+            continue
+        if r["visibility"] == VISIBILITY_FRIENDS or a.travel_visible_to_friends:
+            out.append(r)
+    return out
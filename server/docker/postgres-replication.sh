@@ -0,0 +1,5 @@
+#!/bin/bash
+# Runs once, on first init of the primary's data directory:
+# allow streaming replication connections (used by the optional db-replica service).
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
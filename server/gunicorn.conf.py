@@ -0,0 +1,33 @@
+"""
+Gunicorn config.
+
+preload_app: the master imports the app once and runs the one-time boot tasks
+(migrations, admin seeding) before forking, so workers start from a warm
+interpreter. The master disposes its DB pool before forking and every worker
+drops whatever it inherited in post_fork, so no connection is ever shared.
+"""
+
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8080")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+timeout = 60
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def when_ready(server):
+    if preload_app:
+        from app.boot import run_boot_tasks_once, timed
+
+        with timed("master_boot_tasks"):
+            run_boot_tasks_once()
+
+
+def post_fork(server, worker):
+    from app.db import engine, read_engine
+
+    # Forget (don't close) connections inherited from the master
+    engine.dispose(close=False)
+    if read_engine is not None:
+        read_engine.dispose(close=False)